@@ -104,6 +104,7 @@ class Update(db.Model):
     supply_request_id = db.Column(db.Integer, db.ForeignKey('supply_requests.id'), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-# Create tables
-with app.app_context():
-    db.create_all()
\ No newline at end of file
+# Create tables when run directly, never on import
+if __name__ == '__main__':
+    with app.app_context():
+        db.create_all()
\ No newline at end of file
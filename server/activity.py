@@ -0,0 +1,246 @@
+import re
+import threading
+import time
+import click
+from datetime import datetime, timezone
+from flask.cli import AppGroup
+from sqlalchemy import Column, DateTime, Index, Integer, MetaData, String, Table, Text, and_, func, inspect, select, union
+from models import Admin, Clerk, Update, db
+from pagination import keyset_after
+
+FEED_FIELDS = (
+    'id', 'action', 'description', 'merchant_id', 'admin_id', 'clerk_id', 'item_id', 'supply_request_id', 'created_at'
+)
+FEED_FILTERS = ('merchant_id', 'admin_id', 'clerk_id', 'item_id', 'supply_request_id')
+
+# Rows older than the live window are moved out of `updates` into one table
+# per month, updates_archive_YYYYMM. These tables are not models: they are
+# created by `flask updates archive`, kept out of db.metadata (so create_all
+# and autogenerate leave them alone) and have no foreign keys, so deleting an
+# item or account never has to look at archived history.
+ARCHIVE_NAME = re.compile(r'^updates_archive_(\d{4})(\d{2})$')
+ARCHIVE_TABLES_TTL = 60
+
+archive_metadata = MetaData()
+updates_cli = AppGroup('updates', help='Maintain the updates activity log.')
+
+
+def archive_table(year, month):
+    name = f'updates_archive_{year:04d}{month:02d}'
+    if name in archive_metadata.tables:
+        return archive_metadata.tables[name]
+    return Table(
+        name, archive_metadata,
+        Column('id', Integer, primary_key=True, autoincrement=False),
+        Column('action', String(100), nullable=False),
+        Column('description', Text, nullable=False),
+        Column('merchant_id', Integer),
+        Column('admin_id', Integer),
+        Column('clerk_id', Integer),
+        Column('item_id', Integer),
+        Column('supply_request_id', Integer),
+        Column('created_at', DateTime),
+        Index(f'ix_{name}_created_at', 'created_at'),
+        Index(f'ix_{name}_merchant_id_created_at', 'merchant_id', 'created_at'),
+        Index(f'ix_{name}_admin_id_created_at', 'admin_id', 'created_at'),
+        Index(f'ix_{name}_clerk_id_created_at', 'clerk_id', 'created_at'),
+        Index(f'ix_{name}_item_id', 'item_id'),
+        Index(f'ix_{name}_supply_request_id', 'supply_request_id'),
+    )
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    # Passed to Flask-Migrate so autogenerate does not offer to drop the
+    # archive tables.
+    if type_ == 'table' and ARCHIVE_NAME.match(name):
+        return False
+    if type_ == 'index' and ARCHIVE_NAME.match(getattr(object.table, 'name', '')):
+        return False
+    return True
+
+
+class ArchiveTables:
+    # The archive months that exist, newest first. Listing tables costs a
+    # catalog query, so the answer is reused for ARCHIVE_TABLES_TTL seconds;
+    # a month archived by another process shows up in the feed within that.
+    def __init__(self):
+        self._months = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def months(self):
+        if self._months is None or self._expires < time.monotonic():
+            months = sorted(
+                ((int(m.group(1)), int(m.group(2)))
+                 for m in map(ARCHIVE_NAME.match, inspect(db.engine).get_table_names()) if m),
+                reverse=True
+            )
+            with self._lock:
+                self._months = months
+                self._expires = time.monotonic() + ARCHIVE_TABLES_TTL
+        return self._months
+
+    def invalidate(self):
+        with self._lock:
+            self._months = None
+
+
+archive_tables = ArchiveTables()
+
+
+def month_start(year, month):
+    return datetime(year, month, 1)
+
+
+def next_month(year, month):
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def scoped_updates(query, table, current_user):
+    # Clerks see their own actions; admins also see their clerks'; merchants
+    # see their own, their admins' and those admins' clerks'. Returns one
+    # query per kind of actor so that each can walk its own
+    # (actor_id, created_at) index; an OR of the three leads planners to walk
+    # the whole created_at index instead.
+    role = current_user['role']
+    user_id = current_user['id']
+    if role == 'clerks':
+        return [query.where(table.c.clerk_id == user_id)]
+    if role == 'admins':
+        return [
+            query.where(table.c.admin_id == user_id),
+            query.join(Clerk, Clerk.id == table.c.clerk_id).where(Clerk.admin_id == user_id)
+        ]
+    if role == 'merchants':
+        return [
+            query.where(table.c.merchant_id == user_id),
+            query.join(Admin, Admin.id == table.c.admin_id).where(Admin.merchant_id == user_id),
+            query.join(Clerk, Clerk.id == table.c.clerk_id).join(Admin, Admin.id == Clerk.admin_id)
+            .where(Admin.merchant_id == user_id)
+        ]
+    raise ValueError(f"Unknown role: {role}")
+
+
+def parse_feed_filters(args):
+    filters = {}
+    for name in FEED_FILTERS:
+        if args.get(name):
+            try:
+                filters[name] = int(args[name])
+            except ValueError:
+                raise ValueError(f"{name} must be an integer")
+    if args.get('action'):
+        filters['action'] = args['action']
+    for name in ('since', 'until'):
+        if args.get(name):
+            try:
+                value = datetime.fromisoformat(args[name])
+            except ValueError:
+                raise ValueError(f"{name} must be an ISO 8601 timestamp")
+            # Stored times are naive UTC; so are the archive month bounds
+            # feed_sources compares these with.
+            if value.tzinfo is not None:
+                value = value.astimezone(timezone.utc).replace(tzinfo=None)
+            filters[name] = value
+    return filters
+
+
+def feed_query(table, current_user, filters, cursor, limit):
+    conditions = [table.c[name] == filters[name] for name in FEED_FILTERS + ('action',) if name in filters]
+    if 'since' in filters:
+        conditions.append(table.c.created_at >= filters['since'])
+    if 'until' in filters:
+        conditions.append(table.c.created_at < filters['until'])
+    if cursor:
+        conditions.append(keyset_after(table.c.created_at, table.c.id, cursor))
+
+    branches = [
+        branch.where(*conditions).order_by(table.c.created_at.desc(), table.c.id.desc()).limit(limit)
+        for branch in scoped_updates(select(*[table.c[f] for f in FEED_FIELDS]), table, current_user)
+    ]
+    if len(branches) == 1:
+        return branches[0]
+    # Each branch is already limited; UNION drops a row reached through two
+    # actors (say an admin acting on their own clerk's record).
+    merged = union(*[select(*b.subquery().c) for b in branches]).subquery()
+    return select(merged).order_by(merged.c.created_at.desc(), merged.c.id.desc()).limit(limit)
+
+
+def feed_sources(filters, cursor):
+    # The live table first, then archive months newest to oldest, skipping
+    # months entirely outside the requested range or newer than the cursor.
+    # Each comes with the time its rows are all older than, None for the
+    # live table.
+    yield Update.__table__, None
+    lower = filters.get('since')
+    upper = min((t for t in (filters.get('until'), cursor and cursor[0]) if t), default=None)
+    for year, month in archive_tables.months():
+        if upper and month_start(year, month) >= upper:
+            continue
+        if lower and month_start(*next_month(year, month)) <= lower:
+            break
+        yield archive_table(year, month), month_start(*next_month(year, month))
+
+
+def feed_order(row):
+    return row.created_at or datetime.min, row.id
+
+
+def load_feed(current_user, filters, cursor, limit):
+    # Merges the sources newest first. `updates` usually holds only rows
+    # newer than the archive, but nothing enforces it: the audit writer
+    # inserts rows stamped when they were recorded, and a replayed spool
+    # can add rows from a month already archived. So archive months are
+    # read as long as they could hold a row newer than the oldest of the
+    # limit + 1 kept so far, and rows are ordered across sources. A typical
+    # first page still never leaves the live table.
+    rows = []
+    for table, before in feed_sources(filters, cursor):
+        if before is not None and len(rows) > limit and before <= feed_order(rows[limit])[0]:
+            break
+        rows += db.session.execute(feed_query(table, current_user, filters, cursor, limit + 1)).all()
+        rows = sorted(rows, key=feed_order, reverse=True)[:limit + 1]
+    return rows
+
+
+def archive_updates(before):
+    # Moves whole months older than `before` (the first day of a month) into
+    # their archive tables, one transaction per month.
+    oldest = db.session.scalar(select(func.min(Update.created_at)))
+    moved = {}
+    if oldest is None:
+        return moved
+    year, month = oldest.year, oldest.month
+    while month_start(year, month) < before:
+        start, end = month_start(year, month), month_start(*next_month(year, month))
+        in_month = and_(Update.created_at >= start, Update.created_at < end)
+        table = archive_table(year, month)
+        table.create(db.session.connection(), checkfirst=True)
+        columns = [Update.__table__.c[f] for f in FEED_FIELDS]
+        result = db.session.execute(
+            table.insert().from_select(FEED_FIELDS, select(*columns).where(in_month))
+        )
+        # Delete exactly what was copied: a row committed between the two
+        # statements stays in `updates` until the next run.
+        db.session.execute(Update.__table__.delete().where(in_month, Update.id.in_(select(table.c.id))))
+        db.session.commit()
+        if result.rowcount:
+            moved[table.name] = result.rowcount
+        year, month = next_month(year, month)
+    archive_tables.invalidate()
+    return moved
+
+
+@updates_cli.command('archive')
+@click.option('--keep-months', default=3, show_default=True,
+              help='Whole months kept in the live table, counting the current one.')
+def archive_command(keep_months):
+    """Move older rows from updates into monthly archive tables."""
+    now = datetime.utcnow()
+    year, month = now.year, now.month - max(keep_months - 1, 0)
+    while month < 1:
+        year, month = year - 1, month + 12
+    moved = archive_updates(month_start(year, month))
+    for name, count in moved.items():
+        click.echo(f"{name}: {count} rows")
+    click.echo(f"Archived {sum(moved.values())} rows older than {year:04d}-{month:02d}-01")
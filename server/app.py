@@ -1,48 +1,133 @@
+import importlib
+import click
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
+from flask.cli import ScriptInfo
 from flask_jwt_extended import JWTManager
 from flask_restful import Api
+from sqlalchemy.orm import configure_mappers
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt.exceptions import PyJWTError
 from config import Config
 from models import db  # Import db from models.py
-from blueprints.auth import auth_bp, RegisterUser, LoginUser, LogoutUser, RefreshToken
-from blueprints.items import items_bp, ItemEndpoint, ItemEndpointById
-from blueprints.supply_requests import supply_requests_bp, SupplyRequestEndpoint, SupplyRequestEndpointById
-from blueprints.stores import stores_bp, StoreEndpoint, StoreEndpointById
-from blueprints.users import users_bp, UserEndpoint, UserEndpointById
-from blueprints.reports import reports_bp, WeeklyReport, MonthlyReport, AnnualReport
-
-app = Flask(__name__)
-app.config.from_object(Config)
-db.init_app(app)  # Initialize db with app
-migrate = Migrate(app, db)
-jwt = JWTManager(app)
-api = Api(app)
-
-# Register Blueprints
-app.register_blueprint(auth_bp, url_prefix='/auth')
-app.register_blueprint(items_bp, url_prefix='/items')
-app.register_blueprint(supply_requests_bp, url_prefix='/supply_requests')
-app.register_blueprint(stores_bp, url_prefix='/stores')
-app.register_blueprint(users_bp, url_prefix='/users')
-app.register_blueprint(reports_bp, url_prefix='/reports')
-
-# Add Resources
-api.add_resource(RegisterUser, '/auth/register')
-api.add_resource(LoginUser, '/auth/login')
-api.add_resource(LogoutUser, '/auth/logout')
-api.add_resource(RefreshToken, '/auth/refresh')
-api.add_resource(ItemEndpoint, '/items')
-api.add_resource(ItemEndpointById, '/items/<int:id>')
-api.add_resource(SupplyRequestEndpoint, '/supply_requests')
-api.add_resource(SupplyRequestEndpointById, '/supply_requests/<int:id>')
-api.add_resource(StoreEndpoint, '/stores')
-api.add_resource(StoreEndpointById, '/stores/<int:id>')
-api.add_resource(UserEndpoint, '/users')
-api.add_resource(UserEndpointById, '/users/<int:id>')
-api.add_resource(WeeklyReport, '/reports/weekly')
-api.add_resource(MonthlyReport, '/reports/monthly')
-api.add_resource(AnnualReport, '/reports/annual')
+from rollups import rollups_cli
+from audit import audit
+from cache import response_cache
+from passwords import passwords
+from dbpool import configure_engine, engine_options, instrument_engine
+from routing import replica_router
+from instrumentation import instrumentation
+from revocation import revocations, tokens_cli
+from activity import include_object, updates_cli
+from syncing import sync_cli
+
+# Blueprints by module and URL prefix, and each resource by module, class
+# and URL. create_app imports the modules, so importing this one stays
+# cheap for code that only needs the factory.
+BLUEPRINTS = (
+    ('blueprints.auth', 'auth_bp', '/auth'),
+    ('blueprints.items', 'items_bp', '/items'),
+    ('blueprints.supply_requests', 'supply_requests_bp', '/supply_requests'),
+    ('blueprints.stores', 'stores_bp', '/stores'),
+    ('blueprints.users', 'users_bp', '/users'),
+    ('blueprints.reports', 'reports_bp', '/reports'),
+    ('blueprints.updates', 'updates_bp', '/updates'),
+    ('blueprints.health', 'health_bp', '/health'),
+    ('blueprints.sync', 'sync_bp', '/sync'),
+)
+RESOURCES = (
+    ('blueprints.auth', 'RegisterUser', '/auth/register'),
+    ('blueprints.auth', 'LoginUser', '/auth/login'),
+    ('blueprints.auth', 'LogoutUser', '/auth/logout'),
+    ('blueprints.auth', 'RefreshToken', '/auth/refresh'),
+    ('blueprints.items', 'ItemEndpoint', '/items'),
+    ('blueprints.items', 'ItemEndpointById', '/items/<int:id>'),
+    ('blueprints.items', 'ItemBulkEndpoint', '/items/bulk'),
+    ('blueprints.items', 'ItemExport', '/items/export'),
+    ('blueprints.supply_requests', 'SupplyRequestEndpoint', '/supply_requests'),
+    ('blueprints.supply_requests', 'SupplyRequestEndpointById', '/supply_requests/<int:id>'),
+    ('blueprints.supply_requests', 'SupplyRequestBulkEndpoint', '/supply_requests/bulk'),
+    ('blueprints.supply_requests', 'SupplyRequestExport', '/supply_requests/export'),
+    ('blueprints.stores', 'StoreEndpoint', '/stores'),
+    ('blueprints.stores', 'StoreEndpointById', '/stores/<int:id>'),
+    ('blueprints.users', 'UserEndpoint', '/users'),
+    ('blueprints.users', 'UserEndpointById', '/users/<int:id>'),
+    ('blueprints.reports', 'WeeklyReport', '/reports/weekly'),
+    ('blueprints.reports', 'MonthlyReport', '/reports/monthly'),
+    ('blueprints.reports', 'AnnualReport', '/reports/annual'),
+    ('blueprints.updates', 'UpdateEndpoint', '/updates'),
+    ('blueprints.health', 'CacheStats', '/health/cache'),
+    ('blueprints.health', 'PoolStats', '/health/pool'),
+    ('blueprints.health', 'SlowQueries', '/health/queries'),
+    ('blueprints.health', 'Metrics', '/metrics'),
+    ('blueprints.sync', 'SyncEndpoint', '/sync'),
+)
+
+class JWTApi(Api):
+    # Flask-RESTful turns any exception raised in a resource into a 500 of
+    # its own; let token errors through to the JWTManager loaders below.
+    def handle_error(self, e):
+        if isinstance(e, (JWTExtendedException, PyJWTError)):
+            raise e
+        return super().handle_error(e)
+
+class MigrateCommand(click.Command):
+    # `flask db ...`, with Flask-Migrate (and Alembic, a good part of the
+    # app's import time) loaded only when it runs. Its arguments go to
+    # Flask-Migrate's own command group untouched.
+    def __init__(self):
+        super().__init__(
+            'db', help='Perform database migrations.', add_help_option=False,
+            context_settings={'ignore_unknown_options': True, 'allow_extra_args': True}
+        )
+
+    def invoke(self, ctx):
+        from flask_migrate import Migrate
+        app = ctx.ensure_object(ScriptInfo).load_app()
+        if 'migrate' not in app.extensions:
+            Migrate(app, db, include_object=include_object)
+        return app.cli.commands['db'].main(ctx.args, prog_name=ctx.command_path, obj=ctx.obj, standalone_mode=False)
+
+jwt = JWTManager()
+
+def create_app(config=Config):
+    # `config` is a config object or a mapping of settings. Nothing here
+    # touches the database: engines connect on first use. Everything else
+    # that can be done up front is, so that with `gunicorn --preload
+    # 'app:create_app()'` forked workers start with it done.
+    app = Flask(__name__)
+    if isinstance(config, dict):
+        app.config.from_object(Config)
+        app.config.update(config)
+    else:
+        app.config.from_object(config)
+    configure_engine(app)
+    replica_router.init_app(app, engine_options)
+    db.init_app(app)  # Initialize db with app
+    with app.app_context():
+        for engine in db.engines.values():
+            instrument_engine(engine, app.config)
+    # First, so its timings cover the other extensions' request hooks.
+    instrumentation.init_app(app)
+    jwt.init_app(app)
+    audit.init_app(app)
+    response_cache.init_app(app)
+    passwords.init_app(app)
+    revocations.init_app(app)
+    app.cli.add_command(MigrateCommand())
+    app.cli.add_command(rollups_cli)
+    app.cli.add_command(updates_cli)
+    app.cli.add_command(sync_cli)
+    app.cli.add_command(tokens_cli)
+
+    # Register Blueprints and Resources
+    api = JWTApi(app)
+    for module, name, prefix in BLUEPRINTS:
+        app.register_blueprint(getattr(importlib.import_module(module), name), url_prefix=prefix)
+    for module, name, url in RESOURCES:
+        api.add_resource(getattr(importlib.import_module(module), name), url)
+    # Otherwise the first query of every worker pays for this.
+    configure_mappers()
+    return app
 
 @jwt.unauthorized_loader
 def unauthorized_response(callback):
@@ -56,5 +141,13 @@ def invalid_token_response(callback):
 def expired_token_response(jwt_header, jwt_payload):
     return {"error": "Token has expired"}, 401
 
+@jwt.token_in_blocklist_loader
+def check_if_token_revoked(jwt_header, jwt_payload):
+    return revocations.is_revoked(jwt_payload)
+
+@jwt.revoked_token_loader
+def revoked_token_response(jwt_header, jwt_payload):
+    return {"error": "Token has been revoked"}, 401
+
 if __name__ == '__main__':
-    app.run(debug=True, port=4000)
\ No newline at end of file
+    create_app().run(debug=True, port=4000)
\ No newline at end of file
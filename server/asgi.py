@@ -0,0 +1,278 @@
+import asyncio
+import logging
+from datetime import datetime
+from functools import partial
+from asgiref.wsgi import WsgiToAsgi
+from flask import g, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from flask_jwt_extended.exceptions import JWTExtendedException
+from flask_restful.representations.json import output_json
+from jwt.exceptions import PyJWTError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from werkzeug.exceptions import HTTPException, InternalServerError
+from app import create_app
+from blueprints.auth import LOGIN_BUSY, LOGIN_FAILED, account_principal, account_query, login_tokens, rehash_statement
+from blueprints.items import item_page, item_page_query, parse_item_fields
+from blueprints.reports import AnnualReport, MonthlyReport, WeeklyReport
+from blueprints.supply_requests import supply_request_list, supply_request_list_query
+from cache import own_tags, response_cache
+from dbpool import async_engine_options, instrument_engine
+from pagination import InvalidCursor, decode_cursor, parse_limit
+from passwords import PasswordBusy, passwords
+from principal import build_scope_claims, claimed_principal, store_ids_query
+from reporting import parse_report_args, report_body, report_items_query, report_totals_query
+from scoping import check_account
+
+log = logging.getLogger(__name__)
+
+
+class Fallback(Exception):
+    # The request is left to the Flask app, which answers it as it always
+    # has.
+    pass
+
+
+class AsyncAPI:
+    # ASGI entry point: `uvicorn asgi:application`.
+    #
+    # The read-heavy endpoints and login (GET /items, GET /supply_requests,
+    # GET /reports/*, POST /auth/login) are served here on the event loop,
+    # with their queries on an async engine (asyncpg, or aiosqlite for
+    # SQLite), so a slow report or a login waiting on the password pool no
+    # longer holds a worker thread. Each one runs inside a Flask request
+    # context built from the ASGI scope and reuses the blueprints' query
+    # builders, serialisers, response cache and error bodies, so routes,
+    # status codes and JSON are the same as under WSGI.
+    #
+    # Everything else, writes included (they go through the audit log,
+    # rollups and cache invalidation on the sync session), is handed to the
+    # Flask app through asgiref's WSGI adapter, which runs it on a thread.
+    # So are tokens without scope claims (their principal comes from the
+    # sync session) and any request that fails unexpectedly before its
+    # handler has done work a retry would repeat, whose error response is
+    # then Flask-RESTful's own. Past that point (a login once it starts on
+    # the password check) failures are answered here, in the same shape.
+    #
+    # Async reads go to the primary; replica routing (routing.py) applies
+    # to the WSGI path only.
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        url, options = async_engine_options(flask_app.config)
+        self.engine = create_async_engine(url, **options)
+        instrument_engine(self.engine.sync_engine, flask_app.config)
+        self.sessions = async_sessionmaker(self.engine, expire_on_commit=False)
+        self.routes = {
+            ('GET', '/items'): self.items,
+            ('GET', '/supply_requests'): self.supply_requests,
+            ('GET', '/reports/weekly'): partial(self.report, WeeklyReport.period),
+            ('GET', '/reports/monthly'): partial(self.report, MonthlyReport.period),
+            ('GET', '/reports/annual'): partial(self.report, AnnualReport.period),
+            ('POST', '/auth/login'): self.login,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        handler = self.routes.get((scope['method'], scope['path'])) if scope['type'] == 'http' else None
+        if handler is None:
+            return await self.wsgi(scope, receive, send)
+
+        body = await read_body(receive)
+        try:
+            response = await self.handle(handler, scope, body)
+        except Fallback:
+            return await self.wsgi(scope, replay(body, receive), send)
+        await send_response(send, response)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle(self, handler, scope, body):
+        flask_app = self.flask_app
+        with flask_app.test_request_context(
+            path=scope['path'],
+            method=scope['method'],
+            query_string=scope.get('query_string', b'').decode('latin-1'),
+            headers=[(k.decode('latin-1'), v.decode('latin-1')) for k, v in scope['headers']],
+            data=body,
+            # myduka.async tells instrumentation.py not to profile: this
+            # request's hooks and handler run on different threads.
+            environ_base={'REMOTE_ADDR': (scope.get('client') or ('', 0))[0], 'myduka.async': True},
+        ):
+            try:
+                # before_request hooks (the first revocation load, the audit writer)
+                # may touch the database, so they run off the loop.
+                result = await asyncio.to_thread(flask_app.preprocess_request)
+                if result is None:
+                    result = await handler()
+            except (JWTExtendedException, PyJWTError) as e:
+                # The JWTManager loaders in app.py, as under WSGI.
+                result = flask_app.make_response(flask_app.handle_user_exception(e))
+            except Fallback:
+                raise
+            except Exception as e:
+                if not g.get('_no_fallback'):
+                    if not isinstance(e, HTTPException):
+                        log.exception('Async handler failed for %s %s; retrying through WSGI',
+                                      scope['method'], scope['path'])
+                    raise Fallback()
+                if isinstance(e, HTTPException):
+                    code, message = e.code, e.description
+                else:
+                    log.exception('Async handler failed for %s %s', scope['method'], scope['path'])
+                    code, message = 500, InternalServerError.description
+                result = output_json({"message": message}, code)
+            if isinstance(result, tuple):
+                # Resource results, serialised as Flask-RESTful does.
+                data, code, headers = (result + ({},))[:3]
+                result = output_json(data, code, headers)
+            return flask_app.process_response(flask_app.make_response(result))
+
+    def no_fallback(self):
+        # From here on the request is answered here even if it fails: the
+        # WSGI retry would run its hooks and the handler's work again.
+        g._no_fallback = True
+
+    def identity(self):
+        verify_jwt_in_request()
+        identity = get_jwt_identity()
+        if claimed_principal(identity) is None:
+            raise Fallback()
+        return identity
+
+    async def cached(self, tags, store, view):
+        # response_cache.cached / .conditional for an async view.
+        # Both read the cache backend and the versions table, so they run
+        # off the loop.
+        response, entry = await asyncio.to_thread(response_cache.lookup, tags, store)
+        if response is not None:
+            return response
+        result = await view()
+        return await asyncio.to_thread(response_cache.complete, entry, result) if entry else result
+
+    async def fetch(self, *statements):
+        async with self.sessions() as session:
+            return [(await session.execute(statement)).all() for statement in statements]
+
+    async def items(self):
+        current_user = self.identity()
+
+        async def view():
+            error = check_account(current_user)
+            if error:
+                return error
+            try:
+                fields = parse_item_fields(request.args)
+                cursor = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+            except InvalidCursor:
+                return {"error": "Invalid cursor"}, 400
+            except ValueError as e:
+                return {"error": str(e)}, 400
+
+            limit = parse_limit(request.args)
+            rows, = await self.fetch(item_page_query(current_user, fields, cursor, limit))
+            return item_page(rows, fields, limit), 200
+        return await self.cached(own_tags('items'), False, view)
+
+    async def supply_requests(self):
+        current_user = self.identity()
+
+        async def view():
+            error = check_account(current_user)
+            if error:
+                return error
+            rows, = await self.fetch(supply_request_list_query(current_user))
+            return supply_request_list(rows), 200
+        return await self.cached(own_tags('supply_requests'), False, view)
+
+    async def report(self, period):
+        current_user = self.identity()
+
+        async def view():
+            error = check_account(current_user)
+            if error:
+                return error
+            start_day = (datetime.utcnow() - period).date()
+            include_items, page, per_page = parse_report_args(request.args)
+            statements = [report_totals_query(current_user, start_day)]
+            if include_items:
+                statements.append(report_items_query(current_user, start_day, page, per_page))
+            results = await self.fetch(*statements)
+            return report_body(results[0][0], results[1] if include_items else None, page, per_page), 200
+        return await self.cached(own_tags('items'), True, view)
+
+    async def login(self):
+        data = request.get_json()
+        email = data.get('email')
+        password = data.get('password')
+
+        if not isinstance(password, str):
+            return LOGIN_FAILED
+
+        async with self.sessions() as session:
+            user = (await session.execute(account_query(email))).first()
+            self.no_fallback()
+            try:
+                if not user:
+                    await passwords.dummy_verify_async(password)
+                    return LOGIN_FAILED
+                ok, needs_rehash = await passwords.verify_async(password, user.password)
+                if not ok:
+                    return LOGIN_FAILED
+                if not user.is_active:
+                    return {"error": "Account is deactivated"}, 403
+                if needs_rehash:
+                    await self.rehash(session, user, password)
+            except PasswordBusy:
+                return LOGIN_BUSY
+            store_ids = (await session.scalars(store_ids_query(user.id))).all() if user.role == 'merchants' else None
+        return login_tokens(user, build_scope_claims(account_principal(user), store_ids)), 200
+
+    async def rehash(self, session, user, password):
+        # As rehash_password: best effort, the next login retries.
+        try:
+            await session.execute(rehash_statement(user, await passwords.hash_async(password)))
+            await session.commit()
+        except PasswordBusy:
+            pass
+        except Exception:
+            await session.rollback()
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+def replay(body, receive):
+    # A receive callable that hands the already-read body to the WSGI
+    # adapter, then defers to the server's (for the disconnect).
+    pending = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+    async def receive_again():
+        if pending:
+            return pending.pop()
+        return await receive()
+    return receive_again
+
+
+async def send_response(send, response):
+    body = response.get_data()
+    headers = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in response.headers.items()]
+    await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+application = AsyncAPI(create_app())
@@ -0,0 +1,360 @@
+import atexit
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from datetime import datetime
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from models import Update, db
+from staging import TransactionStage
+
+log = logging.getLogger(__name__)
+
+AUDIT_FIELDS = ('action', 'description', 'merchant_id', 'admin_id', 'clerk_id', 'item_id', 'supply_request_id')
+
+# Spool segments are named after the process that wrote them: the open one
+# is live-<pid>.jsonl, sealed ones are <time_ns>-<pid>.jsonl so that sorting
+# by name replays them oldest first.
+SEGMENT_NAME = re.compile(r'^(live|\d+)-(\d+)\.jsonl$')
+REJECTED_NAME = 'rejected.jsonl'
+
+audit_cli = AppGroup('audit')
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _to_row(event):
+    row = {f: event.get(f) for f in AUDIT_FIELDS}
+    row['created_at'] = datetime.fromisoformat(event['created_at'])
+    return row
+
+
+class AuditLog:
+    # Handlers call audit.record(...) where they used to add an Update to the
+    # session. The event is held on the session and only handed on once the
+    # request transaction commits (dropped on rollback). With AUDIT_ASYNC
+    # off it is simply an Update row in the same transaction.
+    #
+    # In async mode a transaction's events are appended to this process's
+    # spool file (and fsynced, with AUDIT_SPOOL_FSYNC) just before it
+    # commits, each tagged with a transaction id; if the spool cannot be
+    # written they are inserted as Update rows in the transaction instead,
+    # so a full disk never fails the request or loses its events. Once the
+    # commit succeeds the events join an in-memory batch; if it fails, a
+    # cancel record for the transaction id follows them in the spool. A
+    # background thread inserts the batch every AUDIT_FLUSH_INTERVAL
+    # seconds, or sooner once AUDIT_BATCH_SIZE events are waiting, and
+    # deletes the spool segment once the rows are committed. Segments left
+    # behind by a crash or a failed flush are replayed on the next flush, so
+    # delivery is at least once.
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pending = []
+        # Transaction id -> (spooled lines, events) between a transaction's
+        # before_commit and its end.
+        self._inflight = {}
+        self._spool = None
+        self._pid = None
+        self._atexit = False
+        self._events = TransactionStage('audit_events', self._spool_events, self._committed, self._rolled_back)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('AUDIT_ASYNC', True)
+        app.config.setdefault('AUDIT_BATCH_SIZE', 500)
+        app.config.setdefault('AUDIT_FLUSH_INTERVAL', 1.0)
+        app.config.setdefault('AUDIT_SPOOL_DIR', None)
+        app.config.setdefault('AUDIT_SPOOL_FSYNC', True)
+        if self._pid == os.getpid():
+            # Already writing for another app in this process.
+            self._stop()
+        self.app = app
+        self.async_writes = app.config['AUDIT_ASYNC']
+        self.batch_size = app.config['AUDIT_BATCH_SIZE']
+        self.interval = app.config['AUDIT_FLUSH_INTERVAL']
+        self.fsync = app.config['AUDIT_SPOOL_FSYNC']
+        self.spool_dir = app.config['AUDIT_SPOOL_DIR'] or os.path.join(app.instance_path, 'audit-spool')
+        app.extensions['audit'] = self
+        app.cli.add_command(audit_cli)
+        if self.async_writes:
+            app.before_request(self._ensure_started)
+        if self.async_writes and not self._atexit:
+            atexit.register(self.close)
+            self._atexit = True
+
+    def record(self, action, description, **owners):
+        fields = dict(owners, action=action, description=description)
+        if not self.async_writes:
+            db.session.add(Update(**fields))
+            return
+        fields['created_at'] = datetime.utcnow().isoformat()
+        self._events.add(fields)
+
+    def record_many(self, events):
+        if not self.async_writes:
+            db.session.execute(insert(Update), [{f: e.get(f) for f in AUDIT_FIELDS} for e in events])
+            return
+        now = datetime.utcnow().isoformat()
+        self._events.extend(dict(e, created_at=now) for e in events)
+
+    def _spool_events(self, session, events):
+        # Flush first, so that what can still fail after the events are
+        # spooled is the COMMIT itself.
+        session.flush()
+        txn = uuid.uuid4().hex
+        data = ''.join(json.dumps(dict(e, txn=txn)) + '\n' for e in events).encode()
+        try:
+            with self._lock:
+                self._start()
+                self._append(data)
+                self._inflight[txn] = (data, events)
+        except Exception:
+            log.exception('Could not spool audit events; writing them in the transaction')
+            session.execute(insert(Update), [_to_row(e) for e in events])
+            return None
+        return txn
+
+    def _committed(self, txn):
+        with self._lock:
+            entry = self._inflight.pop(txn, None)
+            if entry:
+                self._pending.extend(entry[1])
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wake.set()
+
+    def _rolled_back(self, txn):
+        # Including a COMMIT that failed after the events were spooled.
+        with self._lock:
+            if self._inflight.pop(txn, None) is None:
+                return
+            try:
+                self._append(json.dumps({'cancel': txn}).encode() + b'\n')
+            except Exception:
+                log.exception('Could not spool audit cancellation; a replay of %s would still insert it', txn)
+
+    def _append(self, data):
+        # Runs under self._lock. A failed write is cut back off, so a torn
+        # record is never replayed.
+        position = self._spool.tell()
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[self._spool.write(view):]
+            if self.fsync:
+                os.fsync(self._spool.fileno())
+        except Exception:
+            try:
+                self._spool.truncate(position)
+            except OSError:
+                pass
+            raise
+
+    def _ensure_started(self):
+        # Starting with the first request rather than the first event means
+        # spool segments left by a previous run are replayed straight away.
+        if self._pid != os.getpid():
+            with self._lock:
+                self._start()
+
+    def _start(self):
+        # Runs under self._lock on the first event in a process, including a
+        # freshly forked worker, which inherits neither the thread nor a spool
+        # file it may append to.
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        os.makedirs(self.spool_dir, exist_ok=True)
+        live = self._live_path(pid)
+        if os.path.exists(live):
+            # Left by an earlier process with the same pid; seal it so it is
+            # replayed from disk.
+            os.rename(live, self._segment_path(pid))
+        self._pid = pid
+        self._pending = []
+        self._inflight = {}
+        self._spool = open(live, 'ab', buffering=0)
+        threading.Thread(target=self._run, name='audit-flush', daemon=True).start()
+
+    def _live_path(self, pid):
+        return os.path.join(self.spool_dir, f'live-{pid}.jsonl')
+
+    def _segment_path(self, pid):
+        return os.path.join(self.spool_dir, f'{time.time_ns():020d}-{pid}.jsonl')
+
+    def _seal(self):
+        # Runs under self._lock. Transactions spooled but not yet ended are
+        # copied to the new live file and marked as moved in the sealed one,
+        # whose batch is only what has committed.
+        if self._pid != os.getpid() or not self._pending:
+            return None
+        path = self._segment_path(self._pid)
+        os.rename(self._live_path(self._pid), path)
+        sealed, self._spool = self._spool, open(self._live_path(self._pid), 'ab', buffering=0)
+        batch, self._pending = self._pending, []
+        try:
+            if self._inflight:
+                self._append(b''.join(data for data, _ in self._inflight.values()))
+                sealed.write(json.dumps({'moved': list(self._inflight)}).encode() + b'\n')
+                if self.fsync:
+                    os.fsync(sealed.fileno())
+        except Exception:
+            log.exception('Could not carry uncommitted audit events over to the new spool segment')
+        finally:
+            sealed.close()
+        return path, batch
+
+    def _run(self):
+        # Until the process forks or init_app switches to another app.
+        pid, app = os.getpid(), self.app
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._pid != pid or self.app is not app:
+                return
+            try:
+                self.flush()
+            except Exception:
+                log.exception('Audit flush failed; events stay in %s', self.spool_dir)
+
+    def _leftovers(self, skip=None):
+        # Sealed segments from this process that failed to flush, plus every
+        # segment (live or sealed) of processes that are gone. A dead
+        # process's files are claimed by renaming them to our pid; if another
+        # worker renames first, ours fails and we leave the file to it.
+        if not os.path.isdir(self.spool_dir):
+            return
+        pid = os.getpid()
+        for name in sorted(os.listdir(self.spool_dir)):
+            match = SEGMENT_NAME.match(name)
+            path = os.path.join(self.spool_dir, name)
+            if not match or path == skip:
+                continue
+            owner = int(match.group(2))
+            if owner == pid:
+                if match.group(1) == 'live':
+                    continue
+            elif _pid_alive(owner):
+                continue
+            else:
+                claimed = self._segment_path(pid)
+                try:
+                    os.rename(path, claimed)
+                except FileNotFoundError:
+                    continue
+                path = claimed
+            yield path
+
+    def _read(self, path):
+        # The segment's events, less those of transactions it records as
+        # rolled back or moved on to a later segment.
+        records = []
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # A torn last line from a crash mid-write.
+                    log.warning('Skipping unreadable audit line in %s', path)
+        skip = set()
+        for record in records:
+            if 'cancel' in record:
+                skip.add(record['cancel'])
+            elif 'moved' in record:
+                skip.update(record['moved'])
+        return [r for r in records if 'action' in r and r.get('txn') not in skip]
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                sealed = self._seal()
+            with self.app.app_context():
+                for path in list(self._leftovers(skip=sealed and sealed[0])):
+                    self._write_segment(path, self._read(path))
+                if sealed:
+                    self._write_segment(*sealed)
+
+    def _write_segment(self, path, events):
+        if events:
+            try:
+                db.session.execute(insert(Update), [_to_row(e) for e in events])
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                self._write_one_by_one(events)
+            except Exception:
+                db.session.rollback()
+                raise
+        os.remove(path)
+
+    def _write_one_by_one(self, events):
+        # Something in the batch no longer fits: usually an item or supply
+        # request deleted before its event was flushed. Keep the event
+        # without the dangling reference; set aside anything still rejected.
+        for e in events:
+            for row in (_to_row(e), dict(_to_row(e), item_id=None, supply_request_id=None)):
+                try:
+                    db.session.execute(insert(Update), [row])
+                    db.session.commit()
+                    break
+                except IntegrityError:
+                    db.session.rollback()
+            else:
+                log.error('Audit event rejected: %s', e)
+                with open(os.path.join(self.spool_dir, REJECTED_NAME), 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(e) + '\n')
+
+    def _stop(self):
+        # Hands what this process has batched to the current app's database
+        # and seals the live file, so that whatever is left in it (events of
+        # transactions still in flight) is replayed from its spool directory
+        # later. The flush thread exits at its next wake; the next event
+        # starts over under the app being set up.
+        self.close()
+        with self._flush_lock, self._lock:
+            self._spool.close()
+            live = self._live_path(self._pid)
+            try:
+                if os.path.getsize(live):
+                    os.rename(live, self._segment_path(self._pid))
+                else:
+                    os.remove(live)
+            except OSError:
+                log.exception('Could not seal audit spool in %s', self.spool_dir)
+            self._pid = None
+        self._wake.set()
+
+    def close(self):
+        try:
+            self.flush()
+        except Exception:
+            log.exception('Audit flush at exit failed; events stay in %s', self.spool_dir)
+
+
+audit = AuditLog()
+
+
+@audit_cli.command('flush')
+def flush_command():
+    """Insert spooled audit events left by stopped workers."""
+    current_app.extensions['audit'].flush()
+    click.echo('Audit spool flushed.')
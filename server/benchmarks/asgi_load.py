@@ -0,0 +1,240 @@
+"""Load-test the hot endpoints under WSGI and under ASGI (asgi.py).
+
+Seeds a synthetic dataset, starts one worker of each server on it (gunicorn
+with threads for the Flask app, uvicorn for asgi:application), checks both
+return the same status and JSON for every scenario, then drives GET /items,
+GET /supply_requests, GET /reports/annual and POST /auth/login from a
+number of keep-alive connections and reports requests per second and
+latency percentiles for each.
+
+    cd server && python -m benchmarks.asgi_load --items 20000 --concurrency 1,16,64
+
+The response cache and the password verification cache are turned off in
+both servers so every request reaches the database (or the KDF). Pass
+--wsgi-url / --asgi-url to measure servers started some other way instead;
+they must use the same database, and --skip-seed leaves it as it is.
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlsplit
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WSGI_CMD = "gunicorn --workers 1 --threads 8 --bind 127.0.0.1:{port} 'app:create_app()'"
+ASGI_CMD = 'uvicorn asgi:application --workers 1 --port {port} --no-access-log --log-level warning'
+
+
+class Connection:
+    # A minimal HTTP/1.1 client connection, kept alive between requests.
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.reader = self.writer = None
+
+    async def request(self, method, path, headers=None, body=b''):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {self.host}:{self.port}', f'Content-Length: {len(body)}']
+        lines += [f'{k}: {v}' for k, v in (headers or {}).items()]
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+        await self.writer.drain()
+
+        status = int((await self.reader.readline()).split()[1])
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+        if 'content-length' in response_headers:
+            data = await self.reader.readexactly(int(response_headers['content-length']))
+        elif response_headers.get('transfer-encoding') == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).strip(), 16)
+                chunks.append(await self.reader.readexactly(size + 2))
+                if size == 0:
+                    break
+            data = b''.join(c[:-2] for c in chunks)
+        else:
+            data = await self.reader.read()
+            response_headers['connection'] = 'close'
+        if response_headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status, data
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+def scenarios(tokens, clerk_email):
+    login = json.dumps({'email': clerk_email, 'password': 'bench'}).encode()
+    return [
+        ('GET /items (admin)', 'GET', '/items?limit=50', tokens['admins'], b''),
+        ('GET /supply_requests (clerk)', 'GET', '/supply_requests', tokens['clerks'], b''),
+        ('GET /reports/annual (merchant)', 'GET', '/reports/annual?per_page=50', tokens['merchants'], b''),
+        ('POST /auth/login (clerk)', 'POST', '/auth/login', {'Content-Type': 'application/json'}, login),
+    ]
+
+
+async def drive(url, method, path, headers, body, requests, concurrency):
+    latencies, statuses = [], {}
+    per_connection = [requests // concurrency + (n < requests % concurrency) for n in range(concurrency)]
+
+    async def worker(count):
+        connection = Connection(url)
+        try:
+            for _ in range(count):
+                start = time.perf_counter()
+                status, _ = await connection.request(method, path, headers, body)
+                latencies.append(time.perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+        finally:
+            connection.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(count) for count in per_connection if count])
+    return time.perf_counter() - start, latencies, statuses
+
+
+def normalised(data):
+    # Tokens differ on every login; everything else must match.
+    try:
+        body = json.loads(data)
+    except ValueError:
+        return data
+    if isinstance(body, dict):
+        for key in ('access_token', 'refresh_token'):
+            if key in body:
+                body[key] = '<token>'
+    return body
+
+
+async def compare(targets, cases):
+    same = True
+    for name, method, path, headers, body in cases:
+        results = []
+        for url in targets.values():
+            connection = Connection(url)
+            try:
+                status, data = await connection.request(method, path, headers, body)
+            finally:
+                connection.close()
+            results.append((status, normalised(data)))
+        if any(r != results[0] for r in results[1:]):
+            same = False
+            print(f'MISMATCH {name}: ' + '; '.join(f'{t} {r[0]}' for t, r in zip(targets, results)))
+    return same
+
+
+def start_server(command, port, env):
+    process = subprocess.Popen(shlex.split(command.format(port=port)), cwd=SERVER_DIR, env=env)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{command} exited with {process.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f'{command} did not start listening on {port}')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=20000)
+    parser.add_argument('--requests', type=int, default=400, help='Requests per scenario and concurrency.')
+    parser.add_argument('--logins', type=int, default=40, help='Requests per concurrency for POST /auth/login.')
+    parser.add_argument('--concurrency', default='1,16,64', help='Comma-separated open connections.')
+    parser.add_argument('--wsgi-url')
+    parser.add_argument('--asgi-url')
+    parser.add_argument('--wsgi-cmd', default=WSGI_CMD)
+    parser.add_argument('--asgi-cmd', default=ASGI_CMD)
+    parser.add_argument('--skip-seed', action='store_true')
+    args = parser.parse_args(argv)
+    concurrencies = [int(c) for c in args.concurrency.split(',')]
+
+    if not os.environ.get('DATABASE_URL'):
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'asgi_load.db')
+    os.environ.setdefault('AUDIT_SPOOL_DIR', tempfile.mkdtemp())
+    env = dict(os.environ, CACHE_BACKEND='none', PASSWORD_CACHE_TTL='0')
+
+    from app import create_app
+    from flask_jwt_extended import create_access_token
+    from models import Admin, Clerk, Merchant, Store, Item, SupplyRequest, Update, db
+    from principal import query_principal, scope_claims
+    from benchmarks.query_plans import seed
+    app = create_app()
+
+    with app.app_context():
+        if not args.skip_seed:
+            seed(db, (Merchant, Admin, Clerk, Store, Item, SupplyRequest, Update),
+                 merchants=10, stores=50, clerks=200, items=args.items)
+        merchant_id, admin_id, clerk_id = db.session.execute(
+            db.select(Store.merchant_id, Clerk.admin_id, Clerk.id).join(Store, Store.id == Clerk.store_id)
+            .order_by(Clerk.id).limit(1)
+        ).one()
+        clerk_email = db.session.get(Clerk, clerk_id).email
+        tokens = {}
+        for role, user_id in (('merchants', merchant_id), ('admins', admin_id), ('clerks', clerk_id)):
+            token = create_access_token(
+                identity={'id': user_id, 'role': role},
+                additional_claims={'scope': scope_claims(query_principal(role, user_id))}
+            )
+            tokens[role] = {'Authorization': f'Bearer {token}'}
+
+    processes = []
+    targets = {}
+    try:
+        for name, url, command in (('wsgi', args.wsgi_url, args.wsgi_cmd), ('asgi', args.asgi_url, args.asgi_cmd)):
+            if url is None:
+                port = free_port()
+                processes.append(start_server(command, port, env))
+                url = f'http://127.0.0.1:{port}'
+            targets[name] = url
+
+        cases = scenarios(tokens, clerk_email)
+        if not asyncio.run(compare(targets, cases)):
+            print('Responses differ between the servers')
+            return 1
+        print(f'{"scenario":<32} {"server":<6} {"conns":>5} {"req/s":>9} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9}  statuses')
+        for name, method, path, headers, body in cases:
+            requests = args.logins if method == 'POST' else args.requests
+            for concurrency in concurrencies:
+                for target, url in targets.items():
+                    elapsed, latencies, statuses = asyncio.run(
+                        drive(url, method, path, headers, body, requests, concurrency)
+                    )
+                    ms = sorted(s * 1000 for s in latencies)
+                    pick = lambda q: ms[min(int(len(ms) * q), len(ms) - 1)]
+                    print(f'{name:<32} {target:<6} {concurrency:>5} {len(ms) / elapsed:>9.1f} '
+                          f'{pick(0.5):>9.2f} {pick(0.95):>9.2f} {pick(0.99):>9.2f}  {statuses}')
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,173 @@
+"""Regression check for ETags and 304s across workers and over time.
+
+Seeds the demo data and starts gunicorn with two workers and a one second
+CACHE_TTL and CACHE_VERSION_TTL on the local (per worker) cache backend.
+Then, as the seeded clerk, for each conditional endpoint:
+
+  - fetches it --requests times, each on a new connection so both workers
+    answer, and checks every response carries the same ETag;
+  - waits past CACHE_TTL and checks If-None-Match with that ETag is still
+    answered 304 every time;
+  - after a write the endpoint depends on (an item added or updated, a
+    supply request raised) and CACHE_VERSION_TTL, checks the old ETag gets
+    200 and a new ETag, which every worker then answers with 304.
+
+Then, with INSTRUMENTATION on, measures what a mobile client's poll costs:
+--polls requests to /items with If-None-Match and to /items/1 (a stored
+response), with the cache off (the baseline), with CACHE_VERSION_TTL=0
+(every request reads cache_versions on the primary) and as configured
+above, reporting queries and database time per request from the
+Server-Timing header.
+
+Exits non-zero if any check fails.
+
+    cd server && python -m benchmarks.conditional
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file.
+"""
+import argparse
+import http.client
+import json
+import os
+import re
+import statistics
+import sys
+import tempfile
+import time
+from benchmarks.asgi_load import free_port, start_server
+
+CMD = "gunicorn --workers 2 --bind 127.0.0.1:{port} 'app:create_app()'"
+TTL = 1
+VERSION_TTL = 1
+SERVER_TIMING = re.compile(r'total;dur=([\d.]+), db;dur=([\d.]+);desc="(\d+) queries"')
+
+
+def call(port, method, path, headers=None, body=None, timings=None):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    headers = dict(headers or {})
+    if body is not None:
+        headers['Content-Type'] = 'application/json'
+        body = json.dumps(body)
+    try:
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        data = response.read()
+        if timings is not None:
+            timings.append((response.status, response.getheader('Server-Timing')))
+        return response.status, response.getheader('ETag'), json.loads(data) if data else None
+    finally:
+        connection.close()
+
+
+def check(port, auth, path, requests, write):
+    failures = []
+    etags = {call(port, 'GET', path, auth)[1] for _ in range(requests)}
+    if len(etags) != 1 or None in etags:
+        return [f'{path}: expected one ETag, got {etags}']
+    etag, = etags
+
+    time.sleep(TTL + 0.5)
+    statuses = [call(port, 'GET', path, dict(auth, **{'If-None-Match': etag}))[0] for _ in range(requests)]
+    if set(statuses) != {304}:
+        failures.append(f'{path}: If-None-Match after CACHE_TTL answered {statuses}, expected only 304')
+
+    write()
+    time.sleep(VERSION_TTL + 0.5)
+    status, new_etag, _ = call(port, 'GET', path, dict(auth, **{'If-None-Match': etag}))
+    if status != 200 or new_etag == etag:
+        failures.append(f'{path}: after a write got {status} with ETag {new_etag}, expected 200 and a new ETag')
+    statuses = [call(port, 'GET', path, dict(auth, **{'If-None-Match': new_etag}))[0] for _ in range(requests)]
+    if set(statuses) != {304}:
+        failures.append(f'{path}: new ETag answered {statuses}, expected only 304')
+    return failures
+
+
+def login(port):
+    status, _, body = call(port, 'POST', '/auth/login', body={'email': 'clerk@example.com', 'password': 'clerk123'})
+    return status == 200 and {'Authorization': f"Bearer {body['access_token']}"}
+
+
+def measure(env, polls):
+    # One row per route: statuses, then mean queries, mean database ms and
+    # median total ms per request.
+    port = free_port()
+    process = start_server(CMD, port, dict(env, INSTRUMENTATION='1'))
+    try:
+        auth = login(port)
+        rows = []
+        for path in ('/items', '/items/1'):
+            _, etag, _ = call(port, 'GET', path, auth)
+            headers = dict(auth, **{'If-None-Match': etag}) if path == '/items' and etag else auth
+            timings = []
+            for _ in range(polls):
+                call(port, 'GET', path, headers, timings=timings)
+            parsed = [SERVER_TIMING.match(t).groups() for _, t in timings]
+            statuses = {}
+            for status, _ in timings:
+                statuses[status] = statuses.get(status, 0) + 1
+            rows.append((path, statuses, statistics.mean(int(q) for _, _, q in parsed),
+                         statistics.mean(float(d) for _, d, _ in parsed),
+                         statistics.median(float(t) for t, _, _ in parsed)))
+        return rows
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=10, help='Requests per check, each on a new connection.')
+    parser.add_argument('--polls', type=int, default=200, help='Requests per route when measuring.')
+    args = parser.parse_args(argv)
+
+    if not os.environ.get('DATABASE_URL'):
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'conditional.db')
+    os.environ.setdefault('AUDIT_SPOOL_DIR', tempfile.mkdtemp())
+    env = dict(os.environ, CACHE_BACKEND='local', CACHE_TTL=str(TTL), CACHE_VERSION_TTL=str(VERSION_TTL))
+
+    from seed import seed_database
+    seed_database()
+
+    port = free_port()
+    process = start_server(CMD, port, env)
+    try:
+        auth = login(port)
+        if not auth:
+            print('Clerk login failed')
+            return 1
+        item = {'name': 'Check item', 'quantity_received': 5, 'buying_price': 10.0, 'selling_price': 12.0}
+
+        def add_item():
+            call(port, 'POST', '/items', auth, item)
+
+        def update_item():
+            call(port, 'PUT', '/items/1', auth, {'quantity_spoilt': 6})
+
+        def raise_supply_request():
+            call(port, 'POST', '/supply_requests', auth, {'item_id': 1, 'quantity': 5})
+
+        failures = []
+        for path, write in (('/items', add_item), ('/reports/weekly', add_item), ('/items/1', update_item),
+                            ('/supply_requests', raise_supply_request)):
+            found = check(port, auth, path, args.requests, write)
+            print(f'{path}: {"FAILED" if found else "ok"}')
+            failures += found
+    finally:
+        process.terminate()
+        process.wait()
+
+    # A long CACHE_TTL, so the stored /items/1 stays a hit throughout.
+    print(f'{"cache":<28} {"route":<10} {"statuses":<16} {"queries":>8} {"db ms":>7} {"p50 ms":>7}')
+    for label, overrides in (('off (baseline)', {'CACHE_BACKEND': 'none'}),
+                             ('CACHE_VERSION_TTL=0', {'CACHE_TTL': '300', 'CACHE_VERSION_TTL': '0'}),
+                             (f'CACHE_VERSION_TTL={VERSION_TTL}', {'CACHE_TTL': '300'})):
+        for path, statuses, queries, db_ms, total_ms in measure(dict(env, **overrides), args.polls):
+            print(f'{label:<28} {path:<10} {json.dumps(statuses):<16} {queries:>8.2f} {db_ms:>7.2f} {total_ms:>7.2f}')
+
+    for failure in failures:
+        print(failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,480 @@
+"""Load-test every route with a realistic mix of merchants, admins and clerks.
+
+Generates a dataset with seed.generate_data, starts a gunicorn worker on it
+and runs --concurrency simulated users, each on its own keep-alive
+connection, for --duration seconds after a --warmup. For every action a
+user picks a role by --mix, an account of that role, and an action by the
+role's weights in ACTIONS: mostly the list, detail and report reads each
+role makes all day, with writes (items, supply requests and their
+decisions, stores, users), logins, token refreshes, logouts, syncs and
+exports mixed in. The script reports throughput and p50/p95/p99 latency
+per route, and any of the app's routes the run never reached.
+
+    cd server && python -m benchmarks.load --merchants 10 --items-per-store 2000 --concurrency 16 --duration 60
+
+The same --seed generates the same data and gives each user the same
+sequence of actions, so runs can be compared (timing aside). --json writes
+the results to a file for that. --url measures a server started some other
+way on the same database (--skip-seed keeps that database as it is), and
+--cmd starts a different server, e.g. benchmarks.asgi_load.ASGI_CMD.
+
+Uses DATABASE_URL when set (PostgreSQL or SQLite), otherwise a throwaway
+SQLite file.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from functools import partial
+from urllib.parse import quote
+from benchmarks.asgi_load import WSGI_CMD, Connection, free_port, start_server
+
+ROLE_MIX = 'clerks=70,admins=25,merchants=5'
+# Ids of each kind loaded per simulated account.
+SAMPLE_IDS = 200
+
+
+class User:
+    # A seeded account, its tokens and the ids it may act on.
+    def __init__(self, role, id, email, tokens, **ids):
+        self.role = role
+        self.id = id
+        self.email = email
+        self.token = tokens['access_token']
+        self.refresh_token = tokens['refresh_token']
+        self.ids = ids
+        self.created_stores = []
+        self.created_users = []
+        self.sync_token = None
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+
+    def record(self, route, seconds, status):
+        self.latencies.setdefault(route, []).append(seconds)
+        statuses = self.statuses.setdefault(route, {})
+        statuses[status] = statuses.get(status, 0) + 1
+
+
+class Client:
+    # A keep-alive connection that times each request under its route.
+    def __init__(self, url, stats):
+        self.connection = Connection(url)
+        self.stats = stats
+        self.recording = False
+
+    async def call(self, method, route, path=None, token=None, body=None):
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        data = b''
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+            data = json.dumps(body).encode()
+        start = time.perf_counter()
+        status, response = await self.connection.request(method, path or route, headers, data)
+        if self.recording:
+            self.stats.record(f'{method} {route}', time.perf_counter() - start, status)
+        try:
+            return status, json.loads(response)
+        except ValueError:
+            return status, None
+
+
+# Actions. Each takes the client, the user, the user's random generator and
+# the run's shared state, and returns False when it has nothing to act on
+# (the simulation then picks again).
+
+async def list_items(c, u, rng, shared):
+    status, body = await c.call('GET', '/items', '/items?limit=50', u.token)
+    if status == 200 and body['next_cursor'] and rng.random() < 0.3:
+        await c.call('GET', '/items', f"/items?limit=50&cursor={quote(body['next_cursor'])}", u.token)
+
+
+async def get_item(c, u, rng, shared):
+    if not u.ids['items']:
+        return False
+    await c.call('GET', '/items/<id>', f"/items/{rng.choice(u.ids['items'])}", u.token)
+
+
+def new_item(rng):
+    price = round(rng.uniform(10, 500), 2)
+    return {'name': f'Load item {rng.randrange(10 ** 6)}', 'quantity_received': rng.randint(1, 300),
+            'buying_price': price, 'selling_price': round(price * 1.2, 2), 'payment_status': rng.random() < 0.5}
+
+
+async def add_item(c, u, rng, shared):
+    status, body = await c.call('POST', '/items', token=u.token, body=new_item(rng))
+    if status == 201:
+        u.ids['items'].append(body['id'])
+        shared['items'].setdefault(u.ids['admin'], []).append(body['id'])
+
+
+async def add_items_bulk(c, u, rng, shared):
+    await c.call('POST', '/items/bulk', token=u.token, body={'items': [new_item(rng) for _ in range(20)]})
+
+
+async def restock_item(c, u, rng, shared):
+    if not u.ids['items']:
+        return False
+    await c.call('PUT', '/items/<id>', f"/items/{rng.choice(u.ids['items'])}", u.token,
+                 {'quantity_in_stock': rng.randint(0, 300), 'quantity_spoilt': rng.randint(0, 5)})
+
+
+async def set_payment(c, u, rng, shared):
+    if not u.ids['items']:
+        return False
+    await c.call('PUT', '/items/<id>', f"/items/{rng.choice(u.ids['items'])}", u.token,
+                 {'payment_status': rng.random() < 0.8})
+
+
+async def delete_item(c, u, rng, shared):
+    # Only items added during the run, by this admin's clerks.
+    created = shared['items'].get(u.id)
+    if not created:
+        return False
+    await c.call('DELETE', '/items/<id>', f'/items/{created.pop()}', u.token)
+
+
+async def list_supply_requests(c, u, rng, shared):
+    await c.call('GET', '/supply_requests', token=u.token)
+
+
+async def get_supply_request(c, u, rng, shared):
+    if not u.ids['supply_requests']:
+        return False
+    await c.call('GET', '/supply_requests/<id>', f"/supply_requests/{rng.choice(u.ids['supply_requests'])}", u.token)
+
+
+async def add_supply_request(c, u, rng, shared):
+    if not u.ids['items']:
+        return False
+    status, body = await c.call('POST', '/supply_requests', token=u.token,
+                                body={'item_id': rng.choice(u.ids['items']), 'quantity': rng.randint(1, 100)})
+    if status == 201:
+        shared['supply_requests'].setdefault(u.ids['admin'], []).append(body['id'])
+
+
+async def decide_supply_request(c, u, rng, shared):
+    ids = shared['supply_requests'].get(u.id) or u.ids['supply_requests']
+    if not ids:
+        return False
+    await c.call('PUT', '/supply_requests/<id>', f'/supply_requests/{rng.choice(ids)}', u.token,
+                 {'status': rng.choice(('approved', 'declined'))})
+
+
+async def decide_supply_requests_bulk(c, u, rng, shared):
+    ids = u.ids['supply_requests']
+    if not ids:
+        return False
+    await c.call('PUT', '/supply_requests/bulk', token=u.token,
+                 body={'ids': rng.sample(ids, min(10, len(ids))), 'status': rng.choice(('approved', 'declined'))})
+
+
+async def export(kind, c, u, rng, shared):
+    await c.call('GET', f'/{kind}/export', f"/{kind}/export?format={rng.choice(('ndjson', 'csv'))}", u.token)
+
+
+async def sync(c, u, rng, shared):
+    path = f'/sync?since={quote(u.sync_token)}' if u.sync_token else '/sync'
+    status, body = await c.call('GET', '/sync', path, u.token)
+    if status == 200:
+        u.sync_token = body['next_token']
+
+
+async def list_updates(c, u, rng, shared):
+    await c.call('GET', '/updates', '/updates?limit=50', u.token)
+
+
+async def report(period, c, u, rng, shared):
+    # Mostly the dashboard totals; sometimes the item breakdown too.
+    path = f'/reports/{period}' + ('?per_page=50' if rng.random() < 0.3 else '?include_items=false')
+    await c.call('GET', f'/reports/{period}', path, u.token)
+
+
+async def list_stores(c, u, rng, shared):
+    await c.call('GET', '/stores', token=u.token)
+
+
+async def get_store(c, u, rng, shared):
+    await c.call('GET', '/stores/<id>', f"/stores/{rng.choice(u.ids['stores'])}", u.token)
+
+
+async def add_store(c, u, rng, shared):
+    status, body = await c.call('POST', '/stores', token=u.token, body={'name': f'Load store {rng.randrange(10 ** 6)}'})
+    if status == 201:
+        u.created_stores.append(body['id'])
+
+
+async def delete_store(c, u, rng, shared):
+    # Only stores added during the run, which have nothing in them.
+    if not u.created_stores:
+        return False
+    await c.call('DELETE', '/stores/<id>', f'/stores/{u.created_stores.pop()}', u.token)
+
+
+async def list_users(c, u, rng, shared):
+    status, body = await c.call('GET', '/users', token=u.token)
+    if status == 200:
+        u.created_users = [user['id'] for user in body if user['email'].startswith(f"load-{shared['run']}-")]
+
+
+async def get_user(c, u, rng, shared):
+    if not u.ids['users']:
+        return False
+    await c.call('GET', '/users/<id>', f"/users/{rng.choice(u.ids['users'])}", u.token)
+
+
+def new_email(rng, shared, role):
+    return f"load-{shared['run']}-{role}-{rng.getrandbits(40):x}@load.local"
+
+
+async def add_user(c, u, rng, shared):
+    # Merchants add admins and admins add clerks. The invitation token that
+    # comes back is sometimes used to register a second account.
+    role = 'admin' if u.role == 'merchants' else 'clerk'
+    body = {'role': role, 'email': new_email(rng, shared, role), 'password': shared['password']}
+    if role == 'clerk':
+        body['store_id'] = rng.choice(u.ids['stores'])
+    status, result = await c.call('POST', '/users', token=u.token, body=body)
+    if status == 201 and rng.random() < 0.5:
+        await c.call('POST', '/auth/register', body=dict(body, token=result['token'], email=new_email(rng, shared, role)))
+
+
+async def toggle_user(c, u, rng, shared):
+    # Only accounts added during the run; seeded ones keep working.
+    if not u.created_users:
+        return False
+    await c.call('PUT', '/users/<id>', f'/users/{rng.choice(u.created_users)}', u.token,
+                 {'is_active': rng.random() < 0.5})
+
+
+async def delete_user(c, u, rng, shared):
+    if not u.created_users:
+        return False
+    await c.call('DELETE', '/users/<id>', f'/users/{u.created_users.pop()}', u.token)
+
+
+async def login(c, u, rng, shared):
+    return await c.call('POST', '/auth/login', body={'email': u.email, 'password': shared['password']})
+
+
+async def refresh(c, u, rng, shared):
+    await c.call('POST', '/auth/refresh', token=u.refresh_token)
+
+
+async def logout(c, u, rng, shared):
+    # A session of its own, so the user's tokens stay valid.
+    status, tokens = await login(c, u, rng, shared)
+    if status == 200:
+        await c.call('POST', '/auth/logout', token=tokens['access_token'],
+                     body={'refresh_token': tokens['refresh_token']})
+
+
+async def health(c, u, rng, shared):
+    route = rng.choice(('/health/cache', '/health/pool', '/health/queries', '/metrics'))
+    await c.call('GET', route, token=os.environ.get('METRICS_TOKEN'))
+
+
+ACTIONS = {
+    'clerks': [
+        (30, list_items), (10, get_item), (8, add_item), (1, add_items_bulk), (5, restock_item),
+        (8, list_supply_requests), (4, get_supply_request), (4, add_supply_request), (10, sync),
+        (3, list_updates), (0.2, partial(export, 'items')), (0.2, partial(export, 'supply_requests')),
+        (2, login), (1, refresh), (0.5, logout),
+    ],
+    'admins': [
+        (15, list_items), (5, get_item), (5, set_payment), (1, delete_item), (10, list_supply_requests),
+        (5, get_supply_request), (5, decide_supply_request), (2, decide_supply_requests_bulk),
+        (5, list_users), (3, get_user), (1, add_user), (0.5, toggle_user), (0.5, delete_user),
+        (5, partial(report, 'weekly')), (3, partial(report, 'monthly')), (2, partial(report, 'annual')),
+        (5, list_updates), (2, sync), (2, health), (0.2, partial(export, 'items')),
+        (0.2, partial(export, 'supply_requests')), (1, login), (0.5, refresh), (0.2, logout),
+    ],
+    'merchants': [
+        (10, partial(report, 'weekly')), (8, partial(report, 'monthly')), (6, partial(report, 'annual')),
+        (8, list_stores), (4, get_store), (1, add_store), (0.5, delete_store), (5, list_users), (3, get_user),
+        (1, add_user), (0.3, toggle_user), (0.3, delete_user), (5, list_items), (2, get_item),
+        (5, list_updates), (2, sync), (0.2, partial(export, 'items')), (1, login), (0.5, refresh),
+        (0.2, logout),
+    ],
+}
+
+
+def load_users(per_role, rng):
+    # Runs in an app context: picks accounts of each role and the ids each
+    # can see, and signs their tokens.
+    from models import Admin, Clerk, Item, Merchant, Store, SupplyRequest, db
+    from blueprints.auth import login_tokens
+    from principal import query_principal, scope_claims
+
+    def sample(query):
+        return list(db.session.scalars(query.limit(SAMPLE_IDS)))
+
+    users = {}
+    for role, model in (('merchants', Merchant), ('admins', Admin), ('clerks', Clerk)):
+        ids = list(db.session.scalars(db.select(model.id).order_by(model.id)))
+        users[role] = []
+        for id in sorted(rng.sample(ids, min(per_role, len(ids)))):
+            principal = query_principal(role, id)
+            email = db.session.get(model, id).email
+            if role == 'clerks':
+                owned = dict(
+                    items=sample(db.select(Item.id).where(Item.clerk_id == id).order_by(Item.id.desc())),
+                    supply_requests=sample(db.select(SupplyRequest.id).where(SupplyRequest.clerk_id == id)),
+                    admin=principal.admin_id,
+                )
+            elif role == 'admins':
+                owned = dict(
+                    items=sample(db.select(Item.id).join(Clerk, Clerk.id == Item.clerk_id)
+                                 .where(Clerk.admin_id == id).order_by(Item.id.desc())),
+                    supply_requests=sample(db.select(SupplyRequest.id).join(Clerk, Clerk.id == SupplyRequest.clerk_id)
+                                           .where(Clerk.admin_id == id, SupplyRequest.status == 'pending')),
+                    users=sample(db.select(Clerk.id).where(Clerk.admin_id == id)),
+                    stores=sample(db.select(Store.id).where(Store.merchant_id == principal.merchant_id)),
+                )
+            else:
+                owned = dict(
+                    items=sample(db.select(Item.id).join(Store, Store.id == Item.store_id)
+                                 .where(Store.merchant_id == id).order_by(Item.id.desc())),
+                    users=sample(db.select(Admin.id).where(Admin.merchant_id == id)),
+                    stores=sample(db.select(Store.id).where(Store.merchant_id == id)),
+                )
+            users[role].append(User(role, id, email, login_tokens(principal, scope_claims(principal)), **owned))
+    return users
+
+
+def app_routes():
+    # Every method and URL the app serves, from app.RESOURCES.
+    import importlib
+    from app import RESOURCES
+    routes = set()
+    for module, name, url in RESOURCES:
+        resource = getattr(importlib.import_module(module), name)
+        for method in ('get', 'post', 'put', 'delete'):
+            if hasattr(resource, method):
+                routes.add(f"{method.upper()} {url.replace('<int:id>', '<id>')}")
+    return routes
+
+
+async def simulate(url, users, mix, args, shared):
+    stats = Stats()
+    roles = [role for role in mix if users.get(role)]
+    weights = [mix[role] for role in roles]
+    start = time.monotonic()
+    record_from = start + args.warmup
+    end = record_from + args.duration
+
+    async def user_loop(n):
+        rng = random.Random(args.seed * 1000 + n)
+        client = Client(url, stats)
+        try:
+            while time.monotonic() < end:
+                client.recording = time.monotonic() >= record_from
+                role = rng.choices(roles, weights)[0]
+                user = rng.choice(users[role])
+                action_weights, actions = zip(*ACTIONS[role])
+                await rng.choices(actions, action_weights)[0](client, user, rng, shared)
+        finally:
+            client.connection.close()
+
+    await asyncio.gather(*[user_loop(n) for n in range(args.concurrency)])
+    return stats, time.monotonic() - record_from
+
+
+def percentile(ms, q):
+    return ms[min(int(len(ms) * q), len(ms) - 1)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--merchants', type=int, default=10)
+    parser.add_argument('--stores-per-merchant', type=int, default=5)
+    parser.add_argument('--admins-per-merchant', type=int, default=2)
+    parser.add_argument('--clerks-per-store', type=int, default=4)
+    parser.add_argument('--items-per-store', type=int, default=1000)
+    parser.add_argument('--supply-requests-per-store', type=int, default=100)
+    parser.add_argument('--years', type=float, default=2)
+    parser.add_argument('--password', default='password', help='Password of the generated accounts.')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--skip-seed', action='store_true')
+    parser.add_argument('--mix', default=ROLE_MIX, help='Share of actions per role.')
+    parser.add_argument('--users-per-role', type=int, default=20, help='Accounts of each role to act as.')
+    parser.add_argument('--concurrency', type=int, default=16, help='Simulated users, one connection each.')
+    parser.add_argument('--warmup', type=float, default=5)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--url')
+    parser.add_argument('--cmd', default=WSGI_CMD)
+    parser.add_argument('--json', help='Also write the results to this file.')
+    args = parser.parse_args(argv)
+    if args.admins_per_merchant < 1 or args.clerks_per_store < 1:
+        parser.error('--admins-per-merchant and --clerks-per-store must be at least 1')
+    mix = {role: float(weight) for role, weight in (part.split('=') for part in args.mix.split(','))}
+
+    if not os.environ.get('DATABASE_URL'):
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'load.db')
+    os.environ.setdefault('AUDIT_SPOOL_DIR', tempfile.mkdtemp())
+
+    from app import create_app
+    from seed import generate_data
+    app = create_app()
+    if not args.skip_seed:
+        started = time.perf_counter()
+        counts = generate_data(
+            merchants=args.merchants, stores_per_merchant=args.stores_per_merchant,
+            admins_per_merchant=args.admins_per_merchant, clerks_per_store=args.clerks_per_store,
+            items_per_store=args.items_per_store, supply_requests_per_store=args.supply_requests_per_store,
+            years=args.years, password=args.password, seed=args.seed, app=app
+        )
+        print('Seeded ' + ', '.join(f'{n} {table}' for table, n in counts.items())
+              + f' in {time.perf_counter() - started:.1f}s')
+    with app.app_context():
+        users = load_users(args.users_per_role, random.Random(args.seed))
+
+    process = None
+    url = args.url
+    try:
+        if url is None:
+            port = free_port()
+            process = start_server(args.cmd, port, dict(os.environ))
+            url = f'http://127.0.0.1:{port}'
+        shared = {'run': f'{int(time.time()):x}', 'password': args.password, 'items': {}, 'supply_requests': {}}
+        stats, elapsed = asyncio.run(simulate(url, users, mix, args, shared))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    results = {}
+    print(f'{"route":<32} {"requests":>8} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}  statuses')
+    for route in sorted(stats.latencies, key=lambda r: -len(stats.latencies[r])):
+        ms = sorted(s * 1000 for s in stats.latencies[route])
+        results[route] = {'requests': len(ms), 'per_second': len(ms) / elapsed, 'p50_ms': percentile(ms, 0.5),
+                          'p95_ms': percentile(ms, 0.95), 'p99_ms': percentile(ms, 0.99),
+                          'statuses': stats.statuses[route]}
+        r = results[route]
+        print(f"{route:<32} {r['requests']:>8} {r['per_second']:>8.1f} {r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} "
+              f"{r['p99_ms']:>8.1f}  {r['statuses']}")
+    ms = sorted(s * 1000 for latencies in stats.latencies.values() for s in latencies)
+    if ms:
+        total = {'requests': len(ms), 'per_second': len(ms) / elapsed, 'p50_ms': percentile(ms, 0.5),
+                 'p95_ms': percentile(ms, 0.95), 'p99_ms': percentile(ms, 0.99)}
+        print(f"{'all':<32} {total['requests']:>8} {total['per_second']:>8.1f} {total['p50_ms']:>8.1f} "
+              f"{total['p95_ms']:>8.1f} {total['p99_ms']:>8.1f}")
+        results['all'] = total
+    missed = sorted(app_routes() - set(stats.latencies))
+    if missed:
+        print('Not reached: ' + ', '.join(missed))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'seconds': elapsed, 'routes': results, 'not_reached': missed}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""Compare the old three-query login lookup with the single UNION ALL lookup.
+
+Seeds merchants, admins and clerks (10k accounts by default, most of them
+clerks, as in production) and times the credential lookup for random clerk
+emails both ways. Only the database lookup is timed, not password hashing.
+
+    cd server && python -m benchmarks.login --users 10000 --lookups 2000
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+
+def seed(db, users):
+    from sqlalchemy import insert
+    from models import Admin, Clerk, Merchant, Store, hash_password
+
+    db.drop_all()
+    db.create_all()
+    password = hash_password('bench')
+    merchants = max(users // 100, 1)
+    admins = max(users // 20, 1)
+    clerks = max(users - merchants - admins, 1)
+    db.session.execute(insert(Merchant), [
+        {'email': f'merchant{n}@bench.local', 'password': password, 'is_active': True} for n in range(merchants)
+    ])
+    db.session.execute(insert(Store), [
+        {'name': f'Store {n}', 'merchant_id': n % merchants + 1} for n in range(merchants)
+    ])
+    db.session.execute(insert(Admin), [
+        {'email': f'admin{n}@bench.local', 'password': password, 'is_active': True, 'merchant_id': n % merchants + 1}
+        for n in range(admins)
+    ])
+    db.session.execute(insert(Clerk), [
+        {'email': f'clerk{n}@bench.local', 'password': password, 'is_active': True,
+         'admin_id': n % admins + 1, 'store_id': n % merchants + 1}
+        for n in range(clerks)
+    ])
+    db.session.commit()
+    return clerks
+
+
+def sequential_lookup(email):
+    from models import Admin, Clerk, Merchant
+    return Merchant.query.filter_by(email=email).first() or \
+        Admin.query.filter_by(email=email).first() or \
+        Clerk.query.filter_by(email=email).first()
+
+
+def time_lookups(db, lookup, emails):
+    samples = []
+    for email in emails:
+        start = time.perf_counter()
+        assert lookup(email) is not None
+        samples.append(time.perf_counter() - start)
+        db.session.expunge_all()
+    return samples
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--lookups', type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    if not os.environ.get('DATABASE_URL'):
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'login.db')
+
+    from app import create_app
+    from blueprints.auth import find_account
+    from models import db
+    app = create_app()
+
+    with app.app_context():
+        clerks = seed(db, args.users)
+        rng = random.Random(7)
+        emails = [f'clerk{rng.randrange(clerks)}@bench.local' for _ in range(args.lookups)]
+        # Warm both paths so connection setup is not counted.
+        time_lookups(db, sequential_lookup, emails[:50])
+        time_lookups(db, find_account, emails[:50])
+        results = {
+            'sequential (3 queries)': time_lookups(db, sequential_lookup, emails),
+            'union all (1 query)': time_lookups(db, find_account, emails),
+        }
+        dialect = db.engine.dialect.name
+
+    print(f'{args.users} accounts, {args.lookups} clerk logins, {dialect}')
+    for name, samples in results.items():
+        ms = sorted(s * 1000 for s in samples)
+        print(f'{name:<24} mean {statistics.mean(ms):.3f} ms  p50 {ms[len(ms) // 2]:.3f} ms  '
+              f'p95 {ms[int(len(ms) * 0.95)]:.3f} ms')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""Measure password verification and login throughput per core.
+
+Times the KDF on its own (inline and through the verification pool at
+several concurrencies), then full POST /auth/login requests through the test
+client from a number of threads, reporting logins per second divided by the
+cores available. Also shows the cost of the legacy SHA-256 check and of a
+verification cache hit for comparison.
+
+    cd server && python -m benchmarks.passwords --logins 200 --threads 1,4,16
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from passwords import PasswordBusy, VerificationCache
+
+
+def timed(fn, count, threads, busy=None):
+    samples = []
+
+    def one(_):
+        start = time.perf_counter()
+        try:
+            fn()
+        except PasswordBusy:
+            busy.append(1)
+            return
+        samples.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(one, range(count)))
+    return time.perf_counter() - start, samples
+
+
+def report(name, elapsed, samples, cores, busy=()):
+    ms = sorted(s * 1000 for s in samples)
+    rate = len(samples) / elapsed
+    print(f'{name:<34} {rate:8.1f}/s  {rate / cores:8.1f}/s/core  '
+          f'p50 {ms[len(ms) // 2]:8.2f} ms  p95 {ms[int(len(ms) * 0.95)]:8.2f} ms')
+    if busy:
+        print(f'{"":<34} {len(busy)} refused as busy (PASSWORD_MAX_PENDING)')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--threads', default='1,4,16', help='Comma-separated client concurrencies.')
+    args = parser.parse_args(argv)
+    concurrencies = [int(t) for t in args.threads.split(',')]
+
+    if not os.environ.get('DATABASE_URL'):
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'passwords.db')
+    os.environ.setdefault('AUDIT_SPOOL_DIR', tempfile.mkdtemp())
+
+    import hashlib
+    from app import create_app
+    from sqlalchemy import insert
+    from models import Admin, Clerk, Merchant, Store, db
+    from passwords import passwords
+    app = create_app()
+
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    stored = passwords._hash('bench')
+    legacy = hashlib.sha256(b'bench').hexdigest()
+    print(f'scrypt n={passwords.n} r={passwords.r} p={passwords.p}, '
+          f'{app.config["PASSWORD_WORKERS"]} pool workers, {cores} cores')
+
+    count = max(args.logins // 4, 10)
+    report('legacy sha256 (inline)', *timed(lambda: passwords._verify('bench', legacy), count * 100, 1), cores)
+    report('scrypt (inline)', *timed(lambda: passwords._verify('bench', stored), count, 1), cores)
+    for threads in concurrencies:
+        # Straight to the pool, so the verification cache is not involved.
+        busy = []
+        report(f'scrypt via pool, {threads} threads',
+               *timed(lambda: passwords._run(passwords._verify, 'bench', stored), count, threads, busy), cores, busy)
+    passwords.verify('bench', stored)
+    report('verification cache hit', *timed(lambda: passwords.verify('bench', stored), count * 100, 1), cores)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        # Every clerk gets its own salted hash, so no two logins share a
+        # verification cache entry.
+        db.session.execute(insert(Merchant), [{'email': 'merchant@bench.local', 'password': stored, 'is_active': True}])
+        db.session.execute(insert(Store), [{'name': 'Bench', 'merchant_id': 1}])
+        db.session.execute(insert(Admin), [
+            {'email': 'admin@bench.local', 'password': stored, 'is_active': True, 'merchant_id': 1}
+        ])
+        db.session.execute(insert(Clerk), [
+            {'email': f'clerk{n}@bench.local', 'password': passwords._hash('bench'), 'is_active': True,
+             'admin_id': 1, 'store_id': 1}
+            for n in range(args.logins)
+        ])
+        db.session.commit()
+
+    client = app.test_client()
+    for threads in concurrencies:
+        # Each login is a different account so the cache never helps; busy
+        # responses (503) are counted separately.
+        emails = iter([f'clerk{n}@bench.local' for n in range(args.logins)])
+        busy = []
+
+        def login():
+            response = client.post('/auth/login', json={'email': next(emails), 'password': 'bench'})
+            if response.status_code == 503:
+                raise PasswordBusy()
+            assert response.status_code == 200, response.get_json()
+
+        passwords.cache = VerificationCache()
+        report(f'POST /auth/login, {threads} threads', *timed(login, args.logins, threads, busy), cores, busy)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
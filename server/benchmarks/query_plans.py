@@ -0,0 +1,206 @@
+"""Query-plan regression check for the role-scoped endpoints.
+
+Seeds a large synthetic dataset, calls every list, detail and report
+endpoint as a merchant, an admin and a clerk, then EXPLAINs each statement
+those requests issued. Exits non-zero if any of them scans a large table
+instead of using an index.
+
+    cd server && python -m benchmarks.query_plans --items 50000
+
+Uses DATABASE_URL when set (run ANALYZE-able PostgreSQL for realistic
+plans), otherwise a throwaway SQLite file.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+LARGE_TABLES = ('items', 'supply_requests', 'updates', 'daily_item_rollups', 'deleted_records')
+
+
+def seed(db, models, merchants, stores, clerks, items, chunk_size=5000):
+    from sqlalchemy import insert
+    from models import hash_password
+    from rollups import backfill_rollups
+    Merchant, Admin, Clerk, Store, Item, SupplyRequest, Update = models
+
+    db.drop_all()
+    db.create_all()
+    password = hash_password('bench')
+    db.session.execute(insert(Merchant), [
+        {'email': f'merchant{n}@bench.local', 'password': password, 'is_active': True}
+        for n in range(merchants)
+    ])
+    merchant_ids = db.session.execute(db.select(Merchant.id)).scalars().all()
+    # Each merchant gets its share of stores and one admin per 20 clerks.
+    db.session.execute(insert(Store), [
+        {'name': f'Store {n}', 'merchant_id': merchant_ids[n % merchants]} for n in range(stores)
+    ])
+    db.session.execute(insert(Admin), [
+        {'email': f'admin{n}@bench.local', 'password': password, 'is_active': True,
+         'merchant_id': merchant_ids[n % merchants]}
+        for n in range(max(clerks // 20, merchants))
+    ])
+    store_rows = db.session.execute(db.select(Store.id, Store.merchant_id)).all()
+    admin_rows = db.session.execute(db.select(Admin.id, Admin.merchant_id)).all()
+    admins_by_merchant = {}
+    for admin in admin_rows:
+        admins_by_merchant.setdefault(admin.merchant_id, []).append(admin.id)
+    clerk_rows = []
+    for n in range(clerks):
+        store = store_rows[n % stores]
+        admin_ids = admins_by_merchant[store.merchant_id]
+        clerk_rows.append({
+            'email': f'clerk{n}@bench.local',
+            'password': password,
+            'is_active': True,
+            'admin_id': admin_ids[n % len(admin_ids)],
+            'store_id': store.id
+        })
+    db.session.execute(insert(Clerk), clerk_rows)
+    clerk_rows = db.session.execute(db.select(Clerk.id, Clerk.store_id)).all()
+
+    rng = random.Random(42)
+    now = datetime.utcnow()
+    for start in range(0, items, chunk_size):
+        rows = []
+        for _ in range(start, min(start + chunk_size, items)):
+            clerk_id, store_id = rng.choice(clerk_rows)
+            quantity = rng.randint(1, 500)
+            rows.append({
+                'name': f'SKU-{rng.randint(1, 99999)}',
+                'quantity_received': quantity,
+                'quantity_in_stock': quantity,
+                'quantity_spoilt': rng.randint(0, 5),
+                'buying_price': rng.uniform(1, 100),
+                'selling_price': rng.uniform(1, 150),
+                'payment_status': rng.random() < 0.7,
+                'created_at': now - timedelta(minutes=rng.randint(0, 3 * 365 * 24 * 60)),
+                'store_id': store_id,
+                'clerk_id': clerk_id
+            })
+        db.session.execute(insert(Item), rows)
+        db.session.commit()
+
+    item_ids = db.session.execute(db.select(Item.id, Item.store_id, Item.clerk_id)).all()
+    admin_of = dict(db.session.execute(db.select(Clerk.id, Clerk.admin_id)).all())
+    for start in range(0, len(item_ids) // 10, chunk_size):
+        batch = item_ids[start:start + chunk_size]
+        db.session.execute(insert(SupplyRequest), [{
+            'item_id': i.id, 'store_id': i.store_id, 'clerk_id': i.clerk_id,
+            'quantity': rng.randint(1, 100), 'status': rng.choice(['pending', 'approved', 'declined'])
+        } for i in batch])
+        db.session.execute(insert(Update), [{
+            'action': 'item_added', 'description': 'seeded', 'clerk_id': i.clerk_id, 'item_id': i.id
+        } for i in batch])
+        # Admins act on about half of the requests their clerks raise.
+        db.session.execute(insert(Update), [{
+            'action': 'supply_request_updated', 'description': 'seeded', 'admin_id': admin_of[i.clerk_id]
+        } for i in batch if rng.random() < 0.5])
+        db.session.commit()
+    backfill_rollups()
+
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql('ANALYZE')
+    clerk = db.session.get(Clerk, clerk_rows[0].id)
+    return clerk.store.merchant_id, clerk.admin_id, clerk.id
+
+
+def full_scans(conn, statement, parameters):
+    if conn.dialect.name == 'postgresql':
+        plan = conn.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + statement, parameters).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        found, nodes = [], [plan[0]['Plan']]
+        while nodes:
+            node = nodes.pop()
+            if node.get('Node Type') == 'Seq Scan' and node.get('Relation Name') in LARGE_TABLES:
+                found.append(node['Relation Name'])
+            nodes.extend(node.get('Plans', []))
+        return found
+    rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+    # SQLite reports "SEARCH t USING INDEX ..." for index lookups and
+    # "SCAN t [USING ...]" when it walks the whole table or index.
+    return [table for row in rows for table in LARGE_TABLES
+            if row[-1] == f'SCAN {table}' or row[-1].startswith(f'SCAN {table} ')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--merchants', type=int, default=10)
+    parser.add_argument('--stores', type=int, default=40)
+    parser.add_argument('--clerks', type=int, default=200)
+    parser.add_argument('--items', type=int, default=50000)
+    args = parser.parse_args(argv)
+
+    if not os.environ.get('DATABASE_URL'):
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'query_plans.db')
+
+    from flask_jwt_extended import create_access_token
+    from sqlalchemy import event
+    from app import create_app
+    from models import db, Merchant, Admin, Clerk, Store, Item, SupplyRequest, Update
+    from principal import query_principal, scope_claims
+    from syncing import encode_sync_token
+    app = create_app()
+
+    with app.app_context():
+        merchant_id, admin_id, clerk_id = seed(
+            db, (Merchant, Admin, Clerk, Store, Item, SupplyRequest, Update),
+            args.merchants, args.stores, args.clerks, args.items)
+        item_id = db.session.execute(db.select(Item.id).filter_by(clerk_id=clerk_id)).scalars().first()
+        request_id = db.session.execute(db.select(SupplyRequest.id).filter_by(clerk_id=clerk_id)).scalars().first()
+        # Tokens as LoginUser issues them, scope claims included.
+        tokens = {
+            role: create_access_token(identity={'id': user_id, 'role': role},
+                                      additional_claims={'scope': scope_claims(query_principal(role, user_id))})
+            for role, user_id in (('merchants', merchant_id), ('admins', admin_id), ('clerks', clerk_id))
+        }
+        engine = db.engine
+    sync_token = encode_sync_token(datetime.utcnow() - timedelta(days=1), None, {})
+
+    paths = {
+        'merchants': ['/items', '/supply_requests', '/stores', '/users'],
+        'admins': ['/items', '/supply_requests', '/users'],
+        'clerks': ['/items', '/supply_requests']
+    }
+    for role_paths in paths.values():
+        role_paths += ['/reports/weekly', '/reports/monthly', '/reports/annual', '/updates', '/sync',
+                       f'/sync?since={sync_token}',
+                       f'/items/{item_id}', f'/supply_requests/{request_id}']
+
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            captured.append((statement, parameters))
+
+    client = app.test_client()
+    failures = 0
+    for role, role_paths in paths.items():
+        for path in role_paths:
+            captured.clear()
+            event.listen(engine, 'before_cursor_execute', capture)
+            try:
+                response = client.get(path, headers={'Authorization': f'Bearer {tokens[role]}'})
+            finally:
+                event.remove(engine, 'before_cursor_execute', capture)
+            if response.status_code != 200:
+                print(f'FAIL {role} GET {path}: HTTP {response.status_code}')
+                failures += 1
+                continue
+            with engine.connect() as conn:
+                scans = sorted({t for s, p in captured for t in full_scans(conn, s, p)})
+            status = 'FAIL' if scans else 'ok  '
+            failures += bool(scans)
+            print(f'{status} {role:<9} GET {path:<24} {len(captured)} queries'
+                  + (f', full scan of {", ".join(scans)}' if scans else ''))
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""Regression check for read-replica routing and read-your-writes.
+
+Seeds the demo data into a SQLite primary and copies it to a second file
+that stands in for a replica which never catches up, with one item only it
+has. Then, in process:
+
+  - a clerk's GET reads from the replica (the item only it has is listed);
+  - after the clerk adds an item, the clerk's GETs read from the primary
+    for READ_YOUR_WRITES_SECONDS, while the merchant's uncached export
+    still reads from the replica;
+  - the merchant's conditional /items, whose cache tags that write bumped,
+    reads from the primary, so the body sent with the new ETag lists the
+    new item;
+  - once the windows have passed, both read from the replica again;
+  - with the replica unreachable, GETs read from the primary.
+
+Exits non-zero if any check fails.
+
+    cd server && python -m benchmarks.replicas
+"""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+REPLICA_ONLY = 'Replica only item'
+NEW_ITEM = 'Primary only item'
+WINDOW = 1
+
+
+def add_replica_only_item(path):
+    with sqlite3.connect(path) as conn:
+        columns = [c[1] for c in conn.execute('PRAGMA table_info(items)') if c[1] not in ('id', 'name')]
+        names = ', '.join(columns)
+        conn.execute(f'INSERT INTO items (name, {names}) SELECT ?, {names} FROM items WHERE id = 1', (REPLICA_ONLY,))
+
+
+def item_names(client, auth, path):
+    response = client.get(path, headers=auth)
+    if path.startswith('/items/export'):
+        return response.status_code, {line.split('"name": ')[1].split('"')[1]
+                                      for line in response.get_data(as_text=True).splitlines() if line}
+    return response.status_code, {item['name'] for item in response.get_json()['items']}
+
+
+def login(client, email, password):
+    response = client.post('/auth/login', json={'email': email, 'password': password})
+    return {'Authorization': f"Bearer {response.get_json()['access_token']}"}
+
+
+def make_client(primary, replica):
+    from app import create_app
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': primary,
+        'READ_REPLICA_URLS': [replica],
+        'REPLICA_MAX_LAG_SECONDS': WINDOW,
+        'REPLICA_LAG_CHECK_INTERVAL': 0,
+        'READ_YOUR_WRITES_SECONDS': WINDOW,
+        'CACHE_BACKEND': 'local',
+        'AUDIT_ASYNC': False,
+    })
+    return app.test_client()
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    primary_path = os.path.join(directory, 'primary.db')
+    replica_path = os.path.join(directory, 'replica.db')
+    primary = 'sqlite:///' + primary_path
+    os.environ['DATABASE_URL'] = primary
+    os.environ.setdefault('AUDIT_SPOOL_DIR', tempfile.mkdtemp())
+
+    from seed import seed_database
+    seed_database()
+    shutil.copy(primary_path, replica_path)
+    add_replica_only_item(replica_path)
+
+    failures = []
+
+    def expect(label, found, present=(), absent=()):
+        status, names = found
+        ok = status == 200 and set(present) <= names and not set(absent) & names
+        print(f'{label}: {"ok" if ok else "FAILED"}')
+        if not ok:
+            failures.append(f'{label}: got {status} with {sorted(names)}')
+
+    client = make_client(primary, 'sqlite:///' + replica_path)
+    clerk = login(client, 'clerk@example.com', 'clerk123')
+    merchant = login(client, 'merchant@example.com', 'merchant123')
+
+    expect('GET reads from the replica', item_names(client, clerk, '/items'), present=[REPLICA_ONLY])
+
+    response = client.post('/items', headers=clerk, json={
+        'name': NEW_ITEM, 'quantity_received': 5, 'buying_price': 10.0, 'selling_price': 12.0
+    })
+    if response.status_code != 201:
+        failures.append(f'Adding an item answered {response.status_code}')
+
+    expect('Writer reads its write', item_names(client, clerk, '/items/export'),
+           present=[NEW_ITEM], absent=[REPLICA_ONLY])
+    expect('Other accounts still read from the replica', item_names(client, merchant, '/items/export'),
+           present=[REPLICA_ONLY])
+    expect('Recently bumped tags read from the primary', item_names(client, merchant, '/items'),
+           present=[NEW_ITEM], absent=[REPLICA_ONLY])
+
+    time.sleep(WINDOW + 0.5)
+    expect('Writer reads from the replica after the window', item_names(client, clerk, '/items/export'),
+           present=[REPLICA_ONLY])
+    expect('Tags read from the replica after the window', item_names(client, merchant, '/items?fields=name'),
+           present=[REPLICA_ONLY])
+
+    client = make_client(primary, 'sqlite:///' + os.path.join(directory, 'missing', 'replica.db'))
+    clerk = login(client, 'clerk@example.com', 'clerk123')
+    expect('Unreachable replica falls back to the primary', item_names(client, clerk, '/items'),
+           present=[NEW_ITEM], absent=[REPLICA_ONLY])
+
+    for failure in failures:
+        print(failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""Measure how long a fresh worker takes to start serving.
+
+Runs a number of new Python processes. Each one imports the app module,
+calls create_app() and then makes two GET /items requests through the test
+client as a clerk. The script reports the median and worst time of each
+step, plus the whole process from spawn to the first response. The first
+request pays for whatever the app leaves until then: the first pooled
+connection, the revocation load and statement compilation.
+
+It then does the same for workers forked from one process that has already
+imported and created the app, as gunicorn --preload does.
+
+    cd server && python -m benchmarks.startup --runs 10
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORKER = '''
+import json, os, time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+client = app.test_client()
+headers = {'Authorization': 'Bearer ' + os.environ['STARTUP_TOKEN']}
+assert client.get('/items', headers=headers).status_code == 200
+first = time.perf_counter()
+assert client.get('/items', headers=headers).status_code == 200
+second = time.perf_counter()
+print(json.dumps({'import': imported - start, 'create_app': created - imported,
+                  'first request': first - created, 'second request': second - first,
+                  'first response at': time.time() - (second - first)}))
+'''
+
+PRELOADED = '''
+import json, os, sys, time
+from app import create_app
+app = create_app()
+headers = {'Authorization': 'Bearer ' + os.environ['STARTUP_TOKEN']}
+for _ in range(int(sys.argv[1])):
+    read, write = os.pipe()
+    forked = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        status = app.test_client().get('/items', headers=headers).status_code
+        os.write(write, json.dumps([status, time.perf_counter() - forked]).encode())
+        os._exit(0)
+    os.close(write)
+    status, seconds = json.loads(os.read(read, 100))
+    os.close(read)
+    os.waitpid(pid, 0)
+    assert status == 200
+    print(seconds)
+'''
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    if not os.environ.get('DATABASE_URL'):
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'startup.db')
+    os.environ.setdefault('AUDIT_SPOOL_DIR', tempfile.mkdtemp())
+
+    from app import create_app
+    from flask_jwt_extended import create_access_token
+    from models import Admin, Clerk, Merchant, Store, db
+    from principal import query_principal, scope_claims
+    app = create_app()
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        merchant = Merchant(email='merchant@bench.local', password='-')
+        store = Store(name='Bench', merchant=merchant)
+        admin = Admin(email='admin@bench.local', password='-', merchant=merchant)
+        clerk = Clerk(email='clerk@bench.local', password='-', admin=admin, store=store)
+        db.session.add_all([merchant, store, admin, clerk])
+        db.session.commit()
+        token = create_access_token(
+            identity={'id': clerk.id, 'role': 'clerks'},
+            additional_claims={'scope': scope_claims(query_principal('clerks', clerk.id))}
+        )
+
+    env = dict(os.environ, STARTUP_TOKEN=token)
+    samples = {}
+    for _ in range(args.runs):
+        start = time.time()
+        output = subprocess.run(
+            [sys.executable, '-c', WORKER], cwd=SERVER_DIR, env=env, check=True, capture_output=True, text=True
+        ).stdout
+        times = json.loads(output.strip().splitlines()[-1])
+        times['spawn to first response'] = times.pop('first response at') - start
+        for step, seconds in times.items():
+            samples.setdefault(step, []).append(seconds * 1000)
+    if hasattr(os, 'fork'):
+        output = subprocess.run(
+            [sys.executable, '-c', PRELOADED, str(args.runs)], cwd=SERVER_DIR, env=env, check=True,
+            capture_output=True, text=True
+        ).stdout
+        samples['preloaded: fork to response'] = [float(line) * 1000 for line in output.split()]
+
+    print(f'{"step":<28} {"median ms":>10} {"max ms":>10}')
+    for step, ms in samples.items():
+        print(f'{step:<28} {statistics.median(ms):>10.1f} {max(ms):>10.1f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,15 @@
 from flask import Blueprint, request, jsonify
 from flask_restful import Resource
-from flask_jwt_extended import create_access_token, create_refresh_token, jwt_required, get_jwt_identity
-from models import Merchant, Admin, Clerk, db, hash_password
+from flask_jwt_extended import create_access_token, create_refresh_token, decode_token, jwt_required, get_jwt, get_jwt_identity
+from sqlalchemy import literal_column, null, select, union_all, update
+from models import Merchant, Admin, Clerk, db
+from passwords import PasswordBusy, passwords
+from revocation import revocations
+from principal import Principal, query_principal, scope_claims
 from datetime import datetime, timedelta
 import jwt
 from config import Config
+from cache import response_cache, user_list_tag
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -37,6 +42,7 @@ class RegisterUser(Resource):
 
             user.set_password(password)
             db.session.add(user)
+            response_cache.invalidate(user_list_tag(user))
             db.session.commit()
             return {"message": "User registered successfully"}, 201
         except jwt.InvalidTokenError:
@@ -45,37 +51,124 @@ class RegisterUser(Resource):
             db.session.rollback()
             return {"error": str(e)}, 500
 
+ACCOUNT_MODELS = {'merchants': Merchant, 'admins': Admin, 'clerks': Clerk}
+LOGIN_FAILED = {"error": "Invalid credentials"}, 401
+LOGIN_BUSY = {"error": "Too many logins in progress, try again shortly"}, 503, {"Retry-After": "1"}
+
+def account_query(email):
+    # One round trip across all three account tables, each branch an index
+    # lookup on its unique email, also returning the ids that make up the
+    # account's scope claims. If the same address exists in more than one
+    # table, merchants win over admins and admins over clerks.
+    owners = {
+        Merchant: (Merchant.id, null(), null()),
+        Admin: (Admin.merchant_id, Admin.id, null()),
+        Clerk: (Admin.merchant_id, Clerk.admin_id, Clerk.store_id),
+    }
+    branches = []
+    for rank, model in enumerate((Merchant, Admin, Clerk)):
+        merchant_id, admin_id, store_id = owners[model]
+        branch = select(
+            model.id, literal_column(f"'{model.__tablename__}'").label('role'), model.password, model.is_active,
+            merchant_id.label('merchant_id'), admin_id.label('admin_id'), store_id.label('store_id'),
+            literal_column(str(rank)).label('rank')
+        ).where(model.email == email)
+        if model is Clerk:
+            branch = branch.join(Admin, Admin.id == Clerk.admin_id)
+        branches.append(branch)
+    return union_all(*branches).order_by('rank').limit(1)
+
+def find_account(email):
+    return db.session.execute(account_query(email)).first()
+
+def rehash_statement(user, new_hash):
+    # Only replaces the hash the login verified against.
+    model = ACCOUNT_MODELS[user.role]
+    return update(model).where(model.id == user.id, model.password == user.password).values(password=new_hash)
+
+def rehash_password(user, password):
+    # Upgrades a legacy SHA-256 (or outdated scrypt) hash in place once the
+    # password has been proven. If the pool is busy or another login got
+    # there first, the next login does it.
+    try:
+        db.session.execute(rehash_statement(user, passwords.hash(password)))
+        db.session.commit()
+    except PasswordBusy:
+        pass
+    except Exception:
+        db.session.rollback()
+
 class LoginUser(Resource):
     def post(self):
         data = request.get_json()
         email = data.get('email')
         password = data.get('password')
 
-        user = Merchant.query.filter_by(email=email).first() or \
-               Admin.query.filter_by(email=email).first() or \
-               Clerk.query.filter_by(email=email).first()
+        if not isinstance(password, str):
+            return LOGIN_FAILED
+
+        user = find_account(email)
+        try:
+            if not user:
+                passwords.dummy_verify(password)
+                return LOGIN_FAILED
+            ok, needs_rehash = passwords.verify(password, user.password)
+            if not ok:
+                return LOGIN_FAILED
+            if not user.is_active:
+                return {"error": "Account is deactivated"}, 403
+            if needs_rehash:
+                rehash_password(user, password)
+        except PasswordBusy:
+            return LOGIN_BUSY
 
-        if not user or user.password != hash_password(password):
-            return {"error": "Invalid credentials"}, 401
-        if not user.is_active:
-            return {"error": "Account is deactivated"}, 403
+        return login_tokens(user, scope_claims(account_principal(user))), 200
 
-        access_token = create_access_token(identity={'id': user.id, 'role': user.__tablename__})
-        refresh_token = create_refresh_token(identity={'id': user.id, 'role': user.__tablename__})
-        return {
-            "access_token": access_token,
-            "refresh_token": refresh_token,
-            "role": user.__tablename__
-        }, 200
+def account_principal(user):
+    return Principal(user.id, user.role, user.is_active, user.merchant_id, user.admin_id, user.store_id)
+
+def login_tokens(user, claims):
+    identity = {'id': user.id, 'role': user.role}
+    return {
+        "access_token": create_access_token(identity=identity, additional_claims={'scope': claims}),
+        "refresh_token": create_refresh_token(identity=identity),
+        "role": user.role
+    }
 
 class LogoutUser(Resource):
     @jwt_required()
     def post(self):
+        # Revokes the access token used for this call and, when the client
+        # sends it along, its refresh token.
+        tokens = [get_jwt()]
+        data = request.get_json(silent=True) or {}
+        if data.get('refresh_token'):
+            try:
+                refresh = decode_token(data['refresh_token'])
+            except Exception:
+                return {"error": "Invalid refresh token"}, 400
+            if refresh.get('type') != 'refresh' or refresh.get('sub') != get_jwt_identity():
+                return {"error": "Invalid refresh token"}, 400
+            tokens.append(refresh)
+        try:
+            for token in tokens:
+                revocations.revoke_token(token)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            return {"error": str(e)}, 500
         return {"message": "Logged out successfully"}, 200
 
 class RefreshToken(Resource):
     @jwt_required(refresh=True)
     def post(self):
+        # Scope claims are re-read from the database, so a refresh picks up
+        # new stores or a changed hierarchy.
         current_user = get_jwt_identity()
-        new_access_token = create_access_token(identity=current_user)
+        principal = query_principal(current_user['role'], current_user['id'])
+        if not principal or not principal.is_active:
+            return {"error": "Account deactivated or not found"}, 403
+        new_access_token = create_access_token(
+            identity=current_user, additional_claims={'scope': scope_claims(principal)}
+        )
         return {"access_token": new_access_token}, 200
\ No newline at end of file
@@ -0,0 +1,59 @@
+import hmac
+from functools import wraps
+from flask import Blueprint, Response, current_app, request
+from flask_restful import Resource
+from cache import response_cache
+from dbpool import pool_status
+from instrumentation import instrumentation
+from routing import replica_router
+
+health_bp = Blueprint('health', __name__)
+
+def has_metrics_token(required):
+    # Whether the request carries METRICS_TOKEN as a bearer token. Without
+    # one configured, that passes only where it is not `required`.
+    token = current_app.config['METRICS_TOKEN']
+    if not token:
+        return not required
+    return hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+
+def operators_only(view):
+    # For routes that show every tenant's internals (statement text, pool
+    # state, replica connection errors): open to holders of METRICS_TOKEN,
+    # not to store accounts, and closed when it is not set.
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not has_metrics_token(required=True):
+            return {"error": "Missing or invalid token"}, 401
+        return view(*args, **kwargs)
+    return wrapper
+
+class CacheStats(Resource):
+    @operators_only
+    def get(self):
+        return response_cache.stats(), 200
+
+class PoolStats(Resource):
+    # This worker's pools only; each gunicorn worker answers for itself.
+    @operators_only
+    def get(self):
+        return dict(pool_status(), replicas=replica_router.status()), 200
+
+class SlowQueries(Resource):
+    # The slowest statements this worker has run per endpoint, with
+    # INSTRUMENTATION on.
+    @operators_only
+    def get(self):
+        if not instrumentation.enabled:
+            return {"error": "Instrumentation is disabled"}, 404
+        return instrumentation.slowest_statements(), 200
+
+class Metrics(Resource):
+    # Prometheus scrape target, with INSTRUMENTATION on. Scrapers have no
+    # user token; when METRICS_TOKEN is set they send it as a bearer token.
+    def get(self):
+        if not instrumentation.enabled:
+            return {"error": "Instrumentation is disabled"}, 404
+        if not has_metrics_token(required=False):
+            return {"error": "Missing or invalid token"}, 401
+        return Response(instrumentation.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
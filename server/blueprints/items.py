@@ -1,49 +1,68 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, current_app, request, jsonify
 from flask_restful import Resource
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from models import Item, Clerk, Admin, Merchant, Store, Update, db
+from sqlalchemy import insert, select
+from models import Item, db
+from audit import audit
+from cache import item_tags, own_tags, response_cache
+from export import EXPORT_FORMATS, export_response
+from pagination import InvalidCursor, decode_cursor, keyset_after, keyset_page, parse_limit
+from principal import current_principal
+from scoping import check_account, load_with_owners, owns, scoped
+from rollups import item_contribution, record_item_added, record_item_changed, record_item_removed, record_items_added
 from datetime import datetime
 
 items_bp = Blueprint('items', __name__)
 
+ITEM_FIELDS = (
+    'id', 'name', 'quantity_received', 'quantity_in_stock', 'quantity_spoilt',
+    'buying_price', 'selling_price', 'payment_status', 'store_id'
+)
+
+def parse_item_fields(args):
+    fields = args.get('fields')
+    if not fields:
+        return ITEM_FIELDS
+    fields = tuple(f.strip() for f in fields.split(',') if f.strip())
+    unknown = [f for f in fields if f not in ITEM_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+def item_page_query(current_user, fields, cursor, limit):
+    columns = [getattr(Item, f) for f in dict.fromkeys(fields + ('id',))]
+    query = scoped(select(*columns, Item.received_at.label('received_at')), Item, current_user)
+    if cursor:
+        query = query.where(keyset_after(Item.received_at, Item.id, cursor))
+    return query.order_by(Item.received_at.desc(), Item.id.desc()).limit(limit + 1)
+
+def item_page(rows, fields, limit):
+    rows, next_cursor = keyset_page(rows, limit, 'received_at')
+    return {
+        "items": [{f: getattr(r, f) for f in fields} for r in rows],
+        "next_cursor": next_cursor
+    }
+
 class ItemEndpoint(Resource):
     @jwt_required()
+    @response_cache.conditional(own_tags('items'))
     def get(self):
         current_user = get_jwt_identity()
-        role = current_user['role']
-        user_id = current_user['id']
+        error = check_account(current_user)
+        if error:
+            return error
 
-        if role == 'clerks':
-            clerk = Clerk.query.get(user_id)
-            if not clerk or not clerk.is_active:
-                return {"error": "Account deactivated or not found"}, 403
-            items = Item.query.filter_by(clerk_id=user_id).all()
-        elif role == 'admins':
-            admin = Admin.query.get(user_id)
-            if not admin or not admin.is_active:
-                return {"error": "Account deactivated or not found"}, 403
-            clerks = Clerk.query.filter_by(admin_id=user_id).all()
-            items = Item.query.filter(Item.clerk_id.in_([c.id for c in clerks])).all()
-        elif role == 'merchants':
-            merchant = Merchant.query.get(user_id)
-            if not merchant or not merchant.is_active:
-                return {"error": "Account deactivated or not found"}, 403
-            stores = Store.query.filter_by(merchant_id=user_id).all()
-            items = Item.query.filter(Item.store_id.in_([s.id for s in stores])).all()
-        else:
-            return {"error": "Unauthorized"}, 403
+        try:
+            fields = parse_item_fields(request.args)
+            cursor = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+        except InvalidCursor:
+            return {"error": "Invalid cursor"}, 400
+        except ValueError as e:
+            return {"error": str(e)}, 400
 
-        return [{
-            "id": i.id,
-            "name": i.name,
-            "quantity_received": i.quantity_received,
-            "quantity_in_stock": i.quantity_in_stock,
-            "quantity_spoilt": i.quantity_spoilt,
-            "buying_price": i.buying_price,
-            "selling_price": i.selling_price,
-            "payment_status": i.payment_status,
-            "store_id": i.store_id
-        } for i in items], 200
+        limit = parse_limit(request.args)
+        rows = db.session.execute(item_page_query(current_user, fields, cursor, limit)).all()
+        return item_page(rows, fields, limit), 200
 
     @jwt_required()
     def post(self):
@@ -52,7 +71,7 @@ class ItemEndpoint(Resource):
             return {"error": "Only clerks can add items"}, 403
 
         data = request.get_json()
-        clerk = Clerk.query.get(current_user['id'])
+        clerk = current_principal()
         if not clerk or not clerk.is_active:
             return {"error": "Account deactivated or not found"}, 403
 
@@ -69,51 +88,133 @@ class ItemEndpoint(Resource):
                 clerk_id=clerk.id
             )
             db.session.add(item)
-            db.session.add(Update(
+            db.session.flush()
+            record_item_added(item)
+            audit.record(
                 action="item_added",
                 description=f"Added {data['name']} to store {clerk.store_id}",
                 clerk_id=clerk.id,
                 item_id=item.id
-            ))
+            )
+            response_cache.invalidate(*item_tags(clerk.id, clerk.admin_id, clerk.merchant_id))
             db.session.commit()
             return {"message": "Item added successfully", "id": item.id}, 201
         except Exception as e:
             db.session.rollback()
             return {"error": str(e)}, 500
 
+def validate_item(data):
+    if not isinstance(data, dict):
+        return "Expected an object"
+    if not isinstance(data.get('name'), str) or not data['name'].strip():
+        return "name is required"
+    for field in ('quantity_received', 'buying_price', 'selling_price'):
+        if field not in data:
+            return f"{field} is required"
+    for field in ('quantity_received', 'quantity_spoilt'):
+        value = data.get(field, 0)
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            return f"{field} must be a non-negative integer"
+    for field in ('buying_price', 'selling_price'):
+        value = data[field]
+        if not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0:
+            return f"{field} must be a non-negative number"
+    if not isinstance(data.get('payment_status', False), bool):
+        return "payment_status must be a boolean"
+    return None
+
+class ItemBulkEndpoint(Resource):
+    @jwt_required()
+    def post(self):
+        current_user = get_jwt_identity()
+        if current_user['role'] != 'clerks':
+            return {"error": "Only clerks can add items"}, 403
+
+        clerk = current_principal()
+        if not clerk or not clerk.is_active:
+            return {"error": "Account deactivated or not found"}, 403
+
+        data = request.get_json()
+        batch = data.get('items') if isinstance(data, dict) else data
+        if not isinstance(batch, list) or not batch:
+            return {"error": "Expected a non-empty list of items"}, 400
+        max_items = current_app.config.get('BULK_ITEMS_MAX', 1000)
+        if len(batch) > max_items:
+            return {"error": f"At most {max_items} items per batch"}, 400
+
+        errors = [{"index": i, "error": e} for i, e in enumerate(map(validate_item, batch)) if e]
+        if errors:
+            return {"error": "Invalid items", "results": errors}, 400
+
+        received_at = datetime.utcnow()
+        rows = [{
+            "name": row['name'],
+            "quantity_received": row['quantity_received'],
+            "quantity_in_stock": row['quantity_received'],
+            "quantity_spoilt": row.get('quantity_spoilt', 0),
+            "buying_price": row['buying_price'],
+            "selling_price": row['selling_price'],
+            "payment_status": row.get('payment_status', False),
+            "store_id": clerk.store_id,
+            "clerk_id": clerk.id,
+            "created_at": received_at
+        } for row in batch]
+
+        try:
+            # executemany with RETURNING: on PostgreSQL SQLAlchemy sends the
+            # batch as multi-row INSERTs and hands ids back in parameter
+            # order (SQLite falls back to one INSERT per row).
+            ids = db.session.scalars(
+                insert(Item).returning(Item.id, sort_by_parameter_order=True), rows
+            ).all()
+            audit.record_many([{
+                "action": "item_added",
+                "description": f"Added {row['name']} to store {clerk.store_id}",
+                "clerk_id": clerk.id,
+                "item_id": item_id
+            } for row, item_id in zip(rows, ids)])
+            record_items_added(Item(**row) for row in rows)
+            response_cache.invalidate(*item_tags(clerk.id, clerk.admin_id, clerk.merchant_id))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            return {"error": str(e)}, 500
+
+        return {
+            "message": f"{len(ids)} items added successfully",
+            "results": [{"index": i, "id": item_id} for i, item_id in enumerate(ids)]
+        }, 201
+
+class ItemExport(Resource):
+    @jwt_required()
+    def get(self):
+        current_user = get_jwt_identity()
+        error = check_account(current_user)
+        if error:
+            return error
+
+        fmt = request.args.get('format', 'ndjson')
+        if fmt not in EXPORT_FORMATS:
+            return {"error": f"Unsupported format: {fmt}"}, 400
+
+        fields = ITEM_FIELDS + ('received_at',)
+        query = scoped(select(*[getattr(Item, f) for f in fields]), Item, current_user).order_by(Item.id)
+        return export_response(query, fields, fmt, 'items')
+
 class ItemEndpointById(Resource):
     @jwt_required()
+    @response_cache.cached(lambda principal, id: [('item', id)])
     def get(self, id):
-        item = Item.query.get(id)
-        if not item:
-            return {"error": "Item not found"}, 404
-
         current_user = get_jwt_identity()
-        role = current_user['role']
-        user_id = current_user['id']
+        found = load_with_owners(Item, id, current_user)
+        if not found:
+            return {"error": "Item not found"}, 404
 
-        if role == 'clerks' and item.clerk_id != user_id:
+        item, admin_id, merchant_id = found
+        if not owns(current_user, item.clerk_id, admin_id, merchant_id):
             return {"error": "Unauthorized"}, 403
-        elif role == 'admins':
-            clerk = Clerk.query.get(item.clerk_id)
-            if not clerk or clerk.admin_id != user_id:
-                return {"error": "Unauthorized"}, 403
-        elif role == 'merchants':
-            store = Store.query.get(item.store_id)
-            if not store or store.merchant_id != user_id:
-                return {"error": "Unauthorized"}, 403
 
-        return {
-            "id": item.id,
-            "name": item.name,
-            "quantity_received": item.quantity_received,
-            "quantity_in_stock": item.quantity_in_stock,
-            "quantity_spoilt": item.quantity_spoilt,
-            "buying_price": item.buying_price,
-            "selling_price": item.selling_price,
-            "payment_status": item.payment_status,
-            "store_id": item.store_id
-        }, 200
+        return {f: getattr(item, f) for f in ITEM_FIELDS}, 200
 
     @jwt_required()
     def put(self, id):
@@ -121,33 +222,29 @@ class ItemEndpointById(Resource):
         role = current_user['role']
         user_id = current_user['id']
 
-        item = Item.query.get(id)
-        if not item:
+        found = load_with_owners(Item, id, current_user)
+        if not found:
             return {"error": "Item not found"}, 404
 
-        if role == 'clerks' and item.clerk_id != user_id:
+        item, admin_id, merchant_id = found
+        if not owns(current_user, item.clerk_id, admin_id, merchant_id):
             return {"error": "Unauthorized"}, 403
-        elif role == 'admins':
-            clerk = Clerk.query.get(item.clerk_id)
-            if not clerk or clerk.admin_id != user_id:
-                return {"error": "Unauthorized"}, 403
-        elif role == 'merchants':
-            store = Store.query.get(item.store_id)
-            if not store or store.merchant_id != user_id:
-                return {"error": "Unauthorized"}, 403
 
         data = request.get_json()
         try:
+            before = item_contribution(item)
             item.quantity_in_stock = data.get('quantity_in_stock', item.quantity_in_stock)
             item.quantity_spoilt = data.get('quantity_spoilt', item.quantity_spoilt)
             if role == 'admins' and 'payment_status' in data:
                 item.payment_status = data['payment_status']
-                db.session.add(Update(
+                audit.record(
                     action="payment_updated",
                     description=f"Payment status for {item.name} set to {data['payment_status']}",
                     admin_id=user_id,
                     item_id=item.id
-                ))
+                )
+            record_item_changed(item, before)
+            response_cache.invalidate(('item', id), *item_tags(item.clerk_id, admin_id, merchant_id))
             db.session.commit()
             return {"message": "Item updated successfully"}, 200
         except Exception as e:
@@ -160,18 +257,24 @@ class ItemEndpointById(Resource):
         if current_user['role'] not in ['admins', 'merchants']:
             return {"error": "Unauthorized"}, 403
 
-        item = Item.query.get(id)
-        if not item:
+        found = load_with_owners(Item, id, current_user)
+        if not found:
             return {"error": "Item not found"}, 404
 
+        item, admin_id, merchant_id = found
+        if not owns(current_user, item.clerk_id, admin_id, merchant_id):
+            return {"error": "Unauthorized"}, 403
+
         try:
+            record_item_removed(item)
             db.session.delete(item)
-            db.session.add(Update(
+            audit.record(
                 action="item_deleted",
                 description=f"Item {item.name} deleted",
                 admin_id=current_user['id'] if current_user['role'] == 'admins' else None,
                 merchant_id=current_user['id'] if current_user['role'] == 'merchants' else None
-            ))
+            )
+            response_cache.invalidate(('item', id), *item_tags(item.clerk_id, admin_id, merchant_id))
             db.session.commit()
             return {"message": "Item deleted successfully"}, 200
         except Exception as e:
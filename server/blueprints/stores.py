@@ -1,19 +1,23 @@
 from flask import Blueprint, request, jsonify
 from flask_restful import Resource
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from models import Store, Merchant, Update, db
+from models import Store, db
+from audit import audit
+from cache import response_cache
+from principal import current_principal
 
 stores_bp = Blueprint('stores', __name__)
 
 class StoreEndpoint(Resource):
     @jwt_required()
+    @response_cache.cached(lambda principal: [('stores', principal.id)])
     def get(self):
         current_user = get_jwt_identity()
         if current_user['role'] != 'merchants':
             return {"error": "Only merchants can view stores"}, 403
 
-        merchant = Merchant.query.get(current_user['id'])
-        if not merchant.is_active:
+        merchant = current_principal()
+        if not merchant or not merchant.is_active:
             return {"error": "Account deactivated"}, 403
 
         stores = Store.query.filter_by(merchant_id=merchant.id).all()
@@ -26,18 +30,19 @@ class StoreEndpoint(Resource):
             return {"error": "Only merchants can add stores"}, 403
 
         data = request.get_json()
-        merchant = Merchant.query.get(current_user['id'])
-        if not merchant.is_active:
+        merchant = current_principal()
+        if not merchant or not merchant.is_active:
             return {"error": "Account deactivated"}, 403
 
         try:
             store = Store(name=data['name'], merchant_id=merchant.id)
             db.session.add(store)
-            db.session.add(Update(
+            audit.record(
                 action="store_added",
                 description=f"Store {data['name']} added",
                 merchant_id=merchant.id
-            ))
+            )
+            response_cache.invalidate(('stores', merchant.id))
             db.session.commit()
             return {"message": "Store added successfully", "id": store.id}, 201
         except Exception as e:
@@ -79,11 +84,12 @@ class StoreEndpointById(Resource):
 
         try:
             db.session.delete(store)
-            db.session.add(Update(
+            audit.record(
                 action="store_deleted",
                 description=f"Store {store.name} deleted",
                 merchant_id=current_user['id']
-            ))
+            )
+            response_cache.invalidate(('stores', current_user['id']))
             db.session.commit()
             return {"message": "Store deleted successfully"}, 200
         except Exception as e:
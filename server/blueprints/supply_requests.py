@@ -1,46 +1,44 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, current_app, request, jsonify
 from flask_restful import Resource
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from models import SupplyRequest, Clerk, Admin, Merchant, Store, Update, db
+from sqlalchemy import select, update
+from models import Clerk, SupplyRequest, db
+from audit import audit
+from cache import own_tags, response_cache, supply_request_tags
+from principal import current_principal
+from scoping import check_account, load_with_owners, owns, scoped
+from export import EXPORT_FORMATS, export_response
 from datetime import datetime
 
 supply_requests_bp = Blueprint('supply_requests', __name__)
 
+SUPPLY_REQUEST_FIELDS = ('id', 'item_id', 'store_id', 'quantity', 'status', 'requested_at')
+SUPPLY_REQUEST_STATUSES = ('pending', 'approved', 'declined')
+
+def supply_request_list_query(current_user):
+    return scoped(select(*[getattr(SupplyRequest, f) for f in SUPPLY_REQUEST_FIELDS]), SupplyRequest, current_user)
+
+def supply_request_list(rows):
+    return [{
+        "id": r.id,
+        "item_id": r.item_id,
+        "store_id": r.store_id,
+        "quantity": r.quantity,
+        "status": r.status,
+        "requested_at": r.requested_at.isoformat()
+    } for r in rows]
+
 class SupplyRequestEndpoint(Resource):
     @jwt_required()
+    @response_cache.conditional(own_tags('supply_requests'))
     def get(self):
         current_user = get_jwt_identity()
-        role = current_user['role']
-        user_id = current_user['id']
-
-        if role == 'clerks':
-            clerk = Clerk.query.get(user_id)
-            if not clerk or not clerk.is_active:
-                return {"error": "Account deactivated or not found"}, 403
-            requests = SupplyRequest.query.filter_by(clerk_id=user_id).all()
-        elif role == 'admins':
-            admin = Admin.query.get(user_id)
-            if not admin or not admin.is_active:
-                return {"error": "Account deactivated or not found"}, 403
-            clerks = Clerk.query.filter_by(admin_id=user_id).all()
-            requests = SupplyRequest.query.filter(SupplyRequest.clerk_id.in_([c.id for c in clerks])).all()
-        elif role == 'merchants':
-            merchant = Merchant.query.get(user_id)
-            if not merchant or not merchant.is_active:
-                return {"error": "Account deactivated or not found"}, 403
-            stores = Store.query.filter_by(merchant_id=user_id).all()
-            requests = SupplyRequest.query.filter(SupplyRequest.store_id.in_([s.id for s in stores])).all()
-        else:
-            return {"error": "Unauthorized"}, 403
+        error = check_account(current_user)
+        if error:
+            return error
 
-        return [{
-            "id": r.id,
-            "item_id": r.item_id,
-            "store_id": r.store_id,
-            "quantity": r.quantity,
-            "status": r.status,
-            "requested_at": r.requested_at.isoformat()
-        } for r in requests], 200
+        rows = db.session.execute(supply_request_list_query(current_user)).all()
+        return supply_request_list(rows), 200
 
     @jwt_required()
     def post(self):
@@ -49,7 +47,7 @@ class SupplyRequestEndpoint(Resource):
             return {"error": "Only clerks can request supplies"}, 403
 
         data = request.get_json()
-        clerk = Clerk.query.get(current_user['id'])
+        clerk = current_principal()
         if not clerk or not clerk.is_active:
             return {"error": "Account deactivated or not found"}, 403
 
@@ -62,39 +60,111 @@ class SupplyRequestEndpoint(Resource):
                 status="pending"
             )
             db.session.add(supply_request)
-            db.session.add(Update(
+            db.session.flush()
+            audit.record(
                 action="supply_request_created",
                 description=f"Supply request for item {data['item_id']} created",
                 clerk_id=clerk.id,
                 supply_request_id=supply_request.id
-            ))
+            )
+            response_cache.invalidate(*supply_request_tags(clerk.id, clerk.admin_id, clerk.merchant_id))
             db.session.commit()
             return {"message": "Supply request created successfully", "id": supply_request.id}, 201
         except Exception as e:
             db.session.rollback()
             return {"error": str(e)}, 500
 
+class SupplyRequestBulkEndpoint(Resource):
+    @jwt_required()
+    def put(self):
+        current_user = get_jwt_identity()
+        if current_user['role'] != 'admins':
+            return {"error": "Only admins can update supply requests"}, 403
+
+        admin = current_principal()
+        if not admin or not admin.is_active:
+            return {"error": "Account deactivated or not found"}, 403
+
+        data = request.get_json()
+        if not isinstance(data, dict):
+            return {"error": "Expected an object with ids and status"}, 400
+        ids = data.get('ids')
+        status = data.get('status')
+        if not isinstance(ids, list) or not ids or \
+                not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            return {"error": "ids must be a non-empty list of integers"}, 400
+        if status not in SUPPLY_REQUEST_STATUSES:
+            return {"error": f"status must be one of: {', '.join(SUPPLY_REQUEST_STATUSES)}"}, 400
+        ids = list(dict.fromkeys(ids))
+        max_ids = current_app.config.get('BULK_SUPPLY_REQUESTS_MAX', 1000)
+        if len(ids) > max_ids:
+            return {"error": f"At most {max_ids} supply requests per batch"}, 400
+
+        # One query decides the whole batch: the requests raised by this
+        # admin's clerks. Anything else (missing or someone else's) fails
+        # the batch before anything is written.
+        owned = dict(db.session.execute(
+            select(SupplyRequest.id, SupplyRequest.clerk_id)
+            .join(Clerk, Clerk.id == SupplyRequest.clerk_id)
+            .where(SupplyRequest.id.in_(ids), Clerk.admin_id == admin.id)
+        ).all())
+        denied = [i for i in ids if i not in owned]
+        if denied:
+            return {"error": "Supply requests not found or unauthorized", "ids": denied}, 403
+
+        try:
+            db.session.execute(
+                update(SupplyRequest).where(SupplyRequest.id.in_(ids)).values(status=status),
+                execution_options={"synchronize_session": False}
+            )
+            audit.record_many([{
+                "action": "supply_request_updated",
+                "description": f"Supply request {i} status set to {status}",
+                "admin_id": admin.id,
+                "supply_request_id": i
+            } for i in ids])
+            response_cache.invalidate(
+                *[('supply_request', i) for i in ids],
+                *[('supply_requests', 'clerks', c) for c in set(owned.values())],
+                ('supply_requests', 'admins', admin.id),
+                ('supply_requests', 'merchants', admin.merchant_id)
+            )
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            return {"error": str(e)}, 500
+
+        return {"message": f"{len(ids)} supply requests updated successfully", "ids": ids}, 200
+
+class SupplyRequestExport(Resource):
+    @jwt_required()
+    def get(self):
+        current_user = get_jwt_identity()
+        error = check_account(current_user)
+        if error:
+            return error
+
+        fmt = request.args.get('format', 'ndjson')
+        if fmt not in EXPORT_FORMATS:
+            return {"error": f"Unsupported format: {fmt}"}, 400
+
+        fields = SUPPLY_REQUEST_FIELDS + ('clerk_id',)
+        query = scoped(select(*[getattr(SupplyRequest, f) for f in fields]), SupplyRequest, current_user) \
+            .order_by(SupplyRequest.id)
+        return export_response(query, fields, fmt, 'supply_requests')
+
 class SupplyRequestEndpointById(Resource):
     @jwt_required()
+    @response_cache.cached(lambda principal, id: [('supply_request', id)])
     def get(self, id):
-        supply_request = SupplyRequest.query.get(id)
-        if not supply_request:
-            return {"error": "Supply request not found"}, 404
-
         current_user = get_jwt_identity()
-        role = current_user['role']
-        user_id = current_user['id']
+        found = load_with_owners(SupplyRequest, id, current_user)
+        if not found:
+            return {"error": "Supply request not found"}, 404
 
-        if role == 'clerks' and supply_request.clerk_id != user_id:
+        supply_request, admin_id, merchant_id = found
+        if not owns(current_user, supply_request.clerk_id, admin_id, merchant_id):
             return {"error": "Unauthorized"}, 403
-        elif role == 'admins':
-            clerk = Clerk.query.get(supply_request.clerk_id)
-            if not clerk or clerk.admin_id != user_id:
-                return {"error": "Unauthorized"}, 403
-        elif role == 'merchants':
-            store = Store.query.get(supply_request.store_id)
-            if not store or store.merchant_id != user_id:
-                return {"error": "Unauthorized"}, 403
 
         return {
             "id": supply_request.id,
@@ -111,27 +181,28 @@ class SupplyRequestEndpointById(Resource):
         if current_user['role'] != 'admins':
             return {"error": "Only admins can update supply requests"}, 403
 
-        supply_request = SupplyRequest.query.get(id)
-        if not supply_request:
+        found = load_with_owners(SupplyRequest, id, current_user)
+        if not found:
             return {"error": "Supply request not found"}, 404
 
-        admin = Admin.query.get(current_user['id'])
+        admin = current_principal()
         if not admin or not admin.is_active:
             return {"error": "Account deactivated or not found"}, 403
 
-        clerk = Clerk.query.get(supply_request.clerk_id)
-        if not clerk or clerk.admin_id != admin.id:
+        supply_request, admin_id, merchant_id = found
+        if admin_id != admin.id:
             return {"error": "Unauthorized"}, 403
 
         data = request.get_json()
         try:
             supply_request.status = data.get('status', supply_request.status)
-            db.session.add(Update(
+            audit.record(
                 action="supply_request_updated",
                 description=f"Supply request {id} status set to {supply_request.status}",
                 admin_id=admin.id,
                 supply_request_id=id
-            ))
+            )
+            response_cache.invalidate(('supply_request', id), *supply_request_tags(supply_request.clerk_id, admin_id, merchant_id))
             db.session.commit()
             return {"message": "Supply request updated successfully"}, 200
         except Exception as e:
@@ -0,0 +1,32 @@
+from flask import Blueprint, current_app, request, jsonify
+from flask_restful import Resource
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from scoping import check_account
+from pagination import parse_limit
+from syncing import InvalidSyncToken, decode_sync_token, load_changes
+from datetime import datetime, timedelta
+
+sync_bp = Blueprint('sync', __name__)
+
+class SyncEndpoint(Resource):
+    @jwt_required()
+    def get(self):
+        current_user = get_jwt_identity()
+        error = check_account(current_user)
+        if error:
+            return error
+
+        now = datetime.utcnow()
+        since, until, after = None, now, {}
+        if request.args.get('since'):
+            try:
+                since, until, after = decode_sync_token(request.args['since'])
+            except InvalidSyncToken:
+                return {"error": "Invalid sync token"}, 400
+            until = until or now
+            retention = timedelta(days=current_app.config['SYNC_TOMBSTONE_DAYS'])
+            if since and since < now - retention:
+                return {"error": "Sync token expired; start a full sync"}, 410
+
+        overlap = timedelta(seconds=current_app.config['SYNC_OVERLAP_SECONDS'])
+        return load_changes(current_user, since, until, after, parse_limit(request.args), overlap), 200
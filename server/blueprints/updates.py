@@ -0,0 +1,34 @@
+from flask import Blueprint, request, jsonify
+from flask_restful import Resource
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from scoping import check_account
+from activity import FEED_FIELDS, load_feed, parse_feed_filters
+from pagination import InvalidCursor, decode_cursor, keyset_page, parse_limit
+
+updates_bp = Blueprint('updates', __name__)
+
+class UpdateEndpoint(Resource):
+    @jwt_required()
+    def get(self):
+        current_user = get_jwt_identity()
+        error = check_account(current_user)
+        if error:
+            return error
+
+        try:
+            filters = parse_feed_filters(request.args)
+            cursor = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+        except InvalidCursor:
+            return {"error": "Invalid cursor"}, 400
+        except ValueError as e:
+            return {"error": str(e)}, 400
+
+        limit = parse_limit(request.args)
+        rows, next_cursor = keyset_page(load_feed(current_user, filters, cursor, limit), limit, 'created_at')
+        return {
+            "updates": [{
+                **{f: getattr(r, f) for f in FEED_FIELDS if f != 'created_at'},
+                "created_at": r.created_at.isoformat() if r.created_at else None
+            } for r in rows],
+            "next_cursor": next_cursor
+        }, 200
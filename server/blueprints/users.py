@@ -1,7 +1,11 @@
 from flask import Blueprint, request, jsonify
 from flask_restful import Resource
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from models import Admin, Clerk, Merchant, Update, db
+from models import Admin, Clerk, db
+from audit import audit
+from cache import response_cache, user_list_tag
+from principal import current_principal, invalidate_principal
+from revocation import revocations
 from datetime import datetime, timedelta
 import jwt
 from config import Config
@@ -10,18 +14,19 @@ users_bp = Blueprint('users', __name__)
 
 class UserEndpoint(Resource):
     @jwt_required()
+    @response_cache.cached(lambda principal: [('users', principal.role, principal.id)])
     def get(self):
         current_user = get_jwt_identity()
         role = current_user['role']
         user_id = current_user['id']
 
         if role == 'merchants':
-            merchant = Merchant.query.get(user_id)
+            merchant = current_principal()
             if not merchant or not merchant.is_active:
                 return {"error": "Account deactivated or not found"}, 403
             users = Admin.query.filter_by(merchant_id=user_id).all()
         elif role == 'admins':
-            admin = Admin.query.get(user_id)
+            admin = current_principal()
             if not admin or not admin.is_active:
                 return {"error": "Account deactivated or not found"}, 403
             users = Clerk.query.filter_by(admin_id=user_id).all()
@@ -43,7 +48,7 @@ class UserEndpoint(Resource):
         data = request.get_json()
 
         if role == 'merchants' and data['role'] == 'admin':
-            merchant = Merchant.query.get(user_id)
+            merchant = current_principal()
             if not merchant or not merchant.is_active:
                 return {"error": "Account deactivated or not found"}, 403
             user = Admin(email=data['email'], merchant_id=user_id)
@@ -52,7 +57,7 @@ class UserEndpoint(Resource):
                 'exp': datetime.utcnow() + timedelta(hours=24)
             }, Config.JWT_SECRET_KEY)
         elif role == 'admins' and data['role'] == 'clerk':
-            admin = Admin.query.get(user_id)
+            admin = current_principal()
             if not admin or not admin.is_active:
                 return {"error": "Account deactivated or not found"}, 403
             user = Clerk(email=data['email'], admin_id=user_id, store_id=data['store_id'])
@@ -66,12 +71,13 @@ class UserEndpoint(Resource):
         try:
             user.set_password(data['password'])
             db.session.add(user)
-            db.session.add(Update(
+            audit.record(
                 action="user_added",
                 description=f"{data['role']} {data['email']} added",
                 merchant_id=user_id if role == 'merchants' else None,
                 admin_id=user_id if role == 'admins' else None
-            ))
+            )
+            response_cache.invalidate(user_list_tag(user))
             db.session.commit()
             return {"message": "User added successfully", "token": token}, 201
         except Exception as e:
@@ -126,14 +132,19 @@ class UserEndpointById(Resource):
 
         data = request.get_json()
         try:
+            was_active = user.is_active
             user.is_active = data.get('is_active', user.is_active)
-            db.session.add(Update(
+            if was_active and not user.is_active:
+                revocations.revoke_user(user.__tablename__, user.id)
+            audit.record(
                 action="user_updated",
                 description=f"User {user.email} {'deactivated' if not user.is_active else 'activated'}",
                 merchant_id=user_id if role == 'merchants' else None,
                 admin_id=user_id if role == 'admins' else None
-            ))
+            )
+            response_cache.invalidate(user_list_tag(user))
             db.session.commit()
+            invalidate_principal(user.__tablename__, user.id)
             return {"message": "User updated successfully"}, 200
         except Exception as e:
             db.session.rollback()
@@ -160,13 +171,16 @@ class UserEndpointById(Resource):
 
         try:
             db.session.delete(user)
-            db.session.add(Update(
+            revocations.revoke_user(user.__tablename__, user.id)
+            audit.record(
                 action="user_deleted",
                 description=f"User {user.email} deleted",
                 merchant_id=user_id if role == 'merchants' else None,
                 admin_id=user_id if role == 'admins' else None
-            ))
+            )
+            response_cache.invalidate(user_list_tag(user))
             db.session.commit()
+            invalidate_principal(user.__tablename__, user.id)
             return {"message": "User deleted successfully"}, 200
         except Exception as e:
             db.session.rollback()
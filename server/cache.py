@@ -0,0 +1,312 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from functools import wraps
+from flask import Response, current_app, has_request_context, request
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite
+from models import CacheVersion, db
+from principal import load_principal
+from routing import replica_router, use_primary
+from staging import TransactionStage
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+log = logging.getLogger(__name__)
+
+
+class LocalBackend:
+    # In-process LRU with a per-entry expiry. Each worker has its own copy;
+    # entries are keyed by the versions in the database, so a write seen by
+    # one worker stops every worker's older entries from being hit.
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        values = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry and entry[0] > now:
+                    self._entries.move_to_end(key)
+                    values.append(entry[1])
+                else:
+                    values.append(None)
+        return values
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisBackend:
+    # Shared by every worker, so a response built by one is a hit for all.
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError("CACHE_BACKEND=redis needs the redis package")
+        self._client = redis.Redis.from_url(url)
+
+    def get_many(self, keys):
+        return [v and json.loads(v) for v in self._client.mget(keys)]
+
+    def set(self, key, value, ttl):
+        self._client.set(key, json.dumps(value), ex=max(int(ttl), 1))
+
+    def delete_many(self, keys):
+        if keys:
+            self._client.delete(*keys)
+
+    def __len__(self):
+        return self._client.dbsize()
+
+
+class ResponseCache:
+    # Caches successful GET responses per caller. Every cached response
+    # names the tags it was built from (("stores", merchant_id), ("item", id),
+    # ...) and the current version of each tag is part of its key. Versions
+    # are counters in the cache_versions table: write handlers call
+    # invalidate() with the tags they touch before they commit, and the
+    # counters are bumped in that same transaction. Entries built on the
+    # old versions are never looked up again and age out through the LRU or
+    # their TTL. Being in the database, a version is the same for every
+    # worker and survives restarts, and so are the ETags built on it.
+    #
+    # So that a hit or a 304 needs no query, the versions read are also
+    # kept in the backend for CACHE_VERSION_TTL seconds, and dropped from it
+    # as soon as a write that bumps them commits. With the redis backend
+    # that reaches every worker; with the local one only the worker that
+    # took the write, and the others see the new version once their copy
+    # expires. CACHE_VERSION_TTL=0 reads the table on every request.
+    def __init__(self, app=None):
+        self.backend = None
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        self._tags = TransactionStage('cache_tags', before_commit=self._bump, after_commit=self._forget)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_BACKEND', 'local')
+        app.config.setdefault('CACHE_TTL', 30)
+        app.config.setdefault('CACHE_MAX_ENTRIES', 10000)
+        app.config.setdefault('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+        app.config.setdefault('CACHE_VERSION_TTL', 1.0)
+        backend = app.config['CACHE_BACKEND']
+        self.ttl = app.config['CACHE_TTL']
+        self.version_ttl = app.config['CACHE_VERSION_TTL']
+        if backend == 'redis':
+            self.backend = RedisBackend(app.config['CACHE_REDIS_URL'])
+        elif backend == 'local':
+            self.backend = LocalBackend(app.config['CACHE_MAX_ENTRIES'])
+        else:
+            self.backend = None
+        app.extensions['response_cache'] = self
+
+    def _count(self, endpoint, outcome):
+        with self._stats_lock:
+            counts = self._stats.setdefault(endpoint, {'hits': 0, 'misses': 0, 'not_modified': 0, 'invalidations': 0})
+            counts[outcome] += 1
+
+    def stats(self):
+        with self._stats_lock:
+            endpoints = {k: dict(v) for k, v in self._stats.items()}
+        return {
+            "backend": current_app.config['CACHE_BACKEND'],
+            "entries": len(self.backend) if self.backend is not None else 0,
+            "endpoints": endpoints
+        }
+
+    def _tag_key(self, tag):
+        return ':'.join(map(str, tag))
+
+    def versions(self, tags):
+        # The current version of each tag, 0 for one never bumped, and when
+        # the most recent of them was bumped. Tags without a copy in the
+        # backend are read from the primary: a replica may not have the
+        # latest bump yet.
+        keys = [self._tag_key(t) for t in tags]
+        copies = self.backend.get_many(['ver:' + key for key in keys]) if self.version_ttl else [None] * len(keys)
+        current = {key: copy for key, copy in zip(keys, copies) if copy is not None}
+        missing = [key for key in keys if key not in current]
+        if missing:
+            with use_primary():
+                rows = db.session.execute(
+                    select(CacheVersion.tag, CacheVersion.version, CacheVersion.bumped_at)
+                    .where(CacheVersion.tag.in_(missing))
+                ).all()
+            found = {tag: [version, bumped_at and bumped_at.isoformat()] for tag, version, bumped_at in rows}
+            for key in missing:
+                current[key] = found.get(key, [0, None])
+                if self.version_ttl:
+                    self.backend.set('ver:' + key, current[key], self.version_ttl)
+        bumped = [datetime.fromisoformat(current[key][1]) for key in keys if current[key][1]]
+        return [current[key][0] for key in keys], max(bumped, default=None)
+
+    def invalidate(self, *tags):
+        # Called before the write commits; the tags' versions are bumped in
+        # its transaction, or not at all if it rolls back.
+        if self.backend is None:
+            return
+        self._tags.extend(self._tag_key(t) for t in tags)
+        self._count(request.endpoint if has_request_context() else None, 'invalidations')
+
+    def _bump(self, session, keys):
+        keys = sorted(set(keys))
+        bump_versions(session, keys)
+        return keys
+
+    def _forget(self, keys):
+        # The copies versions() kept of what this commit bumped.
+        self.backend.delete_many(['ver:' + key for key in keys])
+
+    def cached(self, tags):
+        # Wraps a Resource.get below @jwt_required(). `tags` maps the
+        # caller's principal and the view arguments to the tags the response
+        # depends on. Only 200 responses are stored; a caller whose account
+        # is gone or deactivated always goes through to the handler.
+        return self._wrap(tags, store=True)
+
+    def conditional(self, tags):
+        # ETag / If-None-Match only, for responses too large or too varied
+        # to be worth storing (the paginated lists).
+        return self._wrap(tags, store=False)
+
+    def _wrap(self, tags, store):
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                response, entry = self.lookup(tags, store, kwargs)
+                if response is not None:
+                    return response
+                result = view(*args, **kwargs)
+                return self.complete(entry, result) if entry else result
+            return wrapper
+        return decorator
+
+    def lookup(self, tags, store, kwargs=None):
+        # The tag versions that key a cached response also make a weak ETag:
+        # any write that could change the response bumps one of them. A
+        # matching If-None-Match is answered with 304 before the handler
+        # runs a query. Returns (response, entry): a response to send as is
+        # (304 or a hit), or the entry to pass to complete() with what the
+        # handler returned; entry is None when the handler's result is to be
+        # sent untouched.
+        identity = get_jwt_identity()
+        principal = load_principal(identity) if self.backend is not None else None
+        if not principal or not principal.is_active:
+            return None, None
+
+        endpoint = request.endpoint
+        try:
+            versions, bumped_at = self.versions(tags(principal, **(kwargs or {})))
+            # The ETag names the versions just read; a replica that has not
+            # replayed the latest bump must not supply the body sent with it.
+            replica_router.require_fresh(bumped_at)
+            # The reports' windows move with the UTC date, without any write.
+            raw = json.dumps([endpoint, identity['role'], identity['id'], request.full_path, versions,
+                              datetime.utcnow().date().isoformat()])
+            digest = hashlib.sha1(raw.encode()).hexdigest()
+            etag = f'W/"{digest}"'
+            if request.if_none_match.contains_weak(digest):
+                self._count(endpoint, 'not_modified')
+                return Response(status=304, headers={'ETag': etag}), None
+            hit = self.backend.get_many(['resp:' + digest])[0] if store else None
+        except Exception:
+            db.session.rollback()
+            log.exception('Response cache lookup failed')
+            return None, None
+        if hit is not None:
+            self._count(endpoint, 'hits')
+            return (hit, 200, {'X-Cache': 'HIT', 'ETag': etag}), None
+
+        self._count(endpoint, 'misses')
+        return None, (etag, 'resp:' + digest if store else None)
+
+    def complete(self, entry, result):
+        etag, key = entry
+        if isinstance(result, tuple) and len(result) == 2 and result[1] == 200:
+            if key is None:
+                return result[0], 200, {'ETag': etag}
+            # A response read from a replica may predate a write whose
+            # invalidation it was keyed after; keep it no longer than the
+            # replica is allowed to lag.
+            ttl = min(self.ttl, replica_router.max_lag) if replica_router.replica_read() else self.ttl
+            try:
+                self.backend.set(key, result[0], ttl)
+            except Exception:
+                log.exception('Response cache store failed')
+            return result[0], 200, {'X-Cache': 'MISS', 'ETag': etag}
+        return result
+
+
+def bump_versions(session, keys):
+    # One upsert executemany on PostgreSQL and SQLite, in key order so that
+    # concurrent writers lock shared tags in the same order.
+    now = datetime.utcnow()
+    dialect = session.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        stmt = insert(CacheVersion)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['tag'],
+            set_={'version': CacheVersion.__table__.c.version + 1, 'bumped_at': stmt.excluded.bumped_at}
+        )
+        session.execute(stmt, [{'tag': key, 'version': 1, 'bumped_at': now} for key in keys])
+        return
+
+    for key in keys:
+        row = session.query(CacheVersion).filter_by(tag=key).with_for_update().first()
+        if row is None:
+            session.add(CacheVersion(tag=key, version=1, bumped_at=now))
+        else:
+            row.version += 1
+            row.bumped_at = now
+
+
+response_cache = ResponseCache()
+
+
+def own_tags(kind):
+    # For lists of the caller's own items, supply requests, ...: one tag
+    # per account, bumped by item_tags() and friends below.
+    return lambda principal: [(kind, principal.role, principal.id)]
+
+
+def item_tags(clerk_id, admin_id, merchant_id):
+    # Everything derived from a scope's items (the item list and the
+    # reports) for each of the three accounts that can see them.
+    return [('items', 'clerks', clerk_id), ('items', 'admins', admin_id), ('items', 'merchants', merchant_id)]
+
+
+def supply_request_tags(clerk_id, admin_id, merchant_id):
+    return [('supply_requests', 'clerks', clerk_id), ('supply_requests', 'admins', admin_id),
+            ('supply_requests', 'merchants', merchant_id)]
+
+
+def user_list_tag(user):
+    # Merchants list their admins and admins their clerks.
+    if user.__tablename__ == 'admins':
+        return ('users', 'merchants', user.merchant_id)
+    return ('users', 'admins', user.admin_id)
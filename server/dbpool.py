@@ -0,0 +1,228 @@
+import bisect
+import os
+import threading
+import time
+from sqlalchemy import event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+
+# Async drivers used by the ASGI app (asgi.py) for each backend.
+ASYNC_DRIVERS = {'postgresql': 'asyncpg', 'sqlite': 'aiosqlite'}
+
+# Upper bounds, in seconds, of the checkout wait histogram buckets.
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class PoolStats:
+    # Checkout counters for one named pool in this process. They outlive the
+    # pool object itself, which SQLAlchemy replaces on engine.dispose().
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.buckets = [0] * (len(WAIT_BUCKETS) + 1)
+        self.wait_sum = 0.0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.pool = None
+
+    def observe(self, seconds):
+        with self._lock:
+            self.buckets[bisect.bisect_left(WAIT_BUCKETS, seconds)] += 1
+            self.wait_sum += seconds
+            self.checkouts += 1
+
+    def count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def snapshot(self):
+        pool = self.pool
+        with self._lock:
+            cumulative, total = {}, 0
+            for bound, n in zip(WAIT_BUCKETS + (float('inf'),), self.buckets):
+                total += n
+                cumulative['+Inf' if bound == float('inf') else str(bound)] = total
+            result = {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "connects": self.connects,
+                "invalidations": self.invalidations,
+                "wait_seconds_sum": round(self.wait_sum, 6),
+                "wait_seconds_buckets": cumulative,
+            }
+        if isinstance(pool, QueuePool):
+            result.update({
+                "class": "QueuePool",
+                "size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "checked_in": pool.checkedin(),
+                # overflow() counts from -size up; only positive values are
+                # connections beyond pool_size.
+                "overflow": max(pool.overflow(), 0),
+                "max_overflow": pool._max_overflow,
+                "timeout": pool.timeout(),
+            })
+        elif pool is not None:
+            result["class"] = type(pool).__name__
+        return result
+
+
+class PoolRegistry:
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            return self._stats.setdefault(name, PoolStats())
+
+    def snapshot(self):
+        with self._lock:
+            names = list(self._stats)
+        return {name: self.get(name).snapshot() for name in names}
+
+
+pool_stats = PoolRegistry()
+
+
+class InstrumentedPool:
+    # Times every checkout: the wait for a free connection, the pre-ping and,
+    # when the pool has to open one, the connect. Stats are filed under the
+    # pool's logging name (the engine's pool_logging_name).
+    def connect(self):
+        stats = pool_stats.get(self.logging_name or 'default')
+        stats.pool = self
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            stats.count('timeouts')
+            raise
+        finally:
+            stats.observe(time.perf_counter() - start)
+
+
+class InstrumentedQueuePool(InstrumentedPool, QueuePool):
+    pass
+
+
+class InstrumentedNullPool(InstrumentedPool, NullPool):
+    pass
+
+
+class InstrumentedAsyncQueuePool(InstrumentedPool, AsyncAdaptedQueuePool):
+    pass
+
+
+def engine_options(config, name='primary'):
+    # SQLALCHEMY_ENGINE_OPTIONS for the configured database. Pool sizes are
+    # per engine and so per worker process: a gunicorn deployment opens up
+    # to workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections.
+    #
+    # With DB_POOLER=pgbouncer the app connects to a local pooler in
+    # transaction mode. The pooler does the pooling, so each checkout opens
+    # a (cheap, local) connection and closes it after use, and nothing may
+    # rely on session state: no server-side prepared statements, and the
+    # statement timeout is set per transaction rather than per connection.
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    options = dict(config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    options.setdefault('pool_logging_name', name)
+    if url.get_backend_name() == 'sqlite':
+        if url.database in (None, '', ':memory:'):
+            return options
+        options.setdefault('poolclass', InstrumentedQueuePool)
+        options.setdefault('pool_size', config['DB_POOL_SIZE'])
+        options.setdefault('max_overflow', config['DB_MAX_OVERFLOW'])
+        options.setdefault('pool_timeout', config['DB_POOL_TIMEOUT'])
+        return options
+
+    connect_args = dict(options.get('connect_args') or {})
+    if config['DB_POOLER'] == 'pgbouncer':
+        options.setdefault('poolclass', InstrumentedNullPool)
+        if url.get_driver_name() == 'psycopg':
+            connect_args.setdefault('prepare_threshold', None)
+    else:
+        options.setdefault('poolclass', InstrumentedQueuePool)
+        options.setdefault('pool_size', config['DB_POOL_SIZE'])
+        options.setdefault('max_overflow', config['DB_MAX_OVERFLOW'])
+        options.setdefault('pool_timeout', config['DB_POOL_TIMEOUT'])
+        options.setdefault('pool_recycle', config['DB_POOL_RECYCLE'])
+        options.setdefault('pool_pre_ping', config['DB_POOL_PRE_PING'])
+        if config['DB_STATEMENT_TIMEOUT_MS'] and url.get_backend_name() == 'postgresql':
+            connect_args.setdefault('options', f"-c statement_timeout={int(config['DB_STATEMENT_TIMEOUT_MS'])}")
+    if connect_args:
+        options['connect_args'] = connect_args
+    return options
+
+
+def async_database_url(config):
+    # ASYNC_DATABASE_URL, or the primary's URL with its backend's async
+    # driver.
+    if config.get('ASYNC_DATABASE_URL'):
+        return make_url(config['ASYNC_DATABASE_URL'])
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver is None:
+        raise RuntimeError(f"No async driver for {url.get_backend_name()}; set ASYNC_DATABASE_URL")
+    return url.set(drivername=f'{url.get_backend_name()}+{driver}')
+
+
+def async_engine_options(config):
+    # The primary's pool settings for the async engine, which keeps its own
+    # pool (and pool stats, as "primary-async") next to the sync one.
+    # asyncpg takes the statement timeout as a server setting, and behind
+    # pgbouncer must not cache prepared statements, neither its own nor
+    # SQLAlchemy's.
+    url = async_database_url(config)
+    options = engine_options(
+        dict(config, SQLALCHEMY_DATABASE_URI=url, SQLALCHEMY_ENGINE_OPTIONS={}), name='primary-async'
+    )
+    if options.get('poolclass') is InstrumentedQueuePool:
+        options['poolclass'] = InstrumentedAsyncQueuePool
+    connect_args = options.pop('connect_args', {})
+    if url.get_driver_name() == 'asyncpg':
+        connect_args = {}
+        if config['DB_POOLER'] == 'pgbouncer':
+            connect_args['statement_cache_size'] = 0
+            connect_args['prepared_statement_cache_size'] = 0
+        elif config['DB_STATEMENT_TIMEOUT_MS']:
+            connect_args['server_settings'] = {'statement_timeout': str(int(config['DB_STATEMENT_TIMEOUT_MS']))}
+    if connect_args:
+        options['connect_args'] = connect_args
+    return url, options
+
+
+def instrument_engine(engine, config):
+    # Counts new and invalidated connections (the pool's own events) and, in
+    # pgbouncer mode, applies the statement timeout.
+    if getattr(engine, '_pool_instrumented', False):
+        return
+    engine._pool_instrumented = True
+    stats = pool_stats.get(engine.pool.logging_name or 'default')
+    stats.pool = engine.pool
+    event.listen(engine, 'connect', lambda dbapi_connection, record: stats.count('connects'))
+    event.listen(engine, 'invalidate', lambda dbapi_connection, record, exception: stats.count('invalidations'))
+    timeout = config['DB_STATEMENT_TIMEOUT_MS']
+    if timeout and config['DB_POOLER'] == 'pgbouncer' and engine.dialect.name == 'postgresql':
+        # SET LOCAL lasts for the transaction, which is all a
+        # transaction-mode pooler guarantees is ours.
+        event.listen(engine, 'begin', lambda conn: conn.exec_driver_sql(
+            f'SET LOCAL statement_timeout = {int(timeout)}'
+        ))
+
+
+def configure_engine(app):
+    # Called before db.init_app, which builds the engine from these options.
+    app.config.setdefault('DB_POOL_SIZE', 5)
+    app.config.setdefault('DB_MAX_OVERFLOW', 10)
+    app.config.setdefault('DB_POOL_TIMEOUT', 30)
+    app.config.setdefault('DB_POOL_RECYCLE', 1800)
+    app.config.setdefault('DB_POOL_PRE_PING', True)
+    app.config.setdefault('DB_STATEMENT_TIMEOUT_MS', 0)
+    app.config.setdefault('DB_POOLER', '')
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+
+
+def pool_status():
+    return {"pid": os.getpid(), "pools": pool_stats.snapshot()}
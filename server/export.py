@@ -0,0 +1,47 @@
+import csv
+import io
+import json
+from datetime import datetime
+from flask import Response, stream_with_context
+from models import db
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+EXPORT_BATCH_SIZE = 1000
+
+
+def _plain(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _ndjson_lines(fields, batch):
+    return ''.join(json.dumps({f: _plain(v) for f, v in zip(fields, row)}) + '\n' for row in batch)
+
+
+def _csv_lines(fields, batch):
+    buf = io.StringIO()
+    csv.writer(buf).writerows([_plain(v) for v in row] for row in batch)
+    return buf.getvalue()
+
+
+def export_response(query, fields, fmt, filename):
+    # yield_per makes the session use a server-side cursor where the driver
+    # supports one, so only one batch of rows is held in memory at a time and
+    # each batch is written to the client before the next is fetched.
+    def generate():
+        if fmt == 'csv':
+            buf = io.StringIO()
+            csv.writer(buf).writerow(fields)
+            yield buf.getvalue()
+        render = _csv_lines if fmt == 'csv' else _ndjson_lines
+        result = db.session.execute(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        for batch in result.partitions():
+            yield render(fields, batch)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype=EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f"attachment; filename={filename}.{fmt}"}
+    )
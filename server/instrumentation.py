@@ -0,0 +1,250 @@
+import bisect
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from cache import response_cache
+from dbpool import pool_status
+from routing import replica_router
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the request histograms: wall and database seconds, and
+# statements per request.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+STATEMENT_CHARS = 500
+
+
+class RequestStats:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.slowest = []
+
+    def observe(self, statement, seconds, keep):
+        self.queries += 1
+        self.db_time += seconds
+        if len(self.slowest) < keep or seconds > self.slowest[-1][0]:
+            self.slowest.append((seconds, statement[:STATEMENT_CHARS]))
+            self.slowest.sort(key=lambda s: s[0], reverse=True)
+            del self.slowest[keep:]
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        counts = self.series.setdefault(labels, [0] * (len(self.buckets) + 1) + [0.0])
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+
+def _labels(**labels):
+    pairs = ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in labels.items()
+    )
+    return '{' + pairs + '}' if pairs else ''
+
+
+def _histogram(lines, name, labels, cumulative, total):
+    # `cumulative` maps each bucket's upper bound, ending with +Inf, to the
+    # observations at or under it, as dbpool's snapshots do.
+    for bound, n in cumulative.items():
+        lines.append(f'{name}_bucket{_labels(**labels, le=bound)} {n}')
+    lines.append(f'{name}_sum{_labels(**labels)} {total}')
+    lines.append(f'{name}_count{_labels(**labels)} {cumulative["+Inf"]}')
+
+
+class Instrumentation:
+    # Opt-in (INSTRUMENTATION) per-request measurements for this worker.
+    #
+    # Every statement on any engine (primary, replicas, the ASGI engine) run
+    # inside a request is timed through SQLAlchemy's cursor events. Each
+    # response gets a Server-Timing header with the request's total and
+    # database time and its statement count. The same figures feed the
+    # request counters and histograms served by /metrics, per endpoint,
+    # together with the response cache, connection pool and replica
+    # figures. The slowest statements seen per endpoint are kept for
+    # /health/queries.
+    #
+    # With PROFILE_SAMPLE_PERCENT set, that share of requests also runs
+    # under cProfile and leaves a .prof file in PROFILE_DIR (pstats or
+    # snakeviz can read it). Only the WSGI path is profiled: the async
+    # handlers (asgi.py) span more than one thread.
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._durations = Histogram(DURATION_BUCKETS)
+        self._db_durations = Histogram(DURATION_BUCKETS)
+        self._queries = Histogram(QUERY_BUCKETS)
+        self._slowest = {}
+
+    def init_app(self, app):
+        app.config.setdefault('INSTRUMENTATION', False)
+        app.config.setdefault('INSTRUMENTATION_SLOW_QUERIES', 5)
+        app.config.setdefault('PROFILE_SAMPLE_PERCENT', 0)
+        app.config.setdefault('PROFILE_DIR', None)
+        app.config.setdefault('METRICS_TOKEN', None)
+        self.enabled = app.config['INSTRUMENTATION']
+        self.keep = app.config['INSTRUMENTATION_SLOW_QUERIES']
+        self.sample_percent = app.config['PROFILE_SAMPLE_PERCENT']
+        self.profile_dir = app.config['PROFILE_DIR'] or os.path.join(app.instance_path, 'profiles')
+        app.extensions['instrumentation'] = self
+        if not self.enabled:
+            return
+        if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.teardown_request(self._teardown)
+
+    def _start(self):
+        g._request_stats = RequestStats()
+        if self.sample_percent and random.random() * 100 < self.sample_percent \
+                and not request.environ.get('myduka.async'):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler is already running on this thread.
+                return
+            g._profiler = profiler
+
+    def _finish(self, response):
+        stats = g.pop('_request_stats', None)
+        if stats is None:
+            return response
+        wall = time.perf_counter() - stats.start
+        endpoint = request.endpoint or 'unmatched'
+        profiler = g.pop('_profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            self._dump(profiler, endpoint, wall)
+        response.headers['Server-Timing'] = (
+            f'total;dur={wall * 1000:.1f}, db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries"'
+        )
+        with self._lock:
+            key = (endpoint, request.method, response.status_code)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            self._durations.observe(endpoint, wall)
+            self._db_durations.observe(endpoint, stats.db_time)
+            self._queries.observe(endpoint, stats.queries)
+            if stats.slowest:
+                slowest = self._slowest.get(endpoint, []) + stats.slowest
+                slowest.sort(key=lambda s: s[0], reverse=True)
+                self._slowest[endpoint] = slowest[:self.keep]
+        return response
+
+    def _teardown(self, exc):
+        # A request that failed before after_request ran.
+        g.pop('_request_stats', None)
+        profiler = g.pop('_profiler', None)
+        if profiler is not None:
+            profiler.disable()
+
+    def _dump(self, profiler, endpoint, wall):
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            name = f'{datetime.utcnow():%Y%m%dT%H%M%S}-{endpoint}-{os.getpid()}-{wall * 1000:.0f}ms.prof'
+            profiler.dump_stats(os.path.join(self.profile_dir, name))
+        except OSError:
+            log.exception('Could not write request profile')
+
+    def slowest_statements(self):
+        with self._lock:
+            return {
+                endpoint: [{"seconds": round(seconds, 6), "statement": statement} for seconds, statement in slowest]
+                for endpoint, slowest in self._slowest.items()
+            }
+
+    def render(self):
+        # Prometheus text exposition format, version 0.0.4.
+        lines = []
+        with self._lock:
+            requests = dict(self._requests)
+            histograms = [
+                ('myduka_request_duration_seconds', 'Request wall time.', self._durations),
+                ('myduka_request_db_seconds', 'Time spent in database statements per request.', self._db_durations),
+                ('myduka_request_queries', 'Database statements per request.', self._queries),
+            ]
+            series = [(name, help, h.buckets, dict((k, list(v)) for k, v in h.series.items()))
+                      for name, help, h in histograms]
+
+        lines += ['# HELP myduka_requests_total Requests handled.', '# TYPE myduka_requests_total counter']
+        for (endpoint, method, status), n in sorted(requests.items()):
+            lines.append(f'myduka_requests_total{_labels(endpoint=endpoint, method=method, status=status)} {n}')
+        for name, help, buckets, by_endpoint in series:
+            lines += [f'# HELP {name} {help}', f'# TYPE {name} histogram']
+            for endpoint, counts in sorted(by_endpoint.items()):
+                cumulative, total = {}, 0
+                for bound, n in zip([str(b) for b in buckets] + ['+Inf'], counts):
+                    total += n
+                    cumulative[bound] = total
+                _histogram(lines, name, {'endpoint': endpoint}, cumulative, round(counts[-1], 6))
+
+        cache = response_cache.stats()
+        lines += ['# HELP myduka_response_cache_entries Entries in the response cache backend.',
+                  '# TYPE myduka_response_cache_entries gauge',
+                  f'myduka_response_cache_entries{_labels(backend=cache["backend"])} {cache["entries"]}',
+                  '# HELP myduka_response_cache_events_total Response cache lookups and invalidations.',
+                  '# TYPE myduka_response_cache_events_total counter']
+        for endpoint, counts in sorted(cache['endpoints'].items(), key=lambda e: str(e[0])):
+            for outcome, n in sorted(counts.items()):
+                lines.append(f'myduka_response_cache_events_total{_labels(endpoint=endpoint, outcome=outcome)} {n}')
+
+        pools = pool_status()['pools']
+        for field, help in (('checkouts', 'Connection checkouts.'), ('timeouts', 'Checkouts that timed out.'),
+                            ('connects', 'New database connections.'),
+                            ('invalidations', 'Connections invalidated.')):
+            lines += [f'# HELP myduka_db_pool_{field}_total {help}', f'# TYPE myduka_db_pool_{field}_total counter']
+            lines += [f'myduka_db_pool_{field}_total{_labels(pool=pool)} {s[field]}' for pool, s in sorted(pools.items())]
+        for field, help in (('checked_out', 'Connections in use.'), ('overflow', 'Connections beyond pool_size.'),
+                            ('size', 'Configured pool_size.')):
+            lines += [f'# HELP myduka_db_pool_{field} {help}', f'# TYPE myduka_db_pool_{field} gauge']
+            lines += [f'myduka_db_pool_{field}{_labels(pool=pool)} {s[field]}'
+                      for pool, s in sorted(pools.items()) if field in s]
+        lines += ['# HELP myduka_db_pool_wait_seconds Time to check out a connection.',
+                  '# TYPE myduka_db_pool_wait_seconds histogram']
+        for pool, s in sorted(pools.items()):
+            _histogram(lines, 'myduka_db_pool_wait_seconds', {'pool': pool},
+                       s['wait_seconds_buckets'], s['wait_seconds_sum'])
+
+        replicas = replica_router.status()
+        lines += ['# HELP myduka_replica_healthy Whether the read replica passed its last check.',
+                  '# TYPE myduka_replica_healthy gauge']
+        lines += [f'myduka_replica_healthy{_labels(bind=r["bind"])} {int(r["healthy"])}' for r in replicas]
+        lines += ['# HELP myduka_replica_lag_seconds Replica lag at its last check.',
+                  '# TYPE myduka_replica_lag_seconds gauge']
+        lines += [f'myduka_replica_lag_seconds{_labels(bind=r["bind"])} {r["lag_seconds"]}'
+                  for r in replicas if r['lag_seconds'] is not None]
+        return '\n'.join(lines) + '\n'
+
+
+instrumentation = Instrumentation()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and '_request_stats' in g:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start')
+    if starts and has_request_context():
+        stats = g.get('_request_stats')
+        seconds = time.perf_counter() - starts.pop()
+        if stats is not None:
+            stats.observe(statement, seconds, instrumentation.keep)
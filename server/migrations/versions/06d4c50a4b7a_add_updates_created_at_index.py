@@ -0,0 +1,24 @@
+"""add updates created_at index
+
+Revision ID: 06d4c50a4b7a
+Revises: b5e980452454
+Create Date: 2026-10-18 09:39:32.757971
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '06d4c50a4b7a'
+down_revision = 'b5e980452454'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_updates_created_at', 'updates', ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_updates_created_at', table_name='updates')
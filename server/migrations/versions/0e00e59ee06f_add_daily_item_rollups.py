@@ -0,0 +1,42 @@
+"""add daily item rollups
+
+Revision ID: 0e00e59ee06f
+Revises: 36d134af2e13
+Create Date: 2026-10-18 09:40:12.482113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0e00e59ee06f'
+down_revision = '36d134af2e13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('daily_item_rollups',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('store_id', sa.Integer(), nullable=False),
+    sa.Column('clerk_id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('item_count', sa.Integer(), nullable=False),
+    sa.Column('quantity_received', sa.Integer(), nullable=False),
+    sa.Column('quantity_in_stock', sa.Integer(), nullable=False),
+    sa.Column('quantity_spoilt', sa.Integer(), nullable=False),
+    sa.Column('paid_items', sa.Integer(), nullable=False),
+    sa.Column('unpaid_items', sa.Integer(), nullable=False),
+    sa.Column('buying_value', sa.Float(), nullable=False),
+    sa.Column('selling_value', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['clerk_id'], ['clerks.id'], ),
+    sa.ForeignKeyConstraint(['store_id'], ['stores.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('store_id', 'clerk_id', 'day')
+    )
+    # Populate with `flask rollups backfill` once the table exists.
+
+
+def downgrade():
+    op.drop_table('daily_item_rollups')
@@ -0,0 +1,29 @@
+"""add cache versions
+
+Revision ID: 4f2a9c7d1e30
+Revises: dfdd53fd9e5e
+Create Date: 2026-10-18 11:02:13.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4f2a9c7d1e30'
+down_revision = 'dfdd53fd9e5e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('cache_versions',
+    sa.Column('tag', sa.String(length=200), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('bumped_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('tag')
+    )
+
+
+def downgrade():
+    op.drop_table('cache_versions')
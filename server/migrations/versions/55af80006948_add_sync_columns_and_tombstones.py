@@ -0,0 +1,54 @@
+"""add sync columns and tombstones
+
+Revision ID: 55af80006948
+Revises: 06d4c50a4b7a
+Create Date: 2026-10-18 09:44:37.973639
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '55af80006948'
+down_revision = '06d4c50a4b7a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('deleted_records',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('table_name', sa.String(length=50), nullable=False),
+    sa.Column('record_id', sa.Integer(), nullable=False),
+    sa.Column('store_id', sa.Integer(), nullable=False),
+    sa.Column('clerk_id', sa.Integer(), nullable=False),
+    sa.Column('deleted_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_deleted_records_store_id_deleted_at', 'deleted_records', ['store_id', 'deleted_at'], unique=False)
+    op.create_index('ix_deleted_records_clerk_id_deleted_at', 'deleted_records', ['clerk_id', 'deleted_at'], unique=False)
+
+    op.add_column('items', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    op.add_column('supply_requests', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    # Existing rows have not changed since they were created.
+    op.execute('UPDATE items SET updated_at = created_at')
+    op.execute('UPDATE supply_requests SET updated_at = requested_at')
+    op.create_index('ix_items_store_id_updated_at', 'items', ['store_id', 'updated_at'], unique=False)
+    op.create_index('ix_items_clerk_id_updated_at', 'items', ['clerk_id', 'updated_at'], unique=False)
+    op.create_index('ix_supply_requests_store_id_updated_at', 'supply_requests', ['store_id', 'updated_at'], unique=False)
+    op.create_index('ix_supply_requests_clerk_id_updated_at', 'supply_requests', ['clerk_id', 'updated_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_supply_requests_clerk_id_updated_at', table_name='supply_requests')
+    op.drop_index('ix_supply_requests_store_id_updated_at', table_name='supply_requests')
+    op.drop_index('ix_items_clerk_id_updated_at', table_name='items')
+    op.drop_index('ix_items_store_id_updated_at', table_name='items')
+    with op.batch_alter_table('supply_requests', schema=None) as batch_op:
+        batch_op.drop_column('updated_at')
+    with op.batch_alter_table('items', schema=None) as batch_op:
+        batch_op.drop_column('updated_at')
+    op.drop_index('ix_deleted_records_clerk_id_deleted_at', table_name='deleted_records')
+    op.drop_index('ix_deleted_records_store_id_deleted_at', table_name='deleted_records')
+    op.drop_table('deleted_records')
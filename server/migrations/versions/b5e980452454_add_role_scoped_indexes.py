@@ -0,0 +1,50 @@
+"""add role scoped indexes
+
+Revision ID: b5e980452454
+Revises: 0e00e59ee06f
+Create Date: 2026-10-18 10:05:47.913360
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5e980452454'
+down_revision = '0e00e59ee06f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_admins_merchant_id', 'admins', ['merchant_id'], unique=False)
+    op.create_index('ix_stores_merchant_id', 'stores', ['merchant_id'], unique=False)
+    op.create_index('ix_clerks_admin_id', 'clerks', ['admin_id'], unique=False)
+    op.create_index('ix_clerks_store_id', 'clerks', ['store_id'], unique=False)
+    op.create_index('ix_items_store_id_created_at', 'items', ['store_id', 'created_at'], unique=False)
+    op.create_index('ix_items_clerk_id_created_at', 'items', ['clerk_id', 'created_at'], unique=False)
+    op.create_index('ix_supply_requests_store_id_status', 'supply_requests', ['store_id', 'status'], unique=False)
+    op.create_index('ix_supply_requests_clerk_id_status', 'supply_requests', ['clerk_id', 'status'], unique=False)
+    op.create_index('ix_updates_merchant_id_created_at', 'updates', ['merchant_id', 'created_at'], unique=False)
+    op.create_index('ix_updates_admin_id_created_at', 'updates', ['admin_id', 'created_at'], unique=False)
+    op.create_index('ix_updates_clerk_id_created_at', 'updates', ['clerk_id', 'created_at'], unique=False)
+    op.create_index('ix_updates_item_id', 'updates', ['item_id'], unique=False)
+    op.create_index('ix_updates_supply_request_id', 'updates', ['supply_request_id'], unique=False)
+    op.create_index('ix_daily_item_rollups_clerk_id_day', 'daily_item_rollups', ['clerk_id', 'day'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_daily_item_rollups_clerk_id_day', table_name='daily_item_rollups')
+    op.drop_index('ix_updates_supply_request_id', table_name='updates')
+    op.drop_index('ix_updates_item_id', table_name='updates')
+    op.drop_index('ix_updates_clerk_id_created_at', table_name='updates')
+    op.drop_index('ix_updates_admin_id_created_at', table_name='updates')
+    op.drop_index('ix_updates_merchant_id_created_at', table_name='updates')
+    op.drop_index('ix_supply_requests_clerk_id_status', table_name='supply_requests')
+    op.drop_index('ix_supply_requests_store_id_status', table_name='supply_requests')
+    op.drop_index('ix_items_clerk_id_created_at', table_name='items')
+    op.drop_index('ix_items_store_id_created_at', table_name='items')
+    op.drop_index('ix_clerks_store_id', table_name='clerks')
+    op.drop_index('ix_clerks_admin_id', table_name='clerks')
+    op.drop_index('ix_stores_merchant_id', table_name='stores')
+    op.drop_index('ix_admins_merchant_id', table_name='admins')
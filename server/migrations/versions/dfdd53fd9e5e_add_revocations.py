@@ -0,0 +1,35 @@
+"""add revocations
+
+Revision ID: dfdd53fd9e5e
+Revises: 55af80006948
+Create Date: 2026-10-18 09:49:46.129976
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'dfdd53fd9e5e'
+down_revision = '55af80006948'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('revocations',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('jti', sa.String(length=36), nullable=True),
+    sa.Column('role', sa.String(length=20), nullable=True),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('not_before', sa.DateTime(), nullable=True),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_revocations_created_at', 'revocations', ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_revocations_created_at', table_name='revocations')
+    op.drop_table('revocations')
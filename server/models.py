@@ -1,11 +1,9 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
-import hashlib
+from passwords import hash_password
+from routing import RoutingSession
 
-db = SQLAlchemy()
-
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 class Merchant(db.Model):
     __tablename__ = 'merchants'
@@ -28,7 +26,7 @@ class Admin(db.Model):
     password = db.Column(db.String(120), nullable=False)
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    merchant_id = db.Column(db.Integer, db.ForeignKey('merchants.id'), nullable=False)
+    merchant_id = db.Column(db.Integer, db.ForeignKey('merchants.id'), nullable=False, index=True)
     clerks = db.relationship('Clerk', backref='admin', lazy=True)
     updates = db.relationship('Update', backref='admin', lazy=True)
 
@@ -42,8 +40,8 @@ class Clerk(db.Model):
     password = db.Column(db.String(120), nullable=False)
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    admin_id = db.Column(db.Integer, db.ForeignKey('admins.id'), nullable=False)
-    store_id = db.Column(db.Integer, db.ForeignKey('stores.id'), nullable=False)
+    admin_id = db.Column(db.Integer, db.ForeignKey('admins.id'), nullable=False, index=True)
+    store_id = db.Column(db.Integer, db.ForeignKey('stores.id'), nullable=False, index=True)
     items = db.relationship('Item', backref='clerk', lazy=True)
     supply_requests = db.relationship('SupplyRequest', backref='clerk', lazy=True)
     updates = db.relationship('Update', backref='clerk', lazy=True)
@@ -55,7 +53,7 @@ class Store(db.Model):
     __tablename__ = 'stores'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
-    merchant_id = db.Column(db.Integer, db.ForeignKey('merchants.id'), nullable=False)
+    merchant_id = db.Column(db.Integer, db.ForeignKey('merchants.id'), nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     items = db.relationship('Item', backref='store', lazy=True)
     clerks = db.relationship('Clerk', backref='store', lazy=True)
@@ -72,10 +70,18 @@ class Item(db.Model):
     selling_price = db.Column(db.Float, nullable=False)
     payment_status = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    received_at = db.synonym('created_at')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     store_id = db.Column(db.Integer, db.ForeignKey('stores.id'), nullable=False)
     clerk_id = db.Column(db.Integer, db.ForeignKey('clerks.id'), nullable=False)
     supply_requests = db.relationship('SupplyRequest', backref='item', lazy=True)
     updates = db.relationship('Update', backref='item', lazy=True)
+    __table_args__ = (
+        db.Index('ix_items_store_id_created_at', 'store_id', 'created_at'),
+        db.Index('ix_items_clerk_id_created_at', 'clerk_id', 'created_at'),
+        db.Index('ix_items_store_id_updated_at', 'store_id', 'updated_at'),
+        db.Index('ix_items_clerk_id_updated_at', 'clerk_id', 'updated_at'),
+    )
 
 class SupplyRequest(db.Model):
     __tablename__ = 'supply_requests'
@@ -86,6 +92,13 @@ class SupplyRequest(db.Model):
     quantity = db.Column(db.Integer, nullable=False)
     status = db.Column(db.String(50), default='pending')
     requested_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_supply_requests_store_id_status', 'store_id', 'status'),
+        db.Index('ix_supply_requests_clerk_id_status', 'clerk_id', 'status'),
+        db.Index('ix_supply_requests_store_id_updated_at', 'store_id', 'updated_at'),
+        db.Index('ix_supply_requests_clerk_id_updated_at', 'clerk_id', 'updated_at'),
+    )
 
 class Update(db.Model):
     __tablename__ = 'updates'
@@ -95,6 +108,68 @@ class Update(db.Model):
     merchant_id = db.Column(db.Integer, db.ForeignKey('merchants.id'))
     admin_id = db.Column(db.Integer, db.ForeignKey('admins.id'))
     clerk_id = db.Column(db.Integer, db.ForeignKey('clerks.id'))
-    item_id = db.Column(db.Integer, db.ForeignKey('items.id'))
-    supply_request_id = db.Column(db.Integer, db.ForeignKey('supply_requests.id'))
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
\ No newline at end of file
+    item_id = db.Column(db.Integer, db.ForeignKey('items.id'), index=True)
+    supply_request_id = db.Column(db.Integer, db.ForeignKey('supply_requests.id'), index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_updates_created_at', 'created_at'),
+        db.Index('ix_updates_merchant_id_created_at', 'merchant_id', 'created_at'),
+        db.Index('ix_updates_admin_id_created_at', 'admin_id', 'created_at'),
+        db.Index('ix_updates_clerk_id_created_at', 'clerk_id', 'created_at'),
+    )
+
+class DeletedRecord(db.Model):
+    # Tombstones for GET /sync: one row per deleted item or supply request,
+    # kept long enough for offline devices to learn about the deletion.
+    __tablename__ = 'deleted_records'
+    id = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(50), nullable=False)
+    record_id = db.Column(db.Integer, nullable=False)
+    store_id = db.Column(db.Integer, nullable=False)
+    clerk_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_deleted_records_store_id_deleted_at', 'store_id', 'deleted_at'),
+        db.Index('ix_deleted_records_clerk_id_deleted_at', 'clerk_id', 'deleted_at'),
+    )
+
+class Revocation(db.Model):
+    # Revoked JWTs, see revocation.py: either a single token (jti) or every
+    # token an account was issued before not_before. A row is only needed
+    # until expires_at, when every token it covers has expired anyway.
+    __tablename__ = 'revocations'
+    id = db.Column(db.Integer, primary_key=True)
+    jti = db.Column(db.String(36))
+    role = db.Column(db.String(20))
+    user_id = db.Column(db.Integer)
+    not_before = db.Column(db.DateTime)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+class CacheVersion(db.Model):
+    # Per-scope version counters behind the response cache keys and ETags
+    # (cache.py), bumped in the transaction of every write that can change
+    # what the scope's responses show.
+    __tablename__ = 'cache_versions'
+    tag = db.Column(db.String(200), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    bumped_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class DailyItemRollup(db.Model):
+    __tablename__ = 'daily_item_rollups'
+    id = db.Column(db.Integer, primary_key=True)
+    store_id = db.Column(db.Integer, db.ForeignKey('stores.id'), nullable=False)
+    clerk_id = db.Column(db.Integer, db.ForeignKey('clerks.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    item_count = db.Column(db.Integer, nullable=False, default=0)
+    quantity_received = db.Column(db.Integer, nullable=False, default=0)
+    quantity_in_stock = db.Column(db.Integer, nullable=False, default=0)
+    quantity_spoilt = db.Column(db.Integer, nullable=False, default=0)
+    paid_items = db.Column(db.Integer, nullable=False, default=0)
+    unpaid_items = db.Column(db.Integer, nullable=False, default=0)
+    buying_value = db.Column(db.Float, nullable=False, default=0)  # buying_price * quantity_received
+    selling_value = db.Column(db.Float, nullable=False, default=0)  # selling_price * quantity_in_stock
+    __table_args__ = (
+        db.UniqueConstraint('store_id', 'clerk_id', 'day'),
+        db.Index('ix_daily_item_rollups_clerk_id_day', 'clerk_id', 'day'),
+    )
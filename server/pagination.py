@@ -0,0 +1,44 @@
+import base64
+import json
+from datetime import datetime
+from sqlalchemy import and_, or_
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(created_at, id):
+    raw = json.dumps([created_at.isoformat() if created_at else None, id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        created_at, id = json.loads(raw)
+        return (datetime.fromisoformat(created_at) if created_at else None), int(id)
+    except (ValueError, TypeError):
+        raise InvalidCursor(token)
+
+
+def parse_limit(args):
+    return min(max(args.get('limit', DEFAULT_LIMIT, type=int), 1), MAX_LIMIT)
+
+
+def keyset_after(created_column, id_column, cursor):
+    # Newest first: the next page holds rows strictly older than the cursor,
+    # with the id breaking ties between rows sharing a timestamp.
+    created_at, id = cursor
+    return or_(created_column < created_at, and_(created_column == created_at, id_column < id))
+
+
+def keyset_page(rows, limit, created_attr, id_attr='id'):
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(getattr(last, created_attr), getattr(last, id_attr))
@@ -0,0 +1,224 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+# Stored hashes are versioned by their prefix:
+#   scrypt$<n>$<r>$<p>$<salt>$<key>   current format, base64 salt and key
+#   <64 hex digits>                   legacy unsalted SHA-256
+# A hash in an older format, or scrypt with other parameters than the
+# configured ones, verifies as before and is flagged for rehash so the login
+# that proves the password can upgrade it.
+SCRYPT_PREFIX = 'scrypt'
+DEFAULT_SCRYPT_N = 2 ** 14
+DEFAULT_SCRYPT_R = 8
+DEFAULT_SCRYPT_P = 1
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+
+class PasswordBusy(Exception):
+    pass
+
+
+def _b64(raw):
+    return base64.b64encode(raw).decode().rstrip('=')
+
+
+def _unb64(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, dklen=KEY_BYTES, maxmem=256 * n * r + (1 << 20))
+
+
+class VerificationCache:
+    # Remembers recent successful verifications as HMACs of (stored hash,
+    # password) under a key that only lives in this process, so a user
+    # logging in again within the TTL skips the KDF. Failures are never
+    # cached, and a changed stored hash misses by construction.
+    def __init__(self):
+        self._key = secrets.token_bytes(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _digest(self, password, stored):
+        return hmac.new(self._key, f'{stored}\0{password}'.encode(), hashlib.sha256).digest()
+
+    def hit(self, password, stored):
+        digest = self._digest(password, stored)
+        with self._lock:
+            expires = self._entries.get(digest)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self._entries[digest]
+                return False
+            self._entries.move_to_end(digest)
+            return True
+
+    def add(self, password, stored, ttl, max_size):
+        digest = self._digest(password, stored)
+        with self._lock:
+            self._entries[digest] = time.monotonic() + ttl
+            self._entries.move_to_end(digest)
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
+
+
+class Passwords:
+    # Hashing and verification run on a small thread pool (hashlib.scrypt
+    # releases the GIL) sized to the cores available. At most
+    # PASSWORD_MAX_PENDING verifications may be running or queued; beyond
+    # that PasswordBusy is raised at once, so a burst of logins is turned
+    # away with 503 instead of queueing behind each other and tying up every
+    # request thread. So is one still waiting for its result after
+    # PASSWORD_TIMEOUT seconds. Without init_app (scripts, the seed)
+    # everything runs inline.
+    def __init__(self):
+        self.n, self.r, self.p = DEFAULT_SCRYPT_N, DEFAULT_SCRYPT_R, DEFAULT_SCRYPT_P
+        self.cache_ttl = 0
+        self.cache_size = 0
+        self.timeout = None
+        self._pool = None
+        self._slots = None
+        self.cache = VerificationCache()
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_SCRYPT_N', DEFAULT_SCRYPT_N)
+        app.config.setdefault('PASSWORD_SCRYPT_R', DEFAULT_SCRYPT_R)
+        app.config.setdefault('PASSWORD_SCRYPT_P', DEFAULT_SCRYPT_P)
+        app.config.setdefault('PASSWORD_WORKERS', os.cpu_count() or 1)
+        app.config.setdefault('PASSWORD_MAX_PENDING', 4 * (os.cpu_count() or 1))
+        app.config.setdefault('PASSWORD_TIMEOUT', 5.0)
+        app.config.setdefault('PASSWORD_CACHE_TTL', 300)
+        app.config.setdefault('PASSWORD_CACHE_SIZE', 10000)
+        self.n = app.config['PASSWORD_SCRYPT_N']
+        self.r = app.config['PASSWORD_SCRYPT_R']
+        self.p = app.config['PASSWORD_SCRYPT_P']
+        self.timeout = app.config['PASSWORD_TIMEOUT']
+        self.cache_ttl = app.config['PASSWORD_CACHE_TTL']
+        self.cache_size = app.config['PASSWORD_CACHE_SIZE']
+        # Sized for this app even if another in the process set up its own
+        # before. Checks already running on the old pool finish there and
+        # free their slots in the old semaphore.
+        old, self._pool = self._pool, ThreadPoolExecutor(app.config['PASSWORD_WORKERS'], thread_name_prefix='passwords')
+        self._slots = threading.BoundedSemaphore(app.config['PASSWORD_MAX_PENDING'])
+        if old is not None:
+            old.shutdown(wait=False)
+        app.extensions['passwords'] = self
+
+    def _run(self, fn, *args):
+        pool, slots = self._pool, self._slots
+        if pool is None:
+            return fn(*args)
+        if not slots.acquire(blocking=False):
+            raise PasswordBusy()
+        try:
+            future = pool.submit(fn, *args)
+        except Exception:
+            slots.release()
+            raise
+        future.add_done_callback(lambda f: slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            # The pool is too far behind; the work finishes in the
+            # background and frees its slot then.
+            raise PasswordBusy()
+
+    async def _run_async(self, fn, *args):
+        # _run for the ASGI handlers: the same pool and slots, but the event
+        # loop awaits the result instead of a thread blocking on it.
+        pool, slots = self._pool, self._slots
+        if pool is None:
+            return await asyncio.to_thread(fn, *args)
+        if not slots.acquire(blocking=False):
+            raise PasswordBusy()
+        try:
+            future = pool.submit(fn, *args)
+        except Exception:
+            slots.release()
+            raise
+        future.add_done_callback(lambda f: slots.release())
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            # As in _run, the work finishes in the background.
+            raise PasswordBusy()
+
+    def _hash(self, password):
+        salt = secrets.token_bytes(SALT_BYTES)
+        key = _scrypt(password, salt, self.n, self.r, self.p)
+        return f'{SCRYPT_PREFIX}${self.n}${self.r}${self.p}${_b64(salt)}${_b64(key)}'
+
+    def _verify(self, password, stored):
+        # A stored hash that cannot be parsed matches no password.
+        if stored.startswith(SCRYPT_PREFIX + '$'):
+            try:
+                _, n, r, p, salt, key = stored.split('$')
+                n, r, p = int(n), int(r), int(p)
+                ok = hmac.compare_digest(_scrypt(password, _unb64(salt), n, r, p), _unb64(key))
+            except ValueError:
+                return False, False
+            return ok, (n, r, p) != (self.n, self.r, self.p)
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        try:
+            return hmac.compare_digest(legacy, stored), True
+        except TypeError:
+            # Not ASCII, so not a hex digest either.
+            return False, False
+
+    def hash(self, password):
+        return self._run(self._hash, password)
+
+    def verify(self, password, stored):
+        # Returns (matches, needs_rehash).
+        if self.cache_ttl and self.cache.hit(password, stored):
+            return True, False
+        ok, needs_rehash = self._run(self._verify, password, stored)
+        if ok and not needs_rehash and self.cache_ttl:
+            self.cache.add(password, stored, self.cache_ttl, self.cache_size)
+        return ok, needs_rehash
+
+    async def hash_async(self, password):
+        return await self._run_async(self._hash, password)
+
+    async def verify_async(self, password, stored):
+        if self.cache_ttl and self.cache.hit(password, stored):
+            return True, False
+        ok, needs_rehash = await self._run_async(self._verify, password, stored)
+        if ok and not needs_rehash and self.cache_ttl:
+            self.cache.add(password, stored, self.cache_ttl, self.cache_size)
+        return ok, needs_rehash
+
+    async def dummy_verify_async(self, password):
+        await self._run_async(self._verify, password, self._dummy())
+
+    def dummy_verify(self, password):
+        # Spends the same work as a real check, so an unknown email takes
+        # as long to reject as a wrong password.
+        self._run(self._verify, password, self._dummy())
+
+    def _dummy(self):
+        dummy = getattr(self, '_dummy_hash', None)
+        if dummy is None or not dummy.startswith(f'{SCRYPT_PREFIX}${self.n}${self.r}${self.p}$'):
+            dummy = self._dummy_hash = self._hash(secrets.token_hex(16))
+        return dummy
+
+
+passwords = Passwords()
+
+
+def hash_password(password):
+    # For set_password: registrations and password changes are rare enough
+    # to hash on the request thread rather than compete with logins for
+    # pool slots.
+    return passwords._hash(password)
@@ -0,0 +1,148 @@
+import threading
+import time
+from collections import namedtuple
+from flask import current_app, g
+from flask_jwt_extended import get_jwt, get_jwt_identity
+from sqlalchemy import select
+from models import Admin, Clerk, Merchant, Store, db
+
+# The calling account and the ids that decide what it owns. For merchants
+# merchant_id is their own id; admins carry their merchant; clerks carry
+# their admin, store and (through the admin) merchant. store_ids is a
+# merchant's stores as of when their token was issued, or None.
+Principal = namedtuple('Principal', 'id role is_active merchant_id admin_id store_id store_ids', defaults=(None,))
+
+
+class PrincipalCache:
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+    def set(self, key, principal, ttl, max_size):
+        with self._lock:
+            if len(self._entries) >= max_size:
+                now = time.monotonic()
+                self._entries = {k: v for k, v in self._entries.items() if v[0] > now}
+                if len(self._entries) >= max_size:
+                    self._entries.clear()
+            self._entries[key] = (time.monotonic() + ttl, principal)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+principal_cache = PrincipalCache()
+
+
+def query_principal(role, user_id):
+    if role == 'merchants':
+        row = db.session.execute(
+            select(Merchant.id, Merchant.is_active).where(Merchant.id == user_id)
+        ).first()
+        return row and Principal(row.id, role, row.is_active, row.id, None, None)
+    if role == 'admins':
+        row = db.session.execute(
+            select(Admin.id, Admin.is_active, Admin.merchant_id).where(Admin.id == user_id)
+        ).first()
+        return row and Principal(row.id, role, row.is_active, row.merchant_id, row.id, None)
+    if role == 'clerks':
+        row = db.session.execute(
+            select(Clerk.id, Clerk.is_active, Clerk.admin_id, Clerk.store_id, Admin.merchant_id)
+            .join(Admin, Admin.id == Clerk.admin_id)
+            .where(Clerk.id == user_id)
+        ).first()
+        return row and Principal(row.id, role, row.is_active, row.merchant_id, row.admin_id, row.store_id)
+    return None
+
+
+def scope_claims(principal):
+    # Signed into access tokens as the "scope" claim, so requests carrying
+    # the token never have to look the account up. A merchant's store ids
+    # are included while there are at most SCOPE_MAX_STORES of them.
+    store_ids = db.session.scalars(store_ids_query(principal.id)).all() if principal.role == 'merchants' else None
+    return build_scope_claims(principal, store_ids)
+
+
+def store_ids_query(merchant_id):
+    limit = current_app.config.get('SCOPE_MAX_STORES', 50)
+    return select(Store.id).where(Store.merchant_id == merchant_id).order_by(Store.id).limit(limit + 1)
+
+
+def build_scope_claims(principal, store_ids=None):
+    # store_ids: the rows of store_ids_query for a merchant.
+    claims = {
+        'merchant_id': principal.merchant_id,
+        'admin_id': principal.admin_id,
+        'store_id': principal.store_id,
+    }
+    if store_ids is not None and len(store_ids) <= current_app.config.get('SCOPE_MAX_STORES', 50):
+        claims['store_ids'] = list(store_ids)
+    return claims
+
+
+def claimed_principal(identity):
+    # The principal signed into the request's access token, or None for a
+    # token without scope claims. A token is only accepted while its
+    # account is active: deactivating or deleting an account revokes its
+    # tokens (see revocation.py).
+    key = (identity['role'], identity['id'])
+    try:
+        token = get_jwt()
+    except RuntimeError:
+        return None
+    claims = token.get('scope')
+    sub = token.get('sub') or {}
+    if not claims or (sub.get('role'), sub.get('id')) != key:
+        return None
+    store_ids = claims.get('store_ids')
+    return Principal(
+        key[1], key[0], True, claims['merchant_id'], claims['admin_id'], claims['store_id'],
+        frozenset(store_ids) if store_ids is not None else None
+    )
+
+
+def load_principal(identity):
+    # Resolved once per request (kept on flask.g): from the access token's
+    # scope claims when it has them, otherwise from the database and, when
+    # PRINCIPAL_CACHE_TTL is set, shared across requests in this process
+    # for that many seconds.
+    key = (identity['role'], identity['id'])
+    cached = g.get('_principal')
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    principal = claimed_principal(identity)
+    if principal is not None:
+        g._principal = (key, principal)
+        return principal
+
+    ttl = current_app.config.get('PRINCIPAL_CACHE_TTL', 0)
+    principal = principal_cache.get(key) if ttl else None
+    if principal is None:
+        principal = query_principal(*key)
+        if principal and ttl:
+            principal_cache.set(key, principal, ttl, current_app.config.get('PRINCIPAL_CACHE_SIZE', 10000))
+    g._principal = (key, principal)
+    return principal
+
+
+def current_principal():
+    return load_principal(get_jwt_identity())
+
+
+def invalidate_principal(role, user_id):
+    principal_cache.invalidate((role, user_id))
+    cached = g.get('_principal')
+    if cached is not None and cached[0] == (role, user_id):
+        g.pop('_principal')
@@ -0,0 +1,66 @@
+from datetime import datetime, time
+from sqlalchemy import func, select
+from models import DailyItemRollup, Item, db
+from scoping import scoped
+
+DEFAULT_PER_PAGE = 100
+MAX_PER_PAGE = 1000
+
+
+def report_totals_query(current_user, start_day):
+    # Totals come from daily_item_rollups, so even an annual report sums at
+    # most one row per clerk per day instead of scanning a year of items.
+    return scoped(select(
+        func.coalesce(func.sum(DailyItemRollup.item_count), 0),
+        func.coalesce(func.sum(DailyItemRollup.quantity_in_stock), 0),
+        func.coalesce(func.sum(DailyItemRollup.quantity_spoilt), 0),
+        func.coalesce(func.sum(DailyItemRollup.paid_items), 0),
+        func.coalesce(func.sum(DailyItemRollup.unpaid_items), 0),
+    ), DailyItemRollup, current_user).where(DailyItemRollup.day >= start_day)
+
+
+def report_items_query(current_user, start_day, page, per_page):
+    return scoped(select(Item.name, Item.quantity_in_stock, Item.quantity_spoilt), Item, current_user) \
+        .where(Item.received_at >= datetime.combine(start_day, time.min)) \
+        .order_by(Item.id) \
+        .limit(per_page) \
+        .offset((page - 1) * per_page)
+
+
+def build_report(current_user, start_date, include_items=True, page=1, per_page=DEFAULT_PER_PAGE):
+    # Rollups are kept per day, so report windows start at midnight (UTC) of
+    # the first day rather than at the exact time the request was made.
+    start_day = start_date.date()
+    totals = db.session.execute(report_totals_query(current_user, start_day)).one()
+    rows = db.session.execute(report_items_query(current_user, start_day, page, per_page)).all() \
+        if include_items else None
+    return report_body(totals, rows, page, per_page)
+
+
+def report_body(totals, rows, page, per_page):
+    # The report's JSON from the totals row and, when items were asked for,
+    # the page of item rows. Shared with the async handlers in asgi.py.
+    total_items, total_stock, total_spoilt, paid_items, unpaid_items = totals
+    report = {
+        "total_items": total_items,
+        "total_stock": total_stock,
+        "total_spoilt": total_spoilt,
+        "paid_items": paid_items,
+        "unpaid_items": unpaid_items
+    }
+    if rows is not None:
+        report["items"] = [{
+            "name": r.name,
+            "quantity_in_stock": r.quantity_in_stock,
+            "quantity_spoilt": r.quantity_spoilt
+        } for r in rows]
+        report["page"] = page
+        report["per_page"] = per_page
+    return report
+
+
+def parse_report_args(args):
+    include_items = args.get('include_items', 'true').lower() not in ('0', 'false', 'no')
+    page = max(args.get('page', 1, type=int), 1)
+    per_page = min(max(args.get('per_page', DEFAULT_PER_PAGE, type=int), 1), MAX_PER_PAGE)
+    return include_items, page, per_page
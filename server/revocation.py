@@ -0,0 +1,243 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+import click
+from flask.cli import AppGroup
+from sqlalchemy import delete, select
+from models import Revocation, db
+from routing import use_primary
+from staging import TransactionStage
+
+log = logging.getLogger(__name__)
+
+# How far back each periodic read looks before the previous one, for rows
+# whose transaction committed after it.
+SYNC_OVERLAP = timedelta(seconds=30)
+PRUNE_INTERVAL = 60
+
+tokens_cli = AppGroup('tokens', help='Maintain revoked tokens.')
+
+
+def _epoch(moment):
+    return (moment - datetime(1970, 1, 1)).total_seconds()
+
+
+def _utc(epoch):
+    return datetime(1970, 1, 1) + timedelta(seconds=epoch)
+
+
+class BloomFilter:
+    # A fixed bit array with `hashes` probes per key, taken from one
+    # blake2b digest. No false negatives; false positives at roughly
+    # (1 - e^(-k*n/m))^k for n keys in m bits.
+    def __init__(self, bits, hashes):
+        self.bits = bits
+        self.hashes = hashes
+        self._array = bytearray((bits + 7) // 8)
+
+    def _probes(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=4 * self.hashes).digest()
+        for i in range(self.hashes):
+            yield int.from_bytes(digest[4 * i:4 * i + 4], 'little') % self.bits
+
+    def add(self, key):
+        for bit in self._probes(key):
+            self._array[bit >> 3] |= 1 << (bit & 7)
+
+    def __contains__(self, key):
+        return all(self._array[bit >> 3] & (1 << (bit & 7)) for bit in self._probes(key))
+
+
+class Revocations:
+    # Revoked tokens held in memory, so the blocklist check on every request
+    # is a couple of dict lookups and a hash, with no database round trip.
+    #
+    # Two kinds of entries:
+    #   - single tokens by jti (logout), kept until the token's own exp;
+    #   - per account "issued before" cutoffs (deactivation, deletion), kept
+    #     until the longest-lived token issued before them has expired.
+    #
+    # Token jtis go into a Bloom filter and an exact dict. Nearly every
+    # token on a request is not revoked and is answered by the filter alone.
+    # The exact dict is capped at REVOCATION_MAX_ENTRIES; past that, new
+    # jtis are only added to the filter and a filter hit counts as revoked,
+    # so the cap can cost a rare valid token a fresh login but never lets a
+    # revoked one through. Expired entries are pruned and the filter rebuilt
+    # from what is left.
+    #
+    # Every revocation is also a row in `revocations`. A background thread
+    # in each worker reads rows created since its last look every
+    # REVOCATION_SYNC_INTERVAL seconds, so a logout or deactivation handled
+    # by one worker reaches the others within that interval and survives a
+    # restart. The first request a worker serves loads every unexpired row
+    # before it is answered and starts the thread; after that no request
+    # waits on the database for revocations.
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._jtis = {}
+        self._cutoffs = {}
+        self._bloom = None
+        self._overflow_until = 0
+        self._next_prune = 0
+        self._synced_at = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._staged = TransactionStage('revocations', after_commit=self._apply)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('REVOCATION_BLOOM_BITS', 1 << 20)
+        app.config.setdefault('REVOCATION_BLOOM_HASHES', 4)
+        app.config.setdefault('REVOCATION_MAX_ENTRIES', 100000)
+        app.config.setdefault('REVOCATION_SYNC_INTERVAL', 2.0)
+        self.app = app
+        self.bloom_bits = app.config['REVOCATION_BLOOM_BITS']
+        self.bloom_hashes = app.config['REVOCATION_BLOOM_HASHES']
+        self.max_entries = app.config['REVOCATION_MAX_ENTRIES']
+        self.sync_interval = app.config['REVOCATION_SYNC_INTERVAL']
+        # A cutoff has to outlive every token it can match, refresh tokens
+        # included.
+        self.cutoff_ttl = max(
+            app.config['JWT_ACCESS_TOKEN_EXPIRES'], app.config['JWT_REFRESH_TOKEN_EXPIRES']
+        ).total_seconds()
+        # What was loaded for another app in this process is not this one's:
+        # start over, and the next request loads this app's rows.
+        with self._start_lock, self._lock:
+            self._jtis = {}
+            self._cutoffs = {}
+            self._bloom = BloomFilter(self.bloom_bits, self.bloom_hashes)
+            self._overflow_until = 0
+            self._next_prune = 0
+            self._synced_at = None
+            self._pid = None
+        app.extensions['revocations'] = self
+        app.before_request(self._ensure_started)
+
+    def is_revoked(self, payload):
+        identity = payload.get('sub') or {}
+        cutoff = self._cutoffs.get((identity.get('role'), identity.get('id')))
+        if cutoff is not None and payload.get('iat', 0) < cutoff[0]:
+            return True
+        jti = payload.get('jti')
+        if jti is None or jti not in self._bloom:
+            return False
+        expires = self._jtis.get(jti)
+        if expires is not None:
+            return True
+        return self._overflow_until > time.time()
+
+    def revoke_token(self, payload):
+        # Revokes one decoded token (its jti) until it would have expired.
+        self._stage(Revocation(jti=payload['jti'], expires_at=_utc(payload['exp'])))
+
+    def revoke_user(self, role, user_id):
+        # Revokes every token the account holds now. Tokens carry whole
+        # seconds in iat, so one issued within the same second as the cutoff
+        # is revoked too.
+        now = datetime.utcnow()
+        self._stage(Revocation(
+            role=role, user_id=user_id, not_before=now,
+            expires_at=now + timedelta(seconds=self.cutoff_ttl)
+        ))
+
+    def _stage(self, row):
+        # Written in the caller's transaction and applied in memory only once
+        # it commits.
+        db.session.add(row)
+        self._staged.add((row.jti, row.role, row.user_id, row.not_before, row.expires_at))
+
+    def _apply(self, rows):
+        now = time.time()
+        with self._lock:
+            for jti, role, user_id, not_before, expires_at in rows:
+                expires = _epoch(expires_at)
+                if expires <= now:
+                    continue
+                if jti:
+                    self._bloom.add(jti)
+                    if jti in self._jtis or len(self._jtis) < self.max_entries:
+                        self._jtis[jti] = expires
+                    else:
+                        self._overflow_until = max(self._overflow_until, expires)
+                else:
+                    cutoff = (_epoch(not_before), expires)
+                    current = self._cutoffs.get((role, user_id))
+                    if current is None or current[0] < cutoff[0]:
+                        self._cutoffs[(role, user_id)] = cutoff
+
+    def _prune(self, now):
+        with self._lock:
+            self._cutoffs = {k: v for k, v in self._cutoffs.items() if v[1] > now}
+            self._jtis = {k: v for k, v in self._jtis.items() if v > now}
+            if self._overflow_until > now:
+                # Jtis that only live in the filter cannot be re-added.
+                return
+            bloom = BloomFilter(self.bloom_bits, self.bloom_hashes)
+            for jti in self._jtis:
+                bloom.add(jti)
+            self._bloom = bloom
+
+    def _ensure_started(self):
+        # Once per process, a freshly forked worker included: the full load
+        # runs on the request thread so that no token is checked against an
+        # empty denylist, then the thread takes over.
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            try:
+                self.sync()
+            except Exception:
+                db.session.rollback()
+                log.exception('Loading revocations failed; the sync thread retries')
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='revocation-sync', daemon=True).start()
+
+    def _run(self):
+        # Until the process forks or init_app switches to another app.
+        pid, app = os.getpid(), self.app
+        while True:
+            time.sleep(self.sync_interval)
+            if self._pid != pid or self.app is not app:
+                return
+            try:
+                with app.app_context():
+                    self.sync()
+            except Exception:
+                log.exception('Reading revocations failed; using what is in memory')
+
+    def sync(self):
+        # On the first call loads every unexpired row; after that, rows
+        # created since the previous call less SYNC_OVERLAP. Applying a row
+        # twice is harmless.
+        now = datetime.utcnow()
+        query = select(
+            Revocation.jti, Revocation.role, Revocation.user_id, Revocation.not_before, Revocation.expires_at
+        ).where(Revocation.expires_at > now)
+        if self._synced_at is not None:
+            query = query.where(Revocation.created_at >= self._synced_at - SYNC_OVERLAP)
+        with use_primary():
+            rows = db.session.execute(query).all()
+        db.session.commit()
+        self._apply(rows)
+        self._synced_at = now
+        if time.monotonic() >= self._next_prune:
+            self._prune(time.time())
+            self._next_prune = time.monotonic() + PRUNE_INTERVAL
+
+
+revocations = Revocations()
+
+
+@tokens_cli.command('prune')
+def prune_command():
+    """Delete revocations whose tokens have all expired."""
+    result = db.session.execute(delete(Revocation).where(Revocation.expires_at <= datetime.utcnow()))
+    db.session.commit()
+    click.echo(f"Deleted {result.rowcount} expired revocations")
@@ -0,0 +1,138 @@
+import click
+from datetime import date
+from flask.cli import AppGroup
+from sqlalchemy import func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from models import DailyItemRollup, Item, db
+
+ROLLUP_FIELDS = (
+    'item_count', 'quantity_received', 'quantity_in_stock', 'quantity_spoilt',
+    'paid_items', 'unpaid_items', 'buying_value', 'selling_value'
+)
+
+rollups_cli = AppGroup('rollups', help='Maintain the daily_item_rollups table.')
+
+
+def item_contribution(item):
+    paid = bool(item.payment_status)
+    return {
+        'item_count': 1,
+        'quantity_received': item.quantity_received,
+        'quantity_in_stock': item.quantity_in_stock,
+        'quantity_spoilt': item.quantity_spoilt or 0,
+        'paid_items': 1 if paid else 0,
+        'unpaid_items': 0 if paid else 1,
+        'buying_value': item.buying_price * item.quantity_received,
+        'selling_value': item.selling_price * item.quantity_in_stock
+    }
+
+
+def apply_rollup_deltas(rows):
+    # Each row holds store_id, clerk_id, day and the amounts to add to that
+    # rollup; PostgreSQL and SQLite apply them as one upsert executemany.
+    if not rows:
+        return
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        stmt = insert(DailyItemRollup)
+        columns = DailyItemRollup.__table__.c
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['store_id', 'clerk_id', 'day'],
+            set_={k: columns[k] + stmt.excluded[k] for k in ROLLUP_FIELDS}
+        )
+        db.session.execute(stmt, rows)
+        return
+
+    for row in rows:
+        rollup = DailyItemRollup.query.filter_by(
+            store_id=row['store_id'], clerk_id=row['clerk_id'], day=row['day']
+        ).with_for_update().first()
+        if not rollup:
+            rollup = DailyItemRollup(store_id=row['store_id'], clerk_id=row['clerk_id'], day=row['day'],
+                                     **{k: 0 for k in ROLLUP_FIELDS})
+            db.session.add(rollup)
+        for k in ROLLUP_FIELDS:
+            setattr(rollup, k, getattr(rollup, k) + row[k])
+
+
+def _apply_item(item, delta):
+    if any(delta.values()):
+        apply_rollup_deltas([dict(delta, store_id=item.store_id, clerk_id=item.clerk_id,
+                                  day=item.received_at.date())])
+
+
+def record_item_added(item):
+    _apply_item(item, item_contribution(item))
+
+
+def record_items_added(items):
+    totals = {}
+    for item in items:
+        key = (item.store_id, item.clerk_id, item.received_at.date())
+        contribution = item_contribution(item)
+        if key in totals:
+            for k in ROLLUP_FIELDS:
+                totals[key][k] += contribution[k]
+        else:
+            totals[key] = contribution
+    apply_rollup_deltas([dict(delta, store_id=store_id, clerk_id=clerk_id, day=day)
+                         for (store_id, clerk_id, day), delta in totals.items()])
+
+
+def record_item_removed(item):
+    _apply_item(item, {k: -v for k, v in item_contribution(item).items()})
+
+
+def record_item_changed(item, before):
+    after = item_contribution(item)
+    _apply_item(item, {k: after[k] - before[k] for k in ROLLUP_FIELDS})
+
+
+def backfill_rollups(chunk_size=10000):
+    db.session.query(DailyItemRollup).delete()
+    db.session.commit()
+
+    day = func.date(Item.received_at)
+    paid = Item.payment_status.is_(True)
+    lo, hi = db.session.execute(select(func.min(Item.id), func.max(Item.id))).one()
+    if lo is None:
+        return 0
+
+    groups = 0
+    for start in range(lo, hi + 1, chunk_size):
+        rows = db.session.execute(
+            select(
+                Item.store_id, Item.clerk_id, day.label('day'),
+                func.count(Item.id),
+                func.sum(Item.quantity_received),
+                func.sum(Item.quantity_in_stock),
+                func.coalesce(func.sum(Item.quantity_spoilt), 0),
+                func.count(Item.id).filter(paid),
+                func.count(Item.id).filter(~paid),
+                func.sum(Item.buying_price * Item.quantity_received),
+                func.sum(Item.selling_price * Item.quantity_in_stock)
+            ).where(Item.id >= start, Item.id < start + chunk_size)
+            .group_by(Item.store_id, Item.clerk_id, day)
+        ).all()
+        deltas = []
+        for store_id, clerk_id, row_day, *values in rows:
+            if isinstance(row_day, str):
+                row_day = date.fromisoformat(row_day)
+            deltas.append(dict(zip(ROLLUP_FIELDS, values), store_id=store_id, clerk_id=clerk_id, day=row_day))
+        apply_rollup_deltas(deltas)
+        db.session.commit()
+        groups += len(rows)
+    return groups
+
+
+@rollups_cli.command('backfill')
+@click.option('--chunk-size', default=10000, show_default=True, help='Item ids aggregated per transaction.')
+def backfill_command(chunk_size):
+    """Rebuild daily_item_rollups from the items table.
+
+    Run with item writes paused: rows written while the backfill is running
+    may be counted twice or not at all.
+    """
+    groups = backfill_rollups(chunk_size)
+    click.echo(f"Rebuilt daily_item_rollups from {groups} item groups")
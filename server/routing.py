@@ -0,0 +1,226 @@
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from flask import g, has_request_context, request
+from flask_jwt_extended import get_jwt_identity
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, text
+
+log = logging.getLogger(__name__)
+
+REPLICA_PREFIX = 'replica_'
+READ_METHODS = ('GET', 'HEAD')
+
+# Seconds a replica is behind. Caught up (nothing received left to replay)
+# counts as no lag even if the last replayed transaction is old, as it is on
+# a quiet primary.
+POSTGRES_LAG = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+def replica_binds(config, engine_options):
+    # SQLALCHEMY_BINDS entries for READ_REPLICA_URLS, replica_0, replica_1,
+    # ..., each with the same pool settings as the primary and its own pool
+    # stats under /health/pool.
+    binds = dict(config.get('SQLALCHEMY_BINDS') or {})
+    for n, url in enumerate(config.get('READ_REPLICA_URLS') or []):
+        options = engine_options(dict(config, SQLALCHEMY_DATABASE_URI=url, SQLALCHEMY_ENGINE_OPTIONS={}),
+                                 name=f'replica-{n}')
+        binds[f'{REPLICA_PREFIX}{n}'] = dict(options, url=url)
+    return binds
+
+
+class ReplicaState:
+    def __init__(self, key):
+        self.key = key
+        self.lag = None
+        self.healthy = True
+        self.checked_at = 0
+        self.error = None
+
+
+class ReplicaRouter:
+    # Decides, per request, whether reads go to a read replica.
+    #
+    # GET and HEAD requests read from a replica, chosen round-robin among
+    # those whose last measured lag is under REPLICA_MAX_LAG_SECONDS and
+    # kept for the rest of the request. Everything else uses the primary:
+    # other methods, CLI commands and background threads, any statement
+    # once the request has written, every request from an account that
+    # wrote in the last READ_YOUR_WRITES_SECONDS (so a clerk who adds an
+    # item sees it in the list straight after), and any cached or
+    # conditional GET whose cache tags were bumped within the lag a replica
+    # may have (require_fresh, from cache.py). Those write stamps live in
+    # the response cache backend, so with CACHE_BACKEND=redis they hold
+    # across workers; with the local backend, only on the worker that took
+    # the write.
+    #
+    # Lag is measured on the request thread, one replica at a time, at most
+    # every REPLICA_LAG_CHECK_INTERVAL seconds per replica. A replica that
+    # fails the check is skipped until its next check; with none usable,
+    # reads go to the primary.
+    def __init__(self):
+        self._replicas = []
+        self._counter = itertools.count()
+
+    def init_app(self, app, engine_options):
+        # Called before db.init_app, which creates the replica engines from
+        # the binds added here.
+        app.config.setdefault('READ_REPLICA_URLS', [])
+        app.config.setdefault('REPLICA_MAX_LAG_SECONDS', 5.0)
+        app.config.setdefault('REPLICA_LAG_CHECK_INTERVAL', 5.0)
+        app.config.setdefault('READ_YOUR_WRITES_SECONDS', 10.0)
+        self._replicas = [ReplicaState(f'{REPLICA_PREFIX}{n}') for n in range(len(app.config['READ_REPLICA_URLS']))]
+        self.max_lag = app.config['REPLICA_MAX_LAG_SECONDS']
+        self.check_interval = app.config['REPLICA_LAG_CHECK_INTERVAL']
+        self.write_window = app.config['READ_YOUR_WRITES_SECONDS']
+        app.config['SQLALCHEMY_BINDS'] = replica_binds(app.config, engine_options)
+        app.extensions['replica_router'] = self
+
+    def engine_for(self, session, clause):
+        if not self._replicas or not has_request_context() or request.method not in READ_METHODS:
+            return None
+        if g.get('_use_primary') or session.info.get('wrote') or getattr(clause, 'is_dml', False):
+            return None
+        if '_replica' not in g:
+            g._replica = self._choose(session)
+        return g._replica
+
+    def _choose(self, session):
+        if self._wrote_recently():
+            return None
+        now = time.monotonic()
+        for replica in self._replicas:
+            if now - replica.checked_at >= self.check_interval:
+                self._check(session._db.engines[replica.key], replica, now)
+        usable = [r for r in self._replicas if r.healthy and r.lag is not None and r.lag <= self.max_lag]
+        if not usable:
+            return None
+        replica = usable[next(self._counter) % len(usable)]
+        return session._db.engines[replica.key]
+
+    def _check(self, engine, replica, now):
+        replica.checked_at = now
+        try:
+            with engine.connect() as conn:
+                if engine.dialect.name == 'postgresql':
+                    lag = conn.execute(POSTGRES_LAG).scalar()
+                else:
+                    conn.execute(text('SELECT 1'))
+                    lag = 0
+            replica.lag = float(lag or 0)
+            replica.healthy = True
+            replica.error = None
+        except Exception as e:
+            replica.healthy = False
+            replica.error = str(e)
+            log.warning('Read replica %s is unavailable: %s', replica.key, e)
+
+    def _writer_key(self):
+        try:
+            identity = get_jwt_identity()
+        except Exception:
+            return None
+        return identity and f"ryw:{identity['role']}:{identity['id']}"
+
+    def _stamps(self):
+        # Imported here: the response cache imports the principal module,
+        # which needs the models and so this module's session class.
+        from cache import response_cache
+        return response_cache.backend
+
+    def _wrote_recently(self):
+        key = self._writer_key()
+        backend = self._stamps()
+        if key is None or backend is None:
+            return False
+        try:
+            return backend.get_many([key])[0] is not None
+        except Exception:
+            return True
+
+    def note_write(self):
+        key = self._writer_key() if has_request_context() else None
+        backend = self._stamps()
+        if key is None or backend is None or not self._replicas:
+            return
+        try:
+            backend.set(key, time.time(), self.write_window)
+        except Exception:
+            log.exception('Could not record write for read-your-writes')
+
+    def require_fresh(self, changed_at):
+        # Sends the rest of the request to the primary when what it reads
+        # changed at `changed_at` (naive UTC), recently enough that a replica
+        # may not have it yet: one within REPLICA_MAX_LAG_SECONDS at its last
+        # check can have fallen up to REPLICA_LAG_CHECK_INTERVAL further
+        # behind since.
+        if not self._replicas or changed_at is None or not has_request_context():
+            return
+        if datetime.utcnow() - changed_at < timedelta(seconds=self.max_lag + self.check_interval):
+            g._use_primary = True
+
+    def replica_read(self):
+        # Whether this request's reads came from a replica.
+        return has_request_context() and g.get('_replica') is not None and not g.get('_use_primary')
+
+    def status(self):
+        return [
+            {"bind": r.key, "healthy": r.healthy, "lag_seconds": r.lag, "error": r.error}
+            for r in self._replicas
+        ]
+
+
+replica_router = ReplicaRouter()
+
+
+class RoutingSession(Session):
+    # Flask-SQLAlchemy's session, with reads sent to a replica where the
+    # router allows it.
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            engine = replica_router.engine_for(self, clause)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _mark_written(session, flush_context):
+    session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _mark_dml(orm_execute_state):
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _after_commit(session):
+    if session.info.pop('wrote', False):
+        replica_router.note_write()
+
+
+@event.listens_for(RoutingSession, 'after_soft_rollback')
+def _after_rollback(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop('wrote', None)
+
+
+@contextmanager
+def use_primary():
+    # Reads inside the block go to the primary, for data that must not lag
+    # (revocations).
+    previous = g.get('_use_primary') if has_request_context() else None
+    if has_request_context():
+        g._use_primary = True
+    try:
+        yield
+    finally:
+        if has_request_context():
+            g._use_primary = previous
@@ -0,0 +1,72 @@
+from sqlalchemy import select
+from models import Clerk, Store, db
+from principal import claimed_principal, load_principal
+
+
+def scoped(query, model, current_user):
+    # Restricts a select/query over `model` (anything owned by a store and a
+    # clerk: Item, SupplyRequest, DailyItemRollup) to the rows the caller may
+    # see. Ownership is resolved by joining clerks or stores in the same
+    # statement, which lets the planner start from the caller's few clerks or
+    # stores and probe the (clerk_id, ...) / (store_id, ...) indexes.
+    role = current_user['role']
+    user_id = current_user['id']
+    if role == 'clerks':
+        return query.where(model.clerk_id == user_id)
+    if role == 'admins':
+        return query.join(Clerk, Clerk.id == model.clerk_id).where(Clerk.admin_id == user_id)
+    if role == 'merchants':
+        return query.join(Store, Store.id == model.store_id).where(Store.merchant_id == user_id)
+    raise ValueError(f"Unknown role: {role}")
+
+
+def check_account(current_user):
+    if current_user['role'] not in ('merchants', 'admins', 'clerks'):
+        return {"error": "Unauthorized"}, 403
+    principal = load_principal(current_user)
+    if not principal or not principal.is_active:
+        return {"error": "Account deactivated or not found"}, 403
+    return None
+
+
+def load_with_owners(model, id, current_user):
+    # Fetches the row together with the admin and merchant that own it, so
+    # by-id handlers can authorise without a second lookup. With scope
+    # claims in the token a clerk's own rows need no joins (their owners
+    # are the clerk's), and a merchant's need no store join for a store
+    # named in the claims. Claimed store ids only ever answer "yes": a store
+    # added since the token was issued falls back to the join.
+    principal = claimed_principal(current_user)
+    if principal and principal.role == 'clerks':
+        row = db.session.get(model, id)
+        if row is None:
+            return None
+        if row.clerk_id != principal.id:
+            return row, None, None
+        return row, principal.admin_id, principal.merchant_id
+    if principal and principal.role == 'merchants' and principal.store_ids:
+        found = db.session.execute(
+            select(model, Clerk.admin_id).join(Clerk, Clerk.id == model.clerk_id).where(model.id == id)
+        ).first()
+        if found is None:
+            return None
+        if found[0].store_id in principal.store_ids:
+            return found[0], found[1], principal.id
+    return db.session.execute(
+        select(model, Clerk.admin_id, Store.merchant_id)
+        .join(Clerk, Clerk.id == model.clerk_id)
+        .join(Store, Store.id == model.store_id)
+        .where(model.id == id)
+    ).first()
+
+
+def owns(current_user, clerk_id, admin_id, merchant_id):
+    role = current_user['role']
+    user_id = current_user['id']
+    if role == 'clerks':
+        return clerk_id == user_id
+    if role == 'admins':
+        return admin_id == user_id
+    if role == 'merchants':
+        return merchant_id == user_id
+    return False
@@ -1,8 +1,17 @@
-from app import app, db
+import argparse
+import csv
+import io
+import random
+import sys
+from app import create_app, db
 from models import Merchant, Admin, Clerk, Store, Item, SupplyRequest, Update
-from datetime import datetime
+from passwords import hash_password
+from rollups import backfill_rollups
+from sqlalchemy import inspect, text
+from datetime import datetime, timedelta
 
-def seed_database():
+def seed_database(app=None):
+    app = app or create_app()
     with app.app_context():
         db.drop_all()
         db.create_all()
@@ -60,7 +69,281 @@ def seed_database():
         db.session.add(update)
 
         db.session.commit()
+        # Reports read only from the rollups.
+        backfill_rollups()
         print("Database seeded successfully!")
 
+PRODUCTS = (
+    'Maize Flour', 'Wheat Flour', 'Rice', 'Sugar', 'Salt', 'Cooking Oil', 'Milk', 'Bread', 'Tea Leaves',
+    'Coffee', 'Beans', 'Green Grams', 'Eggs', 'Margarine', 'Soap', 'Detergent', 'Toothpaste', 'Tissue',
+    'Soda', 'Juice', 'Water', 'Biscuits', 'Spaghetti', 'Tomato Sauce', 'Candles', 'Matches'
+)
+SIZES = ('250g', '500g', '1kg', '2kg', '5kg', '300ml', '500ml', '1L', '2L', 'pack of 6', 'pack of 12')
+TOWNS = ('Nairobi', 'Mombasa', 'Kisumu', 'Nakuru', 'Eldoret', 'Thika', 'Nyeri', 'Machakos', 'Meru', 'Kitale')
+
+class Loader:
+    # Buffers generated rows per model and writes them in chunks: with COPY
+    # on PostgreSQL (psycopg or psycopg2), elsewhere as one executemany
+    # INSERT per table on the Core table, bypassing the ORM. A full buffer
+    # flushes every model, in the order they were registered, so parents
+    # always reach the database before their children.
+    def __init__(self, models, chunk_size):
+        self.buffers = {model: [] for model in models}
+        self.chunk_size = chunk_size
+        self.counts = dict.fromkeys(models, 0)
+
+    def add(self, model, row):
+        rows = self.buffers[model]
+        rows.append(row)
+        if len(rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        connection = db.session.connection()
+        cursor = copy_cursor(connection) if connection.dialect.name == 'postgresql' else None
+        for model, rows in self.buffers.items():
+            if not rows:
+                continue
+            table = model.__table__
+            # Rows may leave out different nullable columns (updates name
+            # one actor each); the statement needs the same ones in all.
+            keys = set().union(*rows)
+            columns = [c.name for c in table.columns if c.name in keys]
+            if cursor is not None:
+                copy_rows(cursor, connection.dialect, table, columns, rows)
+            else:
+                connection.execute(table.insert(), [{c: row.get(c) for c in columns} for row in rows])
+            self.counts[model] += len(rows)
+            rows.clear()
+        if cursor is not None:
+            cursor.close()
+        db.session.commit()
+
+def copy_cursor(connection):
+    # A DBAPI cursor that can COPY, or None for drivers that can't.
+    cursor = connection.connection.driver_connection.cursor()
+    return cursor if hasattr(cursor, 'copy_expert') or hasattr(cursor, 'copy') else None
+
+def copy_rows(cursor, dialect, table, columns, rows):
+    # COPY ... FROM STDIN with the rows as CSV. None is written as an empty
+    # unquoted field, which COPY reads as NULL.
+    data = io.StringIO()
+    csv.writer(data).writerows([row.get(c) for c in columns] for row in rows)
+    data.seek(0)
+    quote = dialect.identifier_preparer.quote
+    sql = f"COPY {quote(table.name)} ({', '.join(quote(c) for c in columns)}) FROM STDIN WITH (FORMAT csv)"
+    if hasattr(cursor, 'copy_expert'):
+        cursor.copy_expert(sql, data)
+    else:
+        with cursor.copy(sql) as copy:
+            copy.write(data.getvalue())
+
+def defer_constraints(tables):
+    # Drops the secondary indexes (and, on PostgreSQL, the foreign keys) of
+    # the freshly created, still empty tables, and returns what to put back
+    # with restore_constraints once they are loaded. Building an index over
+    # the loaded table, and checking a foreign key in one pass, is much
+    # cheaper than maintaining them row by row.
+    connection = db.session.connection()
+    indexes = [index for table in tables for index in table.indexes]
+    for index in indexes:
+        index.drop(bind=connection)
+    foreign_keys = []
+    if connection.dialect.name == 'postgresql':
+        quote = connection.dialect.identifier_preparer.quote
+        inspector = inspect(connection)
+        for table in tables:
+            for fk in inspector.get_foreign_keys(table.name):
+                connection.exec_driver_sql(f'ALTER TABLE {quote(table.name)} DROP CONSTRAINT {quote(fk["name"])}')
+                foreign_keys.append((table.name, fk))
+    db.session.commit()
+    return indexes, foreign_keys
+
+def restore_constraints(deferred):
+    indexes, foreign_keys = deferred
+    connection = db.session.connection()
+    if connection.dialect.name == 'postgresql':
+        # Index builds over millions of rows outlast DB_STATEMENT_TIMEOUT_MS.
+        connection.exec_driver_sql('SET LOCAL statement_timeout = 0')
+    for index in indexes:
+        index.create(bind=connection)
+    quote = connection.dialect.identifier_preparer.quote
+    for table, fk in foreign_keys:
+        connection.exec_driver_sql(
+            f'ALTER TABLE {quote(table)} ADD CONSTRAINT {quote(fk["name"])} '
+            f'FOREIGN KEY ({", ".join(map(quote, fk["constrained_columns"]))}) '
+            f'REFERENCES {quote(fk["referred_table"])} ({", ".join(map(quote, fk["referred_columns"]))})'
+        )
+    if connection.dialect.name == 'postgresql':
+        connection.exec_driver_sql('ANALYZE')
+    db.session.commit()
+
+def reset_sequences(models):
+    # Generated rows carry their own ids, which PostgreSQL's serial
+    # sequences don't see.
+    if db.engine.dialect.name != 'postgresql':
+        return
+    for model in models:
+        table = model.__tablename__
+        db.session.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), coalesce(max(id), 0) + 1, false) FROM {table}"
+        ))
+    db.session.commit()
+
+def generate_data(merchants=10, stores_per_merchant=5, admins_per_merchant=2, clerks_per_store=4,
+                  items_per_store=1000, supply_requests_per_store=100, years=2, password='password',
+                  seed=42, chunk_size=5000, app=None):
+    # Replaces the database with a generated dataset of the given shape.
+    # The same arguments and seed always produce the same rows (timestamps
+    # are relative to now). Every account's email is <role><n>@seed.local,
+    # n counting from 1, with the same password.
+    #
+    # Each store's items are spread over `years` of history with ids in
+    # received order, and each gets an item_added update, as the API would
+    # leave them. Supply requests point at items of their store; the older
+    # ones are mostly decided, each decision with its
+    # supply_request_updated update.
+    #
+    # Rows go in through Loader (COPY on PostgreSQL, executemany elsewhere)
+    # with the tables' secondary indexes and foreign keys only built once
+    # everything is loaded.
+    app = app or create_app()
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    history = timedelta(days=365 * years)
+    start = now - history
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        password_hash = hash_password(password)
+        models = (Merchant, Store, Admin, Clerk, Item, SupplyRequest, Update)
+        deferred = defer_constraints([model.__table__ for model in models])
+        loader = Loader(models, chunk_size)
+
+        for m in range(1, merchants + 1):
+            loader.add(Merchant, {'id': m, 'email': f'merchant{m}@seed.local', 'password': password_hash,
+                                  'is_active': True, 'created_at': start})
+        for s in range(1, merchants * stores_per_merchant + 1):
+            merchant_id = (s - 1) // stores_per_merchant + 1
+            loader.add(Store, {'id': s, 'name': f'{rng.choice(TOWNS)} {s}', 'merchant_id': merchant_id,
+                               'created_at': start})
+        for a in range(1, merchants * admins_per_merchant + 1):
+            loader.add(Admin, {'id': a, 'email': f'admin{a}@seed.local', 'password': password_hash, 'is_active': True,
+                               'merchant_id': (a - 1) // admins_per_merchant + 1, 'created_at': start})
+
+        for s in range(1, merchants * stores_per_merchant + 1):
+            merchant_id = (s - 1) // stores_per_merchant + 1
+            clerk_ids = [(s - 1) * clerks_per_store + k for k in range(1, clerks_per_store + 1)]
+            admin_of = {}
+            for n, c in enumerate(clerk_ids):
+                # A store's clerks are shared out among its merchant's admins.
+                admin_of[c] = (merchant_id - 1) * admins_per_merchant + (s + n) % admins_per_merchant + 1
+                loader.add(Clerk, {'id': c, 'email': f'clerk{c}@seed.local', 'password': password_hash,
+                                   'is_active': True, 'admin_id': admin_of[c], 'store_id': s, 'created_at': start})
+
+            first_item = (s - 1) * items_per_store + 1
+            received = sorted(start + history * rng.random() for _ in range(items_per_store))
+            for i, received_at in enumerate(received):
+                clerk_id = rng.choice(clerk_ids)
+                quantity = rng.randint(1, 500)
+                # Stock runs down with age; a little spoils.
+                in_stock = round(quantity * (received_at - start) / history * rng.random())
+                buying_price = round(rng.lognormvariate(4.5, 1), 2)
+                name = f'{rng.choice(PRODUCTS)} {rng.choice(SIZES)}'
+                loader.add(Item, {
+                    'id': first_item + i,
+                    'name': name,
+                    'quantity_received': quantity,
+                    'quantity_in_stock': in_stock,
+                    'quantity_spoilt': rng.randint(0, (quantity - in_stock) // 20),
+                    'buying_price': buying_price,
+                    'selling_price': round(buying_price * rng.uniform(1.05, 1.4), 2),
+                    'payment_status': received_at < now - timedelta(days=30) or rng.random() < 0.5,
+                    'created_at': received_at,
+                    'updated_at': received_at,
+                    'store_id': s,
+                    'clerk_id': clerk_id
+                })
+                loader.add(Update, {'action': 'item_added', 'description': f'Added {name} to store {s}',
+                                    'clerk_id': clerk_id, 'item_id': first_item + i, 'created_at': received_at})
+
+            first_request = (s - 1) * supply_requests_per_store + 1
+            requests = supply_requests_per_store if items_per_store else 0
+            requested = sorted(start + history * rng.random() for _ in range(requests))
+            for r, requested_at in enumerate(requested):
+                item = rng.randrange(items_per_store)
+                clerk_id = rng.choice(clerk_ids)
+                age = now - requested_at
+                status = 'pending' if age < timedelta(days=14) and rng.random() < 0.6 else \
+                    rng.choices(('approved', 'declined', 'pending'), (75, 20, 5))[0]
+                decided_at = min(requested_at + timedelta(hours=rng.uniform(1, 72)), now)
+                loader.add(SupplyRequest, {
+                    'id': first_request + r,
+                    'item_id': first_item + item,
+                    'store_id': s,
+                    'clerk_id': clerk_id,
+                    'quantity': rng.randint(1, 200),
+                    'status': status,
+                    'requested_at': requested_at,
+                    'updated_at': requested_at if status == 'pending' else decided_at
+                })
+                loader.add(Update, {'action': 'supply_request_created',
+                                    'description': f'Supply request for item {first_item + item} created',
+                                    'clerk_id': clerk_id, 'supply_request_id': first_request + r,
+                                    'created_at': requested_at})
+                if status != 'pending':
+                    loader.add(Update, {'action': 'supply_request_updated',
+                                        'description': f'Supply request {first_request + r} status set to {status}',
+                                        'admin_id': admin_of[clerk_id], 'supply_request_id': first_request + r,
+                                        'created_at': decided_at})
+
+        loader.flush()
+        restore_constraints(deferred)
+        reset_sequences((Merchant, Store, Admin, Clerk, Item, SupplyRequest))
+        backfill_rollups()
+        return {model.__tablename__: n for model, n in loader.counts.items()}
+
+def count(minimum):
+    # An argparse type for an integer of at least `minimum`.
+    def parse(value):
+        n = int(value)
+        if n < minimum:
+            raise argparse.ArgumentTypeError(f'must be at least {minimum}')
+        return n
+    return parse
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Seed the database with the demo accounts, or with `generate` a synthetic dataset of any size.'
+    )
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('demo', help='One merchant, store, admin, clerk, item and supply request (the default).')
+    generate = commands.add_parser('generate', help='A generated dataset; see generate_data.')
+    generate.add_argument('--merchants', type=count(0), default=10)
+    generate.add_argument('--stores-per-merchant', type=count(0), default=5)
+    # Every store's clerks answer to one of its merchant's admins.
+    generate.add_argument('--admins-per-merchant', type=count(1), default=2)
+    generate.add_argument('--clerks-per-store', type=count(1), default=4)
+    generate.add_argument('--items-per-store', type=count(0), default=1000)
+    generate.add_argument('--supply-requests-per-store', type=count(0), default=100)
+    generate.add_argument('--years', type=float, default=2, help='History the received_at dates span.')
+    generate.add_argument('--password', default='password', help='Password of every generated account.')
+    generate.add_argument('--seed', type=int, default=42)
+    generate.add_argument('--chunk-size', type=count(1), default=5000, help='Rows per table per COPY or INSERT batch.')
+    args = parser.parse_args(argv)
+
+    if args.command != 'generate':
+        seed_database()
+        return 0
+    options = vars(args)
+    del options['command']
+    started = datetime.utcnow()
+    counts = generate_data(**options)
+    print(', '.join(f'{n} {table}' for table, n in counts.items()),
+          f'in {(datetime.utcnow() - started).total_seconds():.1f}s')
+    print(f'Accounts are merchant1@seed.local, admin1@seed.local, clerk1@seed.local, ... '
+          f'with password {args.password!r}')
+    return 0
+
 if __name__ == '__main__':
-    seed_database()
\ No newline at end of file
+    sys.exit(main())
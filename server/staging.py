@@ -0,0 +1,58 @@
+import logging
+from sqlalchemy import event
+from models import db
+
+log = logging.getLogger(__name__)
+
+
+class TransactionStage:
+    # Values a request stages on the session (audit events, revocations,
+    # cache tags) to act on once its transaction's outcome is known.
+    #
+    # before_commit(session, values) runs just before the commit and may
+    # still write in the transaction; what it returns (the values
+    # themselves without one) goes to after_commit(result) once the commit
+    # has succeeded, or to rolled_back(result) if the transaction ended
+    # without committing: a rollback, a close or a failed COMMIT. Values
+    # staged in a transaction that rolls back before it tries to commit are
+    # simply dropped. Errors in the after hooks are logged, never raised:
+    # by then the transaction is over and the request's outcome settled.
+    def __init__(self, key, before_commit=None, after_commit=None, rolled_back=None):
+        self.key = key
+        self.before_commit = before_commit
+        self.after_commit = after_commit
+        self.rolled_back = rolled_back
+        event.listen(db.session, 'before_commit', self._before_commit)
+        event.listen(db.session, 'after_commit', self._after_commit)
+        event.listen(db.session, 'after_transaction_end', self._after_transaction_end)
+
+    def add(self, *values):
+        self.extend(values)
+
+    def extend(self, values):
+        db.session.info.setdefault(self.key, []).extend(values)
+
+    def _before_commit(self, session):
+        values = session.info.pop(self.key, None)
+        if values and self.before_commit is not None:
+            values = self.before_commit(session, values)
+        if values:
+            session.info[self.key] = values
+
+    def _after_commit(self, session):
+        values = session.info.pop(self.key, None)
+        if values and self.after_commit is not None:
+            try:
+                self.after_commit(values)
+            except Exception:
+                log.exception('After-commit hook for %s failed', self.key)
+
+    def _after_transaction_end(self, session, transaction):
+        if transaction.parent is not None:
+            return
+        values = session.info.pop(self.key, None)
+        if values and self.rolled_back is not None:
+            try:
+                self.rolled_back(values)
+            except Exception:
+                log.exception('Rollback hook for %s failed', self.key)
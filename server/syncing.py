@@ -0,0 +1,138 @@
+import base64
+import json
+import click
+from datetime import datetime, timedelta
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import and_, delete, event, insert, or_, select
+from models import DeletedRecord, Item, SupplyRequest, db
+from scoping import scoped
+
+SYNC_ITEM_FIELDS = (
+    'id', 'name', 'quantity_received', 'quantity_in_stock', 'quantity_spoilt',
+    'buying_price', 'selling_price', 'payment_status', 'store_id', 'created_at', 'updated_at'
+)
+SYNC_SUPPLY_REQUEST_FIELDS = ('id', 'item_id', 'store_id', 'quantity', 'status', 'requested_at', 'updated_at')
+
+sync_cli = AppGroup('sync', help='Maintain delta-sync tombstones.')
+
+
+class InvalidSyncToken(ValueError):
+    pass
+
+
+# A sync walks one window of changes, [since, until), in pages. The token
+# carries the window and, for each collection still being paged, the
+# (timestamp, id) of the last row sent. Once every collection is done the
+# next token opens a new window starting SYNC_OVERLAP seconds before this
+# one ended, so that a row written by a transaction that was still open
+# when the window closed is picked up next time. Clients apply rows as
+# upserts keyed by id, so the rows sent twice are harmless.
+def encode_sync_token(since, until, after):
+    raw = json.dumps({
+        's': since.isoformat() if since else None,
+        'u': until.isoformat() if until else None,
+        'a': {k: v if v == 'done' else [v[0].isoformat(), v[1]] for k, v in after.items()}
+    }).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_sync_token(token):
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        since = datetime.fromisoformat(raw['s']) if raw['s'] else None
+        until = datetime.fromisoformat(raw['u']) if raw['u'] else None
+        after = {k: v if v == 'done' else (datetime.fromisoformat(v[0]), int(v[1])) for k, v in raw['a'].items()}
+        return since, until, after
+    except (ValueError, TypeError, KeyError, AttributeError, IndexError):
+        raise InvalidSyncToken(token)
+
+
+def _changes(model, columns, stamp, current_user, since, until, after, limit):
+    query = scoped(select(*columns), model, current_user).where(stamp < until)
+    if since:
+        query = query.where(stamp >= since)
+    if after:
+        query = query.where(or_(stamp > after[0], and_(stamp == after[0], model.id > after[1])))
+    return query.order_by(stamp, model.id).limit(limit + 1)
+
+
+def sync_collections(since):
+    # (name, model, columns, change timestamp) for each collection in a
+    # sync. Tombstones only matter to clients that already hold data.
+    collections = [
+        ('items', Item, [getattr(Item, f) for f in SYNC_ITEM_FIELDS], Item.updated_at),
+        ('supply_requests', SupplyRequest,
+         [getattr(SupplyRequest, f) for f in SYNC_SUPPLY_REQUEST_FIELDS], SupplyRequest.updated_at),
+    ]
+    if since:
+        collections.append(('deleted', DeletedRecord, [
+            DeletedRecord.id, DeletedRecord.table_name, DeletedRecord.record_id, DeletedRecord.deleted_at
+        ], DeletedRecord.deleted_at))
+    return collections
+
+
+def _serialise(row):
+    return {k: v.isoformat() if isinstance(v, datetime) else v for k, v in row._mapping.items()}
+
+
+def load_changes(current_user, since, until, after, limit, overlap):
+    result = {}
+    next_after = {}
+    for name, model, columns, stamp in sync_collections(since):
+        cursor = after.get(name)
+        if cursor == 'done':
+            result[name] = []
+            next_after[name] = 'done'
+            continue
+        rows = db.session.execute(_changes(model, columns, stamp, current_user, since, until, cursor, limit)).all()
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]._mapping
+            next_after[name] = (last[stamp.key], last['id'])
+        else:
+            next_after[name] = 'done'
+        result[name] = [_serialise(r) for r in rows]
+    if 'deleted' in result:
+        # Tombstones point at rows, not at their owners' columns.
+        result['deleted'] = [
+            {'type': d['table_name'], 'id': d['record_id'], 'deleted_at': d['deleted_at']}
+            for d in result['deleted']
+        ]
+
+    has_more = any(v != 'done' for v in next_after.values())
+    if has_more:
+        token = encode_sync_token(since, until, next_after)
+    else:
+        token = encode_sync_token(until - overlap, None, {})
+    result['has_more'] = has_more
+    result['next_token'] = token
+    return result
+
+
+def _record_deleted(mapper, connection, target):
+    connection.execute(insert(DeletedRecord).values(
+        table_name=target.__tablename__,
+        record_id=target.id,
+        store_id=target.store_id,
+        clerk_id=target.clerk_id,
+        deleted_at=datetime.utcnow()
+    ))
+
+
+# Any ORM delete of an item or supply request leaves a tombstone in the same
+# transaction.
+event.listen(Item, 'after_delete', _record_deleted)
+event.listen(SupplyRequest, 'after_delete', _record_deleted)
+
+
+@sync_cli.command('prune')
+@click.option('--days', type=int, default=None, help='Keep tombstones this many days (default SYNC_TOMBSTONE_DAYS).')
+def prune_command(days):
+    """Delete tombstones older than the sync retention window."""
+    days = days or current_app.config['SYNC_TOMBSTONE_DAYS']
+    result = db.session.execute(
+        delete(DeletedRecord).where(DeletedRecord.deleted_at < datetime.utcnow() - timedelta(days=days))
+    )
+    db.session.commit()
+    click.echo(f"Deleted {result.rowcount} tombstones older than {days} days")